@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import List
+from utils import ensure_min_python_version
+
+import boto3
+import json
+import os
+import time
+
+ensure_min_python_version()
+
+
+class BakedImage:
+    __data: dict
+
+    def __init__(self, data: dict):
+        self.__data = data
+
+    @property
+    def image_id(self) -> str:
+        return self.__data.get("image_id")
+
+    @property
+    def region(self) -> str:
+        return self.__data.get("region")
+
+    @property
+    def product(self) -> str:
+        return self.__data.get("product")
+
+    @property
+    def version(self) -> str:
+        return self.__data.get("version")
+
+    @property
+    def base_image_id(self) -> str:
+        return self.__data.get("base_image_id")
+
+    @property
+    def created(self) -> float:
+        return self.__data.get("created", 0.0)
+
+    def to_dict(self) -> dict:
+        return dict(self.__data)
+
+    def __str__(self) -> str:
+        return "{} {} ({}, {})".format(self.product, self.version, self.image_id, self.region)
+
+
+class AmiIndex:
+    """A local index of pre-baked AMIs, stored at ~/cluster_management/amis.json
+
+    Each entry maps a region, product and version to the image that bake_ami created with that
+    version already installed.  Lookups can optionally confirm with EC2 that the image still
+    exists, in which case the EC2 client can be passed in (e.g. a mocked one).
+    """
+
+    __path: Path
+
+    @staticmethod
+    def _get_default_path() -> Path:
+        folder = Path.home() / "cluster_management"
+        folder.mkdir(mode=0o755, parents=True, exist_ok=True)
+        return folder / "amis.json"
+
+    @staticmethod
+    def _key(region: str, product: str, version: str) -> str:
+        return "{}/{}/{}".format(region, product, version)
+
+    def __init__(self, path: Path = None):
+        self.__path = path if path is not None else AmiIndex._get_default_path()
+
+    def _read(self) -> dict:
+        if not self.__path.exists():
+            return {}
+
+        try:
+            with self.__path.open(mode="r") as fin:
+                return json.load(fin)
+        except (ValueError, OSError):
+            return {}
+
+    def _write(self, index: dict):
+        temp_path = self.__path.with_suffix(".{}.tmp".format(os.getpid()))
+        with temp_path.open(mode="w") as fout:
+            json.dump(index, fout, indent=2)
+
+        os.replace(str(temp_path), str(self.__path))
+
+    def images(self) -> List[BakedImage]:
+        return list(BakedImage(v) for v in self._read().values())
+
+    def register(self, region: str, product: str, version: str, image_id: str, base_image_id: str) -> BakedImage:
+        index = self._read()
+        entry = {"image_id": image_id, "region": region, "product": product, "version": version,
+                 "base_image_id": base_image_id, "created": time.time()}
+        index[AmiIndex._key(region, product, version)] = entry
+        self._write(index)
+        return BakedImage(entry)
+
+    def remove(self, region: str, product: str, version: str):
+        index = self._read()
+        if index.pop(AmiIndex._key(region, product, version), None) is not None:
+            self._write(index)
+
+    def lookup(self, region: str, product: str, version: str, verify: bool = False, ec2=None) -> BakedImage:
+        """Finds the baked image for a product version
+
+        Arguments:
+            region  -- The region the image must be in
+            product -- The product installed on the image (e.g. couchbase-server)
+            version -- The version installed on the image
+            verify  -- If True, check with EC2 that the image is still available, and forget it if not
+            ec2     -- The EC2 client to verify with (default a new boto3 client for the region)
+
+        Returns:
+            The image, or None if there isn't a usable one
+        """
+
+        entry = self._read().get(AmiIndex._key(region, product, version))
+        if entry is None:
+            return None
+
+        image = BakedImage(entry)
+        if verify:
+            ec2 = ec2 if ec2 is not None else boto3.client("ec2", region_name=region)
+            found = ec2.describe_images(Filters=[{"Name": "image-id", "Values": [image.image_id]}])["Images"]
+            if len(found) == 0 or found[0].get("State") != "available":
+                print("Baked image {} is no longer available, ignoring it".format(image))
+                if len(found) == 0:
+                    self.remove(region, product, version)
+
+                return None
+
+        return image
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+from utils import ensure_min_python_version, file_lock, file_sha256
+from configure import Configuration, SettingKeyNames
+
+import json
+import os
+import shutil
+import time
+
+ensure_min_python_version()
+
+
+class Artifact:
+    __data: dict
+    __root: Path
+
+    def __init__(self, root: Path, data: dict):
+        self.__root = root
+        self.__data = data
+
+    @property
+    def product(self) -> str:
+        return self.__data["product"]
+
+    @property
+    def version(self) -> str:
+        return self.__data["version"]
+
+    @property
+    def build(self) -> str:
+        return self.__data.get("build")
+
+    @property
+    def filename(self) -> str:
+        return self.__data["filename"]
+
+    @property
+    def sha256(self) -> str:
+        return self.__data["sha256"]
+
+    @property
+    def size(self) -> int:
+        return self.__data["size"]
+
+    @property
+    def last_used(self) -> float:
+        return self.__data["last_used"]
+
+    @property
+    def path(self) -> Path:
+        return ArtifactStore._blob_path(self.__root, self.sha256, self.filename)
+
+    def to_dict(self) -> dict:
+        return dict(self.__data)
+
+    def __str__(self) -> str:
+        return "{} {} ({})".format(self.product, self.version if self.build is None else
+                                   "{}-{}".format(self.version, self.build), self.sha256[:12])
+
+
+class ArtifactStore:
+    """A content addressed store of downloaded installer packages, under ~/cluster_management/artifacts
+
+    Packages are indexed by product, version and build, and stored by SHA-256 so that the hash can
+    double as a dedup key on the remote side.  The store is shared by every working directory and is
+    safe to use from several processes at once (the index is guarded by a file lock, and new entries
+    are moved into place atomically).  When the total size exceeds the configured cap, the least
+    recently used packages are evicted.
+    """
+
+    __root: Path
+    __max_bytes: int
+
+    @staticmethod
+    def _get_default_root() -> Path:
+        return Path.home() / "cluster_management" / "artifacts"
+
+    @staticmethod
+    def _blob_path(root: Path, sha256: str, filename: str) -> Path:
+        return root / "blobs" / sha256[:2] / sha256 / filename
+
+    @staticmethod
+    def _key(product: str, version: str, build: str) -> str:
+        return "{}/{}/{}".format(product, version, build or "release")
+
+    def __init__(self, root: Path = None, max_bytes: int = None):
+        if max_bytes is None:
+            config = Configuration()
+            config.load()
+            max_bytes = int(float(config.get(SettingKeyNames.ARTIFACT_CACHE_MAX_GB)) * 1024 * 1024 * 1024)
+
+        self.__root = root if root is not None else ArtifactStore._get_default_root()
+        self.__max_bytes = max_bytes
+        (self.__root / "tmp").mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    @property
+    def root(self) -> Path:
+        return self.__root
+
+    @contextmanager
+    def _locked_index(self):
+        with file_lock(self.__root / ".lock"):
+            index_path = self.__root / "index.json"
+            index = {}
+            if index_path.exists():
+                with index_path.open(mode="r") as fin:
+                    index = json.load(fin)
+
+            original = json.dumps(index, sort_keys=True)
+            yield index
+            if json.dumps(index, sort_keys=True) != original:
+                temp_path = index_path.with_suffix(".{}.tmp".format(os.getpid()))
+                with temp_path.open(mode="w") as fout:
+                    json.dump(index, fout, indent=2)
+
+                os.replace(str(temp_path), str(index_path))
+
+    def temp_path(self, filename: str) -> Path:
+        """Returns the path inside the store to download into before calling add
+
+        The path is stable across runs so that an interrupted download can be resumed,
+        callers must hold download_lock(filename) while writing to it.
+        """
+
+        return self.__root / "tmp" / "{}.partial".format(filename)
+
+    def download_lock(self, filename: str):
+        return file_lock(self.__root / "tmp" / "{}.lock".format(filename))
+
+    def lookup(self, product: str, version: str, build: str) -> Artifact:
+        with self._locked_index() as index:
+            entry = index.get(ArtifactStore._key(product, version, build))
+            if entry is None:
+                return None
+
+            artifact = Artifact(self.__root, entry)
+            if not artifact.path.exists():
+                del index[ArtifactStore._key(product, version, build)]
+                return None
+
+            entry["last_used"] = time.time()
+            return Artifact(self.__root, entry)
+
+    def find_by_hash(self, sha256: str) -> Artifact:
+        with self._locked_index() as index:
+            entry = next((e for e in index.values() if e["sha256"] == sha256), None)
+            return None if entry is None else Artifact(self.__root, entry)
+
+    def add(self, product: str, version: str, build: str, source: Path, filename: str = None) -> Artifact:
+        """Moves a downloaded file into the store and indexes it
+
+        Arguments:
+            product  -- The product name (e.g. couchbase-server)
+            version  -- The product version
+            build    -- The build number, or None for a release
+            source   -- The downloaded file, which will be moved (not copied)
+            filename -- The name the file should have on disk (default source's name)
+
+        Returns:
+            The stored artifact
+        """
+
+        source = Path(source)
+        filename = filename or source.name
+        sha256 = file_sha256(str(source))
+        blob_path = ArtifactStore._blob_path(self.__root, sha256, filename)
+        blob_path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        if blob_path.exists():
+            # Same content already stored (possibly by a concurrent process)
+            source.unlink()
+        else:
+            os.replace(str(source), str(blob_path))
+
+        with self._locked_index() as index:
+            entry = {
+                "product": product,
+                "version": version,
+                "build": build,
+                "filename": filename,
+                "sha256": sha256,
+                "size": blob_path.stat().st_size,
+                "last_used": time.time()
+            }
+            index[ArtifactStore._key(product, version, build)] = entry
+            self._evict(index, keep=sha256)
+            return Artifact(self.__root, entry)
+
+    def fetch(self, product: str, version: str, build: str, filename: str,
+              download: Callable[[Path], None]) -> Artifact:
+        """Returns the stored artifact, calling download(path) to populate the store if needed"""
+
+        artifact = self.lookup(product, version, build)
+        if artifact is not None:
+            return artifact
+
+        with self.download_lock(filename):
+            # Another process may have finished the download while we waited for the lock
+            artifact = self.lookup(product, version, build)
+            if artifact is not None:
+                return artifact
+
+            temp_path = self.temp_path(filename)
+            download(temp_path)
+            return self.add(product, version, build, temp_path, filename)
+
+    def _evict(self, index: Dict[str, dict], keep: str = None):
+        total = sum(e["size"] for e in index.values())
+        for key, entry in sorted(index.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.__max_bytes:
+                break
+
+            if entry["sha256"] == keep:
+                continue
+
+            del index[key]
+            total -= entry["size"]
+            if not any(e["sha256"] == entry["sha256"] for e in index.values()):
+                shutil.rmtree(str(ArtifactStore._blob_path(self.__root, entry["sha256"], entry["filename"]).parent),
+                              ignore_errors=True)
+                print("Evicted {} {} from the artifact cache".format(entry["product"], entry["version"]))
+
+    def evict(self):
+        with self._locked_index() as index:
+            self._evict(index)
+
+    def artifacts(self) -> List[Artifact]:
+        with self._locked_index() as index:
+            return list(Artifact(self.__root, e) for e in index.values())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from configure import Configuration, SettingKeyNames
+from credential import Credential, CredentialName
+from query_cluster import get_aws_instance
+from ssh_utils import ssh_session, ssh_command
+from install_couchbase_server import CouchbaseServerInstaller
+from install_sync_gateway import SyncGatewayInstaller
+from readiness import Probe, wait_until_ready
+from ami_index import AmiIndex, BakedImage
+from constants import BASE_IMAGE_ID
+from utils import ensure_min_python_version
+
+import boto3
+import time
+
+ensure_min_python_version()
+
+INSTALLERS = {
+    CouchbaseServerInstaller.PRODUCT: (CouchbaseServerInstaller, SettingKeyNames.CBS_VERSION),
+    SyncGatewayInstaller.PRODUCT: (SyncGatewayInstaller, SettingKeyNames.SG_VERSION)
+}
+
+# Applied to every image: no transparent huge pages, minimal swapping, and enough file descriptors
+# for Sync Gateway to hold a connection per device
+OS_TUNING_COMMAND = """
+sudo tee /etc/systemd/system/disable-thp.service > /dev/null <<'EOF'
+[Unit]
+Description=Disable Transparent Huge Pages
+Before=couchbase-server.service sync_gateway.service
+
+[Service]
+Type=oneshot
+ExecStart=/bin/sh -c 'echo never > /sys/kernel/mm/transparent_hugepage/enabled'
+ExecStart=/bin/sh -c 'echo never > /sys/kernel/mm/transparent_hugepage/defrag'
+
+[Install]
+WantedBy=multi-user.target
+EOF
+sudo systemctl daemon-reload
+sudo systemctl enable disable-thp
+echo 'vm.swappiness = 1' | sudo tee /etc/sysctl.d/90-device-farm.conf > /dev/null
+printf '* soft nofile 250000\\n* hard nofile 250000\\n' | \\
+    sudo tee /etc/security/limits.d/90-device-farm.conf > /dev/null
+"""
+
+# Each node started from the image must come up as a brand new Couchbase Server node, not a clone of the builder
+CBS_CLEANUP_COMMAND = """
+sudo systemctl stop couchbase-server
+sudo sh -c 'cd /opt/couchbase/var/lib/couchbase && rm -rf config/config.dat ip ip_start data/*'
+"""
+
+SG_CLEANUP_COMMAND = "sudo systemctl stop sync_gateway"
+
+# The stack's key is added again by cloud-init on each new instance
+FINAL_CLEANUP_COMMAND = "sudo rm -f /root/.ssh/authorized_keys ~/.ssh/authorized_keys"
+
+
+def _create_builder_security_group(ec2, name: str) -> str:
+    group_id = ec2.create_security_group(GroupName=name, Description="Temporary SSH access for AMI baking")["GroupId"]
+    ec2.authorize_security_group_ingress(GroupId=group_id, IpPermissions=[
+        {"IpProtocol": "tcp", "FromPort": 22, "ToPort": 22, "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}
+    ])
+    return group_id
+
+
+def bake_ami(product: str, keyname: str, region: str, ssh_keyfile: str, instance_type: str = "m5.large",
+             base_image_id: str = BASE_IMAGE_ID, ec2=None, index: AmiIndex = None,
+             config: Configuration = None, keypass: Credential = None) -> BakedImage:
+    """Creates an AMI with the configured version of a product already installed and the OS tuned
+
+    A temporary builder instance is started from the base image, the package is installed on it
+    over SSH exactly as it would be on a cluster node, and the instance is stopped and imaged.
+    The installer package is left in the home directory, so installing onto a node started from
+    the image skips both the upload and the yum install.  The builder and its security group are
+    always cleaned up, and the new image is registered in the local AMI index.
+
+    Arguments:
+        product       -- couchbase-server or sync-gateway
+        keyname       -- The EC2 key pair to start the builder with
+        region        -- The region to create the image in
+        ssh_keyfile   -- The private key matching keyname
+        instance_type -- The instance type of the builder
+        base_image_id -- The image to start from
+        ec2           -- The EC2 client to use (default a new boto3 client for the region)
+        index         -- The index to register the image in (default the one in ~/cluster_management)
+        config        -- The configuration to read the product version from (default the saved one)
+        keypass       -- The password for ssh_keyfile (default the stored credential for keyname)
+
+    Returns:
+        The registered image
+    """
+
+    (installer_type, version_key) = INSTALLERS[product]
+    if config is None:
+        config = Configuration()
+        config.load()
+
+    version = config.get(version_key)
+
+    ec2 = ec2 if ec2 is not None else boto3.client("ec2", region_name=region)
+    index = index if index is not None else AmiIndex()
+    if keypass is None:
+        keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), keyname)
+
+    # Make sure the package is available before paying for a builder instance
+    artifact = installer_type(None, None, None).download()
+    build_name = "cbl-device-farm-{}-{}-{}".format(product, version, int(time.time()))
+    group_id = _create_builder_security_group(ec2, build_name)
+    instance_id = None
+    try:
+        print("Starting builder instance from {}...".format(base_image_id))
+        reservation = ec2.run_instances(ImageId=base_image_id, InstanceType=instance_type, KeyName=keyname,
+                                        SecurityGroupIds=[group_id], MinCount=1, MaxCount=1,
+                                        TagSpecifications=[{"ResourceType": "instance",
+                                                            "Tags": [{"Key": "Name", "Value": build_name}]}])
+        instance_id = reservation["Instances"][0]["InstanceId"]
+        ec2.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+        instance = get_aws_instance(instance_id, region, ec2=ec2)
+        wait_until_ready([instance], [Probe.SSH])
+
+        print("Installing {} {} ({})...".format(product, version, artifact.filename))
+        installer_type(instance.address, ssh_keyfile, keypass).install()
+        with ssh_session(instance.address, ssh_keyfile, str(keypass)) as ssh_client:
+            ssh_command(ssh_client, instance.name, OS_TUNING_COMMAND)
+            ssh_command(ssh_client, instance.name,
+                        CBS_CLEANUP_COMMAND if product == CouchbaseServerInstaller.PRODUCT else SG_CLEANUP_COMMAND)
+            ssh_command(ssh_client, instance.name, FINAL_CLEANUP_COMMAND)
+
+        # Stop first so that the file system is quiescent when it is snapshotted
+        print("Stopping builder and creating image {}...".format(build_name))
+        ec2.stop_instances(InstanceIds=[instance_id])
+        ec2.get_waiter("instance_stopped").wait(InstanceIds=[instance_id])
+        image_id = ec2.create_image(InstanceId=instance_id, Name=build_name,
+                                    Description="{} {} for CBL device farm".format(product, version))["ImageId"]
+        ec2.get_waiter("image_available").wait(ImageIds=[image_id], WaiterConfig={"Delay": 15, "MaxAttempts": 120})
+    finally:
+        if instance_id is not None:
+            print("Terminating builder instance...")
+            ec2.terminate_instances(InstanceIds=[instance_id])
+            ec2.get_waiter("instance_terminated").wait(InstanceIds=[instance_id])
+
+        ec2.delete_security_group(GroupId=group_id)
+
+    image = index.register(region, product, version, image_id, base_image_id)
+    print("Registered {}".format(image))
+    return image
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="bake_ami")
+    config = Configuration()
+    config.load()
+
+    parser.add_argument("product", action="store", type=str, choices=list(INSTALLERS.keys()),
+                        help="The product to pre-install on the image (the configured version is used)")
+    parser.add_argument("keyname", action="store", type=str,
+                        help="The name of the SSH key to start the builder instance with")
+    parser.add_argument("--region", action="store", type=str, dest="region",
+                        default=config.get(SettingKeyNames.AWS_REGION),
+                        help="The AWS region to create the image in (default %(default)s)")
+    parser.add_argument("--ssh-key", action="store", type=str, dest="sshkey",
+                        help="The key to connect to the builder instance")
+    parser.add_argument("--instance-type", action="store", type=str, dest="instancetype", default="m5.large",
+                        help="The EC2 instance type of the builder (default %(default)s)")
+    parser.add_argument("--base-image", action="store", type=str, dest="baseimage", default=BASE_IMAGE_ID,
+                        help="The AMI to start the builder from (default %(default)s)")
+    args = parser.parse_args()
+
+    bake_ami(args.product, args.keyname, args.region, args.sshkey, args.instancetype, args.baseimage)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from typing import List
+from configure import Configuration, SettingKeyNames
+from credential import Credential, CredentialName
+from query_cluster import AWSState, AWSInstance
+from inventory_cache import InventoryCache
+from install_couchbase_server import CouchbaseServerInstaller, initialize_couchbase_cluster, rebalance_cluster, \
+    wait_for_healthy_nodes
+from install_sync_gateway import SyncGatewayInstaller, deploy_sg_config
+from sg_config import SGProfile
+from couchbase_rest import CouchbaseAdminClient
+from readiness import Probe, wait_until_ready
+from task_graph import TaskGraph
+from utils import ensure_min_python_version
+
+import sys
+
+ensure_min_python_version()
+
+
+def _add_node(cluster: AWSInstance, node: AWSInstance, username: str, password: str):
+    client = CouchbaseAdminClient(cluster.address, username, password)
+    if any(n.hostname.split(":")[0] == node.internal_address for n in client.nodes()):
+        print("{} is already part of the cluster".format(node.name))
+        return
+
+    print("Adding {} as a new node to the {} cluster...".format(node.name, cluster.name))
+    client.add_node(node.internal_address, username, password)
+
+
+def _create_bucket(cluster: AWSInstance, username: str, password: str, bucket_name: str):
+    client = CouchbaseAdminClient(cluster.address, username, password)
+    if client.bucket(bucket_name) is None:
+        print("Creating bucket {}...".format(bucket_name))
+        client.create_bucket(bucket_name, 4096)
+
+
+def _rebalance(cluster: AWSInstance, username: str, password: str):
+    if rebalance_cluster(cluster, username, password) != 0:
+        raise Exception("Rebalance failed")
+
+
+def build_bring_up_graph(cb_instances: List[AWSInstance], sg_instances: List[AWSInstance], ssh_keyfile: str,
+                         keypass: Credential, username: str, password: str, bucket_name: str,
+                         profile: SGProfile = SGProfile.DEFAULT) -> TaskGraph:
+    """Models installing and configuring a cluster as a graph of per node tasks
+
+    Couchbase Server and Sync Gateway install independently of each other, so Sync Gateway is
+    installed while the server nodes are still being installed, added and rebalanced.  A Sync
+    Gateway node's config is deployed as soon as that node is installed and the bucket exists,
+    rather than after the whole server cluster has settled.
+
+    Arguments:
+        cb_instances -- The Couchbase Server nodes (the first one initializes the cluster)
+        sg_instances -- The Sync Gateway nodes
+        ssh_keyfile  -- The key to connect to the nodes with
+        keypass      -- The password for the key
+        username     -- The Couchbase Server administrator username
+        password     -- The Couchbase Server administrator password
+        bucket_name  -- The bucket Sync Gateway uses
+        profile      -- The performance profile to generate the Sync Gateway configs from
+
+    Returns:
+        The graph, ready to run
+    """
+
+    graph = TaskGraph()
+    cluster = cb_instances[0]
+
+    cbs_download = graph.add("download couchbase-server", CouchbaseServerInstaller(None, None, None).download)
+    cbs_installs = {}
+    for instance in cb_instances:
+        installer = CouchbaseServerInstaller(instance.address, ssh_keyfile, keypass)
+        cbs_installs[instance.name] = graph.add("install couchbase-server on {}".format(instance.name),
+                                                lambda i=instance, inst=installer: (wait_until_ready([i], [Probe.SSH]),
+                                                                                    inst.install()),
+                                                [cbs_download])
+
+    cluster_init = graph.add("initialize cluster on {}".format(cluster.name),
+                             lambda: (wait_until_ready([cluster], [Probe.CBS_REST]),
+                                      initialize_couchbase_cluster(cluster, username, password)),
+                             [cbs_installs[cluster.name]])
+
+    add_nodes = []
+    for instance in cb_instances[1:]:
+        add_nodes.append(graph.add("add {} to cluster".format(instance.name),
+                                   lambda i=instance: (wait_until_ready([i], [Probe.CBS_REST]),
+                                                       _add_node(cluster, i, username, password)),
+                                   [cluster_init, cbs_installs[instance.name]]))
+
+    rebalance = graph.add("rebalance", lambda: _rebalance(cluster, username, password), [cluster_init] + add_nodes)
+    healthy = graph.add("wait for healthy cluster",
+                        lambda: wait_for_healthy_nodes(cluster, username, password, len(cb_instances)), [rebalance])
+    # Creating the bucket during the rebalance would race it, and Sync Gateway needs the whole cluster anyway
+    bucket = graph.add("create bucket {}".format(bucket_name),
+                       lambda: _create_bucket(cluster, username, password, bucket_name), [healthy])
+
+    sg_download = graph.add("download sync-gateway", SyncGatewayInstaller(None, None, None).download)
+    for instance in sg_instances:
+        installer = SyncGatewayInstaller(instance.address, ssh_keyfile, keypass)
+        install = graph.add("install sync-gateway on {}".format(instance.name),
+                            lambda i=instance, inst=installer: (wait_until_ready([i], [Probe.SSH]), inst.install()),
+                            [sg_download])
+        deploy = graph.add("deploy sync-gateway config on {}".format(instance.name),
+                           lambda i=instance: deploy_sg_config(i, cluster, ssh_keyfile, keypass, profile),
+                           [install, bucket])
+        graph.add("wait for sync-gateway on {}".format(instance.name),
+                  lambda i=instance: wait_until_ready([i], [Probe.SG_PUBLIC, Probe.SG_ADMIN], ssh_keyfile=ssh_keyfile,
+                                                      keypass=str(keypass)),
+                  [deploy])
+
+    return graph
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="bring_up")
+    config = Configuration()
+    config.load()
+
+    parser.add_argument("keyname", action="store", type=str,
+                        help="The name of the SSH key that the EC2 instances are using")
+    parser.add_argument("--region", action="store", type=str, dest="region",
+                        default=config.get(SettingKeyNames.AWS_REGION),
+                        help="The EC2 region to query (default %(default)s)")
+    parser.add_argument("--server-name-prefix", action="store", type=str, dest="servername",
+                        default=config.get(SettingKeyNames.CBS_SERVER_PREFIX),
+                        help="The prefix of the Couchbase Server nodes in EC2 (default %(default)s)")
+    parser.add_argument("--sg-name-prefix", action="store", type=str, dest="sgname",
+                        default=config.get(SettingKeyNames.SG_SERVER_PREFIX),
+                        help="The prefix of the Sync Gateway instance names in EC2 (default %(default)s)")
+    parser.add_argument("--bucket-name", action="store", type=str, dest="bucketname", default="device-farm-data",
+                        help="The name of the bucket for Sync Gateway to use (default %(default)s)")
+    parser.add_argument("--ssh-key", action="store", type=str, dest="sshkey",
+                        help="The key to connect to EC2 instances")
+    parser.add_argument("--username", action="store", default=config.get(SettingKeyNames.CBS_ADMIN),
+                        help="The administrator username for Couchbase Server (default %(default)s)")
+    parser.add_argument("--password", action="store",
+                        help="The administrator password for Couchbase Server (If not provided, " +
+                        "run credential.py for information on how it is resolved)")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+    parser.add_argument("--profile", action="store", type=lambda s: SGProfile(s), choices=list(SGProfile),
+                        default=SGProfile.DEFAULT,
+                        help="The performance profile to generate the Sync Gateway config from (default %(default)s)")
+
+    args = parser.parse_args()
+    inventory = InventoryCache()
+    cb_instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.servername,
+                                           refresh=args.refresh)
+    sg_instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname)
+    if len(cb_instances) == 0:
+        print("No Couchbase Server instances found, nothing to do!")
+        sys.exit(0)
+
+    keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), args.keyname)
+    couchbase_pw = Credential("Couchbase Server password", args.password, str(CredentialName.CM_CBS_PASS), args.keyname)
+    graph = build_bring_up_graph(cb_instances, sg_instances, args.sshkey, keypass, args.username, str(couchbase_pw),
+                                 args.bucketname, args.profile)
+    succeeded = graph.run()
+    print()
+    graph.print_report()
+    sys.exit(0 if succeeded else 1)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+from abc import ABC, abstractmethod
+from enum import Enum
+from pathlib import Path
+from statistics import median
+from typing import Dict, List, Tuple
+from couchbase_rest import BucketInfo, CouchbaseAdminClient, CouchbaseRestError
+from bucket_snapshot import BucketSnapshots, SnapshotError
+from utils import Backoff, ensure_min_python_version
+
+import json
+import os
+import time
+
+ensure_min_python_version()
+
+# Settings for a bucket that doesn't exist yet
+DEFAULT_RAM_QUOTA_MB = 4096
+DEFAULT_REPLICAS = 1
+
+# How many of the most recent timings are kept for each strategy
+TIMING_HISTORY = 5
+
+
+class ResetStrategyName(Enum):
+    AUTO = "auto"
+    FLUSH = "flush"
+    RECREATE_BUCKET = "recreate-bucket"
+    RECREATE_SCOPE = "recreate-scope"
+    RESTORE_SNAPSHOT = "restore-snapshot"
+
+    def __str__(self):
+        return self.value
+
+
+def server_version(client: CouchbaseAdminClient) -> Tuple[int, int]:
+    """Returns the (major, minor) version of the oldest node in the cluster"""
+
+    versions = []
+    for node in client.nodes():
+        try:
+            parts = node.version.split("-")[0].split(".")
+            versions.append((int(parts[0]), int(parts[1])))
+        except (AttributeError, IndexError, ValueError):
+            continue
+
+    return min(versions) if len(versions) > 0 else (0, 0)
+
+
+def wait_for_bucket(client: CouchbaseAdminClient, bucket_name: str, timeout: float = 120) -> BucketInfo:
+    """Waits for a bucket to exist and be healthy on every node, and returns it"""
+
+    backoff = Backoff(0.5, 5.0)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            bucket = client.bucket(bucket_name)
+            if bucket is not None and bucket.is_ready:
+                return bucket
+        except CouchbaseRestError:
+            pass
+
+        if time.monotonic() >= deadline:
+            raise CouchbaseRestError("Bucket {} was not ready after {} seconds".format(bucket_name, timeout))
+
+        time.sleep(backoff.next())
+
+
+class ResetStrategy(ABC):
+    """A way of emptying a bucket, which may only work on some clusters
+
+    ESTIMATE is the number of seconds a reset is assumed to take before it has been timed on
+    the cluster, and only decides which strategy gets tried first.
+    """
+
+    NAME: ResetStrategyName = None
+    ESTIMATE: float = None
+
+    @abstractmethod
+    def supported(self, client: CouchbaseAdminClient, bucket: BucketInfo, version: Tuple[int, int]) -> bool:
+        """Whether this strategy can reset the bucket on a cluster running the given (major, minor) version"""
+
+    @abstractmethod
+    def reset(self, client: CouchbaseAdminClient, bucket: BucketInfo):
+        """Empties the bucket, raising an exception if it couldn't"""
+
+
+class FlushStrategy(ResetStrategy):
+    NAME = ResetStrategyName.FLUSH
+    ESTIMATE = 30.0
+
+    def supported(self, client: CouchbaseAdminClient, bucket: BucketInfo, version: Tuple[int, int]) -> bool:
+        return bucket.flush_enabled
+
+    def reset(self, client: CouchbaseAdminClient, bucket: BucketInfo):
+        client.flush_bucket(bucket.name)
+        wait_for_bucket(client, bucket.name)
+
+
+class RecreateBucketStrategy(ResetStrategy):
+    NAME = ResetStrategyName.RECREATE_BUCKET
+    ESTIMATE = 60.0
+
+    def supported(self, client: CouchbaseAdminClient, bucket: BucketInfo, version: Tuple[int, int]) -> bool:
+        return True
+
+    def reset(self, client: CouchbaseAdminClient, bucket: BucketInfo):
+        client.delete_bucket(bucket.name)
+        client.create_bucket(bucket.name, bucket.ram_quota_mb, bucket.replicas, bucket.flush_enabled,
+                             bucket.bucket_type)
+        wait_for_bucket(client, bucket.name)
+
+
+class RecreateScopeStrategy(ResetStrategy):
+    """Drops a scope and recreates it with the same collections, which is close to instant
+
+    Only named scopes can be dropped, so this needs Couchbase Server 7.0 and data that lives in
+    a scope other than _default.
+    """
+
+    NAME = ResetStrategyName.RECREATE_SCOPE
+    ESTIMATE = 2.0
+
+    __scope: str
+
+    def __init__(self, scope: str):
+        self.__scope = scope
+
+    def supported(self, client: CouchbaseAdminClient, bucket: BucketInfo, version: Tuple[int, int]) -> bool:
+        if self.__scope is None or self.__scope == "_default" or version < (7, 0):
+            return False
+
+        return self.__scope in client.scopes(bucket.name)
+
+    def reset(self, client: CouchbaseAdminClient, bucket: BucketInfo):
+        collections = client.scopes(bucket.name)[self.__scope]
+        client.drop_scope(bucket.name, self.__scope)
+        client.create_scope(bucket.name, self.__scope)
+        for c in collections:
+            client.create_collection(bucket.name, self.__scope, c["name"], c.get("maxTTL", 0))
+
+
+class RestoreSnapshotStrategy(ResetStrategy):
+    """Deletes the bucket and restores it from a snapshot, which recreates it with the snapshot's data
+
+    cbbackupmgr only creates buckets while restoring from 7.0, and the snapshot has to exist.
+    """
+
+    NAME = ResetStrategyName.RESTORE_SNAPSHOT
+    ESTIMATE = 120.0
+
+    __snapshots: BucketSnapshots
+    __snapshot: str
+
+    def __init__(self, snapshots: BucketSnapshots, snapshot: str):
+        self.__snapshots = snapshots
+        self.__snapshot = snapshot
+
+    def supported(self, client: CouchbaseAdminClient, bucket: BucketInfo, version: Tuple[int, int]) -> bool:
+        if self.__snapshots is None or self.__snapshot is None or version < (7, 0):
+            return False
+
+        return self.__snapshots.exists(bucket.name, self.__snapshot)
+
+    def reset(self, client: CouchbaseAdminClient, bucket: BucketInfo):
+        client.delete_bucket(bucket.name)
+        self.__snapshots.restore(bucket.name, self.__snapshot, auto_create=True)
+        wait_for_bucket(client, bucket.name)
+
+
+class ResetTimings:
+    """The recent durations of each reset strategy per cluster and bucket, stored at
+    ~/cluster_management/reset_timings.json
+    """
+
+    __path: Path
+
+    @staticmethod
+    def _get_default_path() -> Path:
+        folder = Path.home() / "cluster_management"
+        folder.mkdir(mode=0o755, parents=True, exist_ok=True)
+        return folder / "reset_timings.json"
+
+    @staticmethod
+    def _key(cluster: str, bucket_name: str, strategy: ResetStrategyName) -> str:
+        return "{}/{}/{}".format(cluster, bucket_name, strategy)
+
+    def __init__(self, path: Path = None):
+        self.__path = path if path is not None else ResetTimings._get_default_path()
+
+    def _read(self) -> Dict[str, List[float]]:
+        if not self.__path.exists():
+            return {}
+
+        try:
+            with self.__path.open(mode="r") as fin:
+                return json.load(fin)
+        except (ValueError, OSError):
+            return {}
+
+    def _write(self, timings: Dict[str, List[float]]):
+        temp_path = self.__path.with_suffix(".{}.tmp".format(os.getpid()))
+        with temp_path.open(mode="w") as fout:
+            json.dump(timings, fout, indent=2)
+
+        os.replace(str(temp_path), str(self.__path))
+
+    def estimate(self, cluster: str, bucket_name: str, strategy: ResetStrategyName) -> float:
+        """Returns the median of the recent timings, or None if the strategy hasn't been timed"""
+
+        durations = self._read().get(ResetTimings._key(cluster, bucket_name, strategy), [])
+        return median(durations) if len(durations) > 0 else None
+
+    def record(self, cluster: str, bucket_name: str, strategy: ResetStrategyName, seconds: float):
+        timings = self._read()
+        key = ResetTimings._key(cluster, bucket_name, strategy)
+        timings[key] = (timings.get(key, []) + [round(seconds, 3)])[-TIMING_HISTORY:]
+        self._write(timings)
+
+
+class BucketResetter:
+    """Empties a bucket with the fastest strategy the cluster supports
+
+    Every reset is timed and recorded, and with ResetStrategyName.AUTO the supported strategies
+    are tried in order of their recorded (or, until they have been timed, estimated) duration,
+    falling back to the next one if a strategy fails.
+
+    If a snapshot is given the bucket ends up holding the snapshot instead of being empty.  With
+    ResetStrategyName.AUTO it is restored in place of the bucket where the cluster supports that,
+    and otherwise it is restored into the bucket after emptying it.
+    """
+
+    __client: CouchbaseAdminClient
+    __bucket_name: str
+    __strategies: List[ResetStrategy]
+    __timings: ResetTimings
+    __snapshots: BucketSnapshots
+    __snapshot: str
+
+    def __init__(self, client: CouchbaseAdminClient, bucket_name: str, scope: str = None,
+                 timings: ResetTimings = None, snapshots: BucketSnapshots = None, snapshot: str = None):
+        self.__client = client
+        self.__bucket_name = bucket_name
+        self.__strategies = [FlushStrategy(), RecreateBucketStrategy(), RecreateScopeStrategy(scope),
+                             RestoreSnapshotStrategy(snapshots, snapshot)]
+        self.__timings = timings if timings is not None else ResetTimings()
+        self.__snapshots = snapshots
+        self.__snapshot = snapshot
+
+    def _estimate(self, strategy: ResetStrategy) -> float:
+        recorded = self.__timings.estimate(self.__client.base_url, self.__bucket_name, strategy.NAME)
+        return recorded if recorded is not None else strategy.ESTIMATE
+
+    def candidates(self, bucket: BucketInfo) -> List[ResetStrategy]:
+        """Returns the strategies the cluster supports for the bucket, fastest first"""
+
+        version = server_version(self.__client)
+        supported = list(s for s in self.__strategies if s.supported(self.__client, bucket, version))
+        return sorted(supported, key=self._estimate)
+
+    def reset(self, strategy: ResetStrategyName = ResetStrategyName.AUTO) -> ResetStrategyName:
+        """Empties the bucket (or resets it to the snapshot), creating it if it doesn't exist
+
+        Arguments:
+            strategy -- The strategy to use, or ResetStrategyName.AUTO to pick the fastest
+
+        Returns:
+            The strategy that reset the bucket, or None if the bucket was created
+        """
+
+        result = self._reset(strategy)
+        if self.__snapshot is not None and result != ResetStrategyName.RESTORE_SNAPSHOT:
+            start = time.monotonic()
+            self.__snapshots.restore(self.__bucket_name, self.__snapshot)
+            print("Restored snapshot {} in {:.1f}s".format(self.__snapshot, time.monotonic() - start))
+
+        return result
+
+    def _reset(self, strategy: ResetStrategyName) -> ResetStrategyName:
+        bucket = self.__client.bucket(self.__bucket_name)
+        if bucket is None:
+            self.__client.create_bucket(self.__bucket_name, DEFAULT_RAM_QUOTA_MB, DEFAULT_REPLICAS)
+            wait_for_bucket(self.__client, self.__bucket_name)
+            print("Created new bucket {}...".format(self.__bucket_name))
+            return None
+
+        candidates = self.candidates(bucket)
+        restore = list(s for s in candidates if s.NAME == ResetStrategyName.RESTORE_SNAPSHOT)
+        if strategy == ResetStrategyName.AUTO and len(restore) > 0:
+            # Emptying the bucket is only a fallback, since the snapshot still has to be restored after it
+            candidates = restore + list(s for s in candidates if s.NAME != ResetStrategyName.RESTORE_SNAPSHOT)
+        elif strategy != ResetStrategyName.AUTO:
+            candidates = list(s for s in candidates if s.NAME == strategy)
+            if len(candidates) == 0:
+                raise CouchbaseRestError("The {} strategy can't reset bucket {} on this cluster".format(
+                                         strategy, self.__bucket_name))
+
+        for (i, candidate) in enumerate(candidates):
+            print("Resetting bucket {} ({})...".format(self.__bucket_name, candidate.NAME))
+            start = time.monotonic()
+            try:
+                candidate.reset(self.__client, bucket)
+            except (CouchbaseRestError, SnapshotError) as e:
+                if i == len(candidates) - 1:
+                    raise
+
+                print("{} failed ({}), trying {}".format(candidate.NAME, e, candidates[i + 1].NAME))
+                if self.__client.bucket(self.__bucket_name) is None:
+                    # It failed after deleting the bucket, so put it back for the next strategy
+                    self.__client.create_bucket(bucket.name, bucket.ram_quota_mb, bucket.replicas,
+                                                bucket.flush_enabled, bucket.bucket_type)
+                    wait_for_bucket(self.__client, self.__bucket_name)
+
+                continue
+
+            elapsed = time.monotonic() - start
+            self.__timings.record(self.__client.base_url, self.__bucket_name, candidate.NAME, elapsed)
+            print("Reset bucket {} with {} in {:.1f}s".format(self.__bucket_name, candidate.NAME, elapsed))
+            return candidate.NAME
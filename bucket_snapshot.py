@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+from typing import Tuple
+from query_cluster import AWSInstance
+from ssh_utils import remote_secret_file, ssh_command, ssh_session
+from utils import ensure_min_python_version
+
+import shlex
+import uuid
+
+ensure_min_python_version()
+
+CBBACKUPMGR = "/opt/couchbase/bin/cbbackupmgr"
+DEFAULT_SNAPSHOT_ARCHIVE = "/home/centos/cbbackup"
+
+# Cloud archives are written through a local staging folder on the node
+OBJECT_STAGING_DIR = "/home/centos/cbbackup-staging"
+
+# cbbackupmgr reads the password from CB_PASSWORD, which is set from this file rather than the command line
+PASSWORD_FILE_PREFIX = "/home/centos/.cbbackupmgr-password"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class BucketSnapshots:
+    """Saves and restores snapshots of a bucket with cbbackupmgr, run on one of the Couchbase Server nodes
+
+    Each snapshot is its own repository in the archive, named after the bucket and the snapshot.  The
+    archive is either a folder on the node or an s3:// URL, in which case cbbackupmgr authenticates
+    with the node's IAM role (or its AWS environment).  Backups and restores use one thread per core
+    on the node, and each thread works on its own vBuckets.
+    """
+
+    __instance: AWSInstance
+    __ssh_keyfile: str
+    __keypass: str
+    __cb_user: str
+    __cb_pass: str
+    __archive: str
+    __region: str
+
+    def __init__(self, instance: AWSInstance, ssh_keyfile: str, keypass: str, cb_user: str, cb_pass: str,
+                 archive: str = DEFAULT_SNAPSHOT_ARCHIVE, region: str = None):
+        self.__instance = instance
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__cb_user = cb_user
+        self.__cb_pass = cb_pass
+        self.__archive = archive
+        self.__region = region
+
+    @property
+    def archive(self) -> str:
+        return self.__archive
+
+    @property
+    def is_cloud_archive(self) -> bool:
+        return self.__archive.startswith("s3://")
+
+    @staticmethod
+    def repo_name(bucket_name: str, snapshot: str) -> str:
+        return "{}-{}".format(bucket_name, snapshot)
+
+    def _command(self, action: str, bucket_name: str, snapshot: str, *args: str) -> str:
+        command = [CBBACKUPMGR, action, "--archive", shlex.quote(self.__archive), "--repo",
+                   shlex.quote(BucketSnapshots.repo_name(bucket_name, snapshot))]
+        if self.is_cloud_archive:
+            command += ["--obj-staging-dir", OBJECT_STAGING_DIR]
+            if self.__region is not None:
+                command += ["--obj-region", self.__region]
+
+        return " ".join(command + list(args))
+
+    def _cluster_args(self) -> str:
+        return "--cluster couchbase://localhost --username {} --threads $(nproc)".format(shlex.quote(self.__cb_user))
+
+    def _run(self, ssh_client, command: str, timeout: float = None) -> int:
+        return ssh_command(ssh_client, self.__instance.name, command, timeout)
+
+    def _run_authenticated(self, ssh_client, command: str, timeout: float = None) -> int:
+        password_file = "{}.{}".format(PASSWORD_FILE_PREFIX, uuid.uuid4().hex[:8])
+        with remote_secret_file(ssh_client, password_file, self.__cb_pass):
+            return self._run(ssh_client, "CB_PASSWORD=\"$(cat {})\" {}".format(password_file, command), timeout)
+
+    def _prepare(self, ssh_client):
+        folder = OBJECT_STAGING_DIR if self.is_cloud_archive else shlex.quote(self.__archive)
+        self._run(ssh_client, "mkdir -p {}".format(folder))
+
+    def exists(self, bucket_name: str, snapshot: str) -> bool:
+        with ssh_session(self.__instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            (_, stdout, _) = ssh_client.exec_command(self._command("info", bucket_name, snapshot))
+            return stdout.channel.recv_exit_status() == 0
+
+    def save(self, bucket_name: str, snapshot: str, version: Tuple[int, int], timeout: float = 3600):
+        """Saves the current contents of a bucket as a snapshot, replacing any snapshot with the same name
+
+        Arguments:
+            bucket_name -- The bucket to save
+            snapshot    -- The name of the snapshot
+            version     -- The (major, minor) version of the cluster, which decides the cbbackupmgr options
+            timeout     -- How long the backup may take, in seconds
+        """
+
+        include = "--include-data" if version >= (7, 0) else "--include-buckets"
+        with ssh_session(self.__instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            self._prepare(ssh_client)
+            # An existing repository can't be reconfigured, so replace it (it's fine if there isn't one)
+            self._run(ssh_client, "{} > /dev/null 2>&1; true".format(self._command("remove", bucket_name, snapshot)))
+            if self._run(ssh_client, self._command("config", bucket_name, snapshot, include, bucket_name)) != 0:
+                raise SnapshotError("Failed to create the snapshot repository for {}".format(snapshot))
+
+            print("Saving bucket {} as snapshot {} in {}...".format(bucket_name, snapshot, self.__archive))
+            if self._run_authenticated(ssh_client, self._command("backup", bucket_name, snapshot, self._cluster_args()),
+                                       timeout) != 0:
+                raise SnapshotError("Failed to save bucket {} as snapshot {}".format(bucket_name, snapshot))
+
+    def restore(self, bucket_name: str, snapshot: str, auto_create: bool = False, timeout: float = 3600):
+        """Restores the latest backup in a snapshot into a bucket
+
+        Arguments:
+            bucket_name -- The bucket the snapshot was saved from
+            snapshot    -- The name of the snapshot
+            auto_create -- If True, create the bucket from the settings in the snapshot (7.0 and up)
+            timeout     -- How long the restore may take, in seconds
+        """
+
+        args = [self._cluster_args(), "--force-updates"]
+        if auto_create:
+            args.append("--auto-create-buckets")
+
+        print("Restoring snapshot {} into bucket {}...".format(snapshot, bucket_name))
+        with ssh_session(self.__instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            self._prepare(ssh_client)
+            command = self._command("restore", bucket_name, snapshot, *args)
+            if self._run_authenticated(ssh_client, command, timeout) != 0:
+                raise SnapshotError("Failed to restore snapshot {} into bucket {}".format(snapshot, bucket_name))
@@ -5,7 +5,8 @@ import json
 import sys
 
 from argparse import ArgumentParser
-from query_cluster import get_aws_instances, AWSState, AWSInstance
+from query_cluster import AWSState, AWSInstance
+from inventory_cache import InventoryCache
 from typing import List
 from utils import ensure_min_python_version
 from configure import Configuration, SettingKeyNames
@@ -59,12 +60,17 @@ if __name__ == "__main__":
     parser.add_argument("--region",
                         action="store", type=str, dest="region", default=config.get(SettingKeyNames.AWS_REGION),
                         help="The EC2 region (default %(default)s)")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+    parser.add_argument("--no-wait", action="store_true", dest="nowait",
+                        help="Don't wait for the instances to finish starting or stopping")
 
     args = parser.parse_args()
+    inventory = InventoryCache()
     if args.state == AWSState.STOPPED:
-        instances = get_aws_instances(AWSState.RUNNING, args.keyname, args.region)
+        instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, refresh=args.refresh)
     else:
-        instances = get_aws_instances(AWSState.STOPPED, args.keyname, args.region)
+        instances = inventory.get_instances(AWSState.STOPPED, args.keyname, args.region, refresh=args.refresh)
 
     if len(instances) == 0:
         print("No instances found that need changing!")
@@ -75,4 +81,12 @@ if __name__ == "__main__":
     else:
         result = start_cluster(instances, args.region)
 
+    # Addresses change when instances stop and start, so nothing cached is valid anymore
+    InventoryCache.invalidate(args.keyname, args.region, transitioning=True)
     print(json.dumps(result))
+    if not args.nowait:
+        print("Waiting for the instances to be {}...".format(str(args.state).lower()))
+        waiter_name = "instance_stopped" if args.state == AWSState.STOPPED else "instance_running"
+        boto3.client("ec2", region_name=args.region).get_waiter(waiter_name).wait(
+            InstanceIds=list(i.id for i in instances))
+        InventoryCache.invalidate(args.keyname, args.region)
@@ -1,11 +1,13 @@
 package com.couchbase.massreplication;
 
 import android.content.Context;
+import android.provider.Settings;
 
 import androidx.test.platform.app.InstrumentationRegistry;
 import androidx.test.ext.junit.runners.AndroidJUnit4;
 
 import com.couchbase.lite.AbstractReplicator;
+import com.couchbase.lite.BasicAuthenticator;
 import com.couchbase.lite.CouchbaseLite;
 import com.couchbase.lite.CouchbaseLiteException;
 import com.couchbase.lite.Database;
@@ -14,6 +16,9 @@ import com.couchbase.lite.Replicator;
 import com.couchbase.lite.ReplicatorConfiguration;
 import com.couchbase.lite.URLEndpoint;
 
+import org.json.JSONArray;
+import org.json.JSONException;
+import org.json.JSONObject;
 import org.junit.After;
 import org.junit.Before;
 import org.junit.Test;
@@ -25,7 +30,16 @@ import java.net.MalformedURLException;
 import java.net.URI;
 import java.net.URISyntaxException;
 import java.net.URL;
+import java.nio.charset.StandardCharsets;
+import java.security.InvalidKeyException;
+import java.security.MessageDigest;
+import java.security.NoSuchAlgorithmException;
+import java.util.ArrayList;
 import java.util.Date;
+import java.util.List;
+
+import javax.crypto.Mac;
+import javax.crypto.spec.SecretKeySpec;
 
 import okhttp3.Call;
 import okhttp3.OkHttpClient;
@@ -41,28 +55,124 @@ import static org.junit.Assert.*;
  */
 @RunWith(AndroidJUnit4.class)
 public class MassReplicationTest {
+    private static final String DEVICE_FARM_FOLDER = "https://cbmobile-bucket.s3.amazonaws.com/device-farm/";
+
     private Replicator _replicator;
     private Database _database;
     private StatusAwaiter _replAwaiter;
 
+    // Returns the contents of a file in the device farm folder, or null if it isn't there
+    private static String fetchDeviceFile(OkHttpClient client, String filename) throws IOException {
+        Request request = new Request.Builder()
+                .url(new URL(DEVICE_FARM_FOLDER + filename))
+                .build();
+        Call call = client.newCall(request);
+        try (Response response = call.execute()) {
+            if (!response.isSuccessful()) {
+                return null;
+            }
+
+            return response.body().string();
+        }
+    }
+
+    // Picks the candidate with the highest SHA-256 of "<device id>|<candidate>", the same as
+    // sg_endpoints.assign_endpoint, so every device keeps its pick and the devices spread evenly
+    static String rendezvous(String deviceId, List<String> candidates) throws NoSuchAlgorithmException {
+        MessageDigest digest = MessageDigest.getInstance("SHA-256");
+        String best = null;
+        String bestScore = null;
+        for (String candidate : candidates) {
+            byte[] hash = digest.digest((deviceId + "|" + candidate).getBytes(StandardCharsets.UTF_8));
+            String score = toHex(hash);
+            if (bestScore == null || score.compareTo(bestScore) > 0) {
+                best = candidate;
+                bestScore = score;
+            }
+        }
+
+        return best;
+    }
+
+    private static String toHex(byte[] bytes) {
+        StringBuilder hex = new StringBuilder();
+        for (byte b : bytes) {
+            hex.append(String.format("%02x", b & 0xff));
+        }
+
+        return hex.toString();
+    }
+
+    // Picks a user from the published usernames and derives its password from the secret the same
+    // way provision_sg_users.py does, or returns null to replicate as GUEST
+    private static BasicAuthenticator syncGatewayUser(OkHttpClient client, String deviceId)
+            throws IOException, JSONException, NoSuchAlgorithmException, InvalidKeyException {
+        String mapping = fetchDeviceFile(client, "device_farm_sg_users.json");
+        if (mapping == null || BuildConfig.SG_USER_SECRET.isEmpty()) {
+            return null;
+        }
+
+        JSONArray users = new JSONObject(mapping).getJSONArray("users");
+        List<String> usernames = new ArrayList<>();
+        for (int i = 0; i < users.length(); i++) {
+            usernames.add(users.getJSONObject(i).getString("username"));
+        }
+
+        if (usernames.isEmpty()) {
+            return null;
+        }
+
+        String username = rendezvous(deviceId, usernames);
+        Mac mac = Mac.getInstance("HmacSHA256");
+        mac.init(new SecretKeySpec(BuildConfig.SG_USER_SECRET.getBytes(StandardCharsets.UTF_8), "HmacSHA256"));
+        String password = toHex(mac.doFinal(username.getBytes(StandardCharsets.UTF_8))).substring(0, 20);
+        return new BasicAuthenticator(username, password);
+    }
+
+    // Uses the endpoint manifest if one is published, and otherwise the single published address
+    private static URI syncGatewayUri(OkHttpClient client, String deviceId)
+            throws IOException, URISyntaxException, JSONException, NoSuchAlgorithmException {
+        String manifest = fetchDeviceFile(client, "device_farm_sg_manifest.json");
+        if (manifest != null) {
+            JSONObject parsed = new JSONObject(manifest);
+            JSONArray endpoints = parsed.getJSONArray("endpoints");
+            List<String> candidates = new ArrayList<>();
+            for (int i = 0; i < endpoints.length(); i++) {
+                candidates.add(endpoints.getString(i));
+            }
+
+            if (!candidates.isEmpty()) {
+                String address = rendezvous(deviceId, candidates);
+                return new URI("ws", null, address, parsed.optInt("port", 4984), "/db", null, null);
+            }
+        }
+
+        String address = fetchDeviceFile(client, "device_farm_sg_address.txt");
+        if (address == null) {
+            throw new IOException("No Sync Gateway address has been published");
+        }
+
+        return new URI("ws", null, address.trim(), 4984, "/db", null, null);
+    }
+
     @Before
-    public void setUp() throws CouchbaseLiteException, IOException, URISyntaxException {
-        Initializer.getInstance().init(InstrumentationRegistry.getInstrumentation().getTargetContext());
+    public void setUp() throws Exception {
+        Context context = InstrumentationRegistry.getInstrumentation().getTargetContext();
+        Initializer.getInstance().init(context);
 
         try {
             if (_replicator == null) {
                 _database = new Database("device-farm");
-                URL addressUrl = new URL("https://cbmobile-bucket.s3.amazonaws.com/device-farm/device_farm_sg_address.txt");
+                String deviceId = Settings.Secure.getString(context.getContentResolver(), Settings.Secure.ANDROID_ID);
                 OkHttpClient client = new OkHttpClient();
-                Request request = new Request.Builder()
-                        .url(addressUrl)
-                        .build();
-                Call call = client.newCall(request);
-                Response response = call.execute();
-                String address = response.body().string();
-                URI fullAddress = new URI("ws", null, address, 4984, "/db", null, null);
+                URI fullAddress = syncGatewayUri(client, deviceId);
                 ReplicatorConfiguration replConfig = new ReplicatorConfiguration(_database, new URLEndpoint(fullAddress))
                         .setContinuous(true);
+                BasicAuthenticator user = syncGatewayUser(client, deviceId);
+                if (user != null) {
+                    replConfig.setAuthenticator(user);
+                }
+
                 _replicator = new Replicator(replConfig);
                 _replAwaiter = new StatusAwaiter(_replicator);
             }
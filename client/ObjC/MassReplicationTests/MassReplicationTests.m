@@ -7,6 +7,9 @@
 //
 
 #import <XCTest/XCTest.h>
+#import <UIKit/UIKit.h>
+#import <CommonCrypto/CommonDigest.h>
+#import <CommonCrypto/CommonHMAC.h>
 #import <CouchbaseLite/CouchbaseLite.h>
 #import "DFStatusAwaiter.h"
 
@@ -14,6 +17,8 @@
 
 @end
 
+static NSString* const kDeviceFarmFolder = @"https://cbmobile-bucket.s3.amazonaws.com/device-farm/";
+
 @implementation MassReplicationTests
 {
     CBLReplicator* _replicator;
@@ -22,6 +27,93 @@
     DFStatusAwaiter* _replAwaiter;
 }
 
+// Returns the contents of a file in the device farm folder, or nil if it isn't there
++ (NSData*)fetchDeviceFile:(NSString*)filename {
+    NSURL* url = [NSURL URLWithString:[kDeviceFarmFolder stringByAppendingString:filename]];
+    return [NSData dataWithContentsOfURL:url];
+}
+
+// Picks the candidate with the highest SHA-256 of "<device id>|<candidate>", the same as
+// sg_endpoints.assign_endpoint, so every device keeps its pick and the devices spread evenly
++ (NSString*)rendezvousForDevice:(NSString*)deviceId candidates:(NSArray<NSString*>*)candidates {
+    NSString* best = nil;
+    NSString* bestScore = nil;
+    for(NSString* candidate in candidates) {
+        NSData* input = [[NSString stringWithFormat:@"%@|%@", deviceId, candidate] dataUsingEncoding:NSUTF8StringEncoding];
+        unsigned char hash[CC_SHA256_DIGEST_LENGTH];
+        CC_SHA256(input.bytes, (CC_LONG)input.length, hash);
+        NSString* score = [self hexString:hash length:CC_SHA256_DIGEST_LENGTH];
+        if(!bestScore || [score compare:bestScore] == NSOrderedDescending) {
+            best = candidate;
+            bestScore = score;
+        }
+    }
+    
+    return best;
+}
+
++ (NSString*)hexString:(const unsigned char*)bytes length:(size_t)length {
+    NSMutableString* hex = [NSMutableString stringWithCapacity:length * 2];
+    for(size_t i = 0; i < length; i++) {
+        [hex appendFormat:@"%02x", bytes[i]];
+    }
+    
+    return hex;
+}
+
+// Picks a user from the published usernames and derives its password from the secret the same
+// way provision_sg_users.py does, or returns nil to replicate as GUEST.  The secret comes from the
+// SG_USER_SECRET build setting of the test target.
++ (CBLBasicAuthenticator*)syncGatewayUserForDevice:(NSString*)deviceId {
+    NSString* secret = [NSBundle bundleForClass:self].infoDictionary[@"SGUserSecret"];
+    NSData* mappingData = [self fetchDeviceFile:@"device_farm_sg_users.json"];
+    if(secret.length == 0 || !mappingData) {
+        return nil;
+    }
+    
+    NSDictionary* mapping = [NSJSONSerialization JSONObjectWithData:mappingData options:0 error:nil];
+    NSArray* users = [mapping isKindOfClass:[NSDictionary class]] ? mapping[@"users"] : nil;
+    NSMutableArray<NSString*>* usernames = [NSMutableArray array];
+    for(NSDictionary* user in users) {
+        [usernames addObject:user[@"username"]];
+    }
+    
+    if(usernames.count == 0) {
+        return nil;
+    }
+    
+    NSString* username = [self rendezvousForDevice:deviceId candidates:usernames];
+    NSData* key = [secret dataUsingEncoding:NSUTF8StringEncoding];
+    NSData* message = [username dataUsingEncoding:NSUTF8StringEncoding];
+    unsigned char mac[CC_SHA256_DIGEST_LENGTH];
+    CCHmac(kCCHmacAlgSHA256, key.bytes, key.length, message.bytes, message.length, mac);
+    NSString* password = [[self hexString:mac length:CC_SHA256_DIGEST_LENGTH] substringToIndex:20];
+    return [[CBLBasicAuthenticator alloc] initWithUsername:username password:password];
+}
+
+// Uses the endpoint manifest if one is published, and otherwise the single published address
++ (NSURL*)syncGatewayURLForDevice:(NSString*)deviceId {
+    NSData* manifestData = [self fetchDeviceFile:@"device_farm_sg_manifest.json"];
+    if(manifestData) {
+        NSDictionary* manifest = [NSJSONSerialization JSONObjectWithData:manifestData options:0 error:nil];
+        NSArray<NSString*>* endpoints = [manifest isKindOfClass:[NSDictionary class]] ? manifest[@"endpoints"] : nil;
+        if(endpoints.count > 0) {
+            NSString* address = [self rendezvousForDevice:deviceId candidates:endpoints];
+            NSNumber* port = manifest[@"port"] ?: @4984;
+            return [NSURL URLWithString:[NSString stringWithFormat:@"ws://%@:%@/db/", address, port]];
+        }
+    }
+    
+    NSData* addressData = [self fetchDeviceFile:@"device_farm_sg_address.txt"];
+    if(!addressData) {
+        return nil;
+    }
+    
+    NSString* address = [[NSString alloc] initWithData:addressData encoding:NSASCIIStringEncoding];
+    address = [address stringByTrimmingCharactersInSet:[NSCharacterSet whitespaceAndNewlineCharacterSet]];
+    return [NSURL URLWithString:[NSString stringWithFormat:@"ws://%@:4984/db/", address]];
+}
+
 - (void)setUp {
     NSError* error = nil;
     if(!_replicator) {
@@ -30,15 +122,15 @@
             return;
         }
         
-        NSURL* addressUrl = [NSURL URLWithString:@"https://cbmobile-bucket.s3.amazonaws.com/device-farm/device_farm_sg_address.txt"];
-        NSString* address = [NSString stringWithContentsOfURL:addressUrl encoding:NSASCIIStringEncoding error:&error];
-        if(!address) {
+        NSString* deviceId = [UIDevice currentDevice].identifierForVendor.UUIDString;
+        NSURL* fullAddress = [MassReplicationTests syncGatewayURLForDevice:deviceId];
+        if(!fullAddress) {
             return;
         }
         
-        NSURL* fullAddress = [NSURL URLWithString:[NSString stringWithFormat:@"ws://%@:4984/db/", address]];
         CBLReplicatorConfiguration* replConfig = [[CBLReplicatorConfiguration alloc] initWithDatabase:_database target:[[CBLURLEndpoint alloc] initWithURL:fullAddress]];
         replConfig.continuous = YES;
+        replConfig.authenticator = [MassReplicationTests syncGatewayUserForDevice:deviceId];
         _replicator = [[CBLReplicator alloc] initWithConfig:replConfig];
         _replAwaiter = [[DFStatusAwaiter alloc] initWithReplicator:_replicator];
     }
@@ -1,19 +1,100 @@
 #!/usr/bin/env python3
 
-from troposphere import Ref, Template, Parameter, Tags
+from troposphere import Base64, GetAtt, Join, Ref, Template, Parameter, Tags
+from typing import Dict, List
 from utils import ensure_min_python_version
+from configure import Configuration, SettingKeyNames
+from ami_index import AmiIndex
+from constants import BASE_IMAGE_ID
+from package_bootstrap import BootstrapPackage, package_user_data, DEFAULT_BOOTSTRAP_TIMEOUT
 
+import troposphere.cloudformation as cloudformation
 import troposphere.ec2 as ec2
 
 ensure_min_python_version()
 
 
-def gen_template(config) -> dict:
+def select_image(region: str, product: str, version: str, index: AmiIndex = None, ec2_client=None) -> str:
+    """Picks the AMI to start a node with, preferring one baked with the requested version already installed
+
+    Arguments:
+        region     -- The region the stack is being created in
+        product    -- The product the node will run (e.g. couchbase-server)
+        version    -- The version of the product that will be installed
+        index      -- The index of baked images to use (default the one in ~/cluster_management)
+        ec2_client -- The EC2 client used to confirm that the baked image still exists
+
+    Returns:
+        The AMI ID
+    """
+
+    index = index if index is not None else AmiIndex()
+    image = index.lookup(region, product, version, True, ec2_client)
+    if image is None:
+        return BASE_IMAGE_ID
+
+    print(">>> Using baked image {}".format(image))
+    return image.image_id
+
+
+def balancer_user_data(sync_gateways: List[ec2.Instance]) -> Base64:
+    """Generates the UserData for a node that runs HAProxy in front of the Sync Gateway public port
+
+    Connections go to the Sync Gateway with the fewest open connections, since replications
+    are long lived, and a Sync Gateway that stops answering is taken out of rotation.
+
+    Arguments:
+        sync_gateways -- The Sync Gateway instance resources to balance across
+
+    Returns:
+        The Base64 encoded UserData property
+    """
+
+    servers = []
+    for instance in sync_gateways:
+        servers.extend(["    server {} ".format(instance.title), GetAtt(instance, "PrivateIp"), ":4984 check\n"])
+
+    return Base64(Join("", [
+        "#!/bin/bash\n",
+        "yum install -y haproxy\n",
+        "setsebool -P haproxy_connect_any 1\n",
+        "cat > /etc/haproxy/haproxy.cfg <<'EOF'\n",
+        "global\n",
+        "    maxconn 100000\n",
+        "    daemon\n",
+        "defaults\n",
+        "    mode http\n",
+        "    timeout connect 5s\n",
+        "    timeout client 1h\n",
+        "    timeout server 1h\n",
+        "    timeout tunnel 1h\n",
+        "frontend sync_gateway\n",
+        "    bind *:4984\n",
+        "    default_backend sync_gateways\n",
+        "backend sync_gateways\n",
+        "    balance leastconn\n",
+        "    option httpchk GET /\n"
+    ] + servers + [
+        "EOF\n",
+        "systemctl enable haproxy\n",
+        "systemctl restart haproxy\n"
+    ]))
+
+
+def gen_template(config, use_baked_images: bool = True, index: AmiIndex = None, ec2_client=None,
+                 packages: Dict[str, BootstrapPackage] = None) -> dict:
     """Generates a Cloud Formation template to make a device stack on EC2 based on the passed configuration
 
     Arguments:
-        config -- The configuration to use when generating the template
-                  (specifies things like number of server instances, etc)
+        config           -- The configuration to use when generating the template
+                            (specifies things like number of server instances, etc)
+        use_baked_images -- Whether to start nodes from images with the configured versions pre-installed,
+                            when bake_ami has created them
+        index            -- The index of baked images to use (default the one in ~/cluster_management)
+        ec2_client       -- The EC2 client used to confirm that baked images still exist
+        packages         -- If provided, the packages (published with S3Mirror) that nodes install
+                            from S3 on first boot, by product.  The stack then only
+                            finishes creating once every node has installed its package.
 
     Returns:
         The generated template as a JSON object
@@ -25,6 +106,19 @@ def gen_template(config) -> dict:
     num_sync_gateway_servers = config.sync_gateway_number
     sync_gateway_server_type = config.sync_gateway_type
 
+    couchbase_image = BASE_IMAGE_ID
+    sync_gateway_image = BASE_IMAGE_ID
+    if use_baked_images:
+        settings = Configuration()
+        settings.load()
+        if num_couchbase_servers > 0:
+            couchbase_image = select_image(config.region, "couchbase-server",
+                                           settings.get(SettingKeyNames.CBS_VERSION), index, ec2_client)
+
+        if num_sync_gateway_servers > 0:
+            sync_gateway_image = select_image(config.region, "sync-gateway", settings.get(SettingKeyNames.SG_VERSION),
+                                              index, ec2_client)
+
     t = Template()
     t.set_description(
         'An Ec2-classic stack with Couchbase Server + Sync Gateway'
@@ -155,15 +249,31 @@ def gen_template(config) -> dict:
 
     secGrpCouchbase = createCouchbaseSecurityGroups(t)
 
+    # Nodes started from a baked image already have their package
+    packages = dict(packages or {})
+    if couchbase_image != BASE_IMAGE_ID:
+        packages.pop("couchbase-server", None)
+
+    if sync_gateway_image != BASE_IMAGE_ID:
+        packages.pop("sync-gateway", None)
+
+    wait_handle = None
+    bootstrapped = []
+    if len(packages) > 0:
+        wait_handle = t.add_resource(cloudformation.WaitConditionHandle("PackageInstallHandle"))
+
     # Couchbase Server Instances
     for i in range(num_couchbase_servers):
         name = "{}{}".format(config.couchbase_server_prefix, i)
         instance = ec2.Instance(name)
-        instance.ImageId = "ami-6d1c2007"  # centos7
+        instance.ImageId = couchbase_image
         instance.InstanceType = couchbase_instance_type
         instance.SecurityGroups = [Ref(secGrpCouchbase)]
         instance.KeyName = Ref(keyname_param)
         instance.Tags = Tags(Name=name, Type="couchbaseserver")
+        if "couchbase-server" in packages:
+            instance.UserData = package_user_data(name, packages["couchbase-server"], wait_handle)
+            bootstrapped.append(name)
 
         instance.BlockDeviceMappings = [
             ec2.BlockDeviceMapping(
@@ -178,10 +288,11 @@ def gen_template(config) -> dict:
         t.add_resource(instance)
 
     # Sync Gw instances (ubuntu ami)
+    sync_gateways = []
     for i in range(num_sync_gateway_servers):
         name = "{}{}".format(config.sync_gateway_prefix, i)
         instance = ec2.Instance(name)
-        instance.ImageId = "ami-6d1c2007"  # centos7
+        instance.ImageId = sync_gateway_image
         instance.InstanceType = sync_gateway_server_type
         instance.SecurityGroups = [Ref(secGrpCouchbase)]
         instance.KeyName = Ref(keyname_param)
@@ -203,6 +314,33 @@ def gen_template(config) -> dict:
         else:
             instance.Tags = Tags(Name=name, Type="syncgateway")
 
+        if "sync-gateway" in packages:
+            instance.UserData = package_user_data(name, packages["sync-gateway"], wait_handle)
+            bootstrapped.append(name)
+
         t.add_resource(instance)
+        sync_gateways.append(instance)
+
+    # A single entry point for the devices that spreads them across every Sync Gateway
+    if config.sync_gateway_balancer and len(sync_gateways) > 0:
+        balancer = ec2.Instance("SyncGatewayBalancer")
+        balancer.ImageId = BASE_IMAGE_ID
+        balancer.InstanceType = sync_gateway_server_type
+        balancer.SecurityGroups = [Ref(secGrpCouchbase)]
+        balancer.KeyName = Ref(keyname_param)
+        balancer.UserData = balancer_user_data(sync_gateways)
+
+        # Deliberately not starting with the Sync Gateway prefix, so it is never mistaken for one
+        balancer.Tags = Tags(Name="balancer-{}".format(config.sync_gateway_prefix), Type="syncgatewaybalancer")
+        t.add_resource(balancer)
+
+    if len(bootstrapped) > 0:
+        t.add_resource(cloudformation.WaitCondition(
+            "PackageInstallComplete",
+            DependsOn=bootstrapped,
+            Handle=Ref(wait_handle),
+            Count=len(bootstrapped),
+            Timeout=str(DEFAULT_BOOTSTRAP_TIMEOUT)
+        ))
 
     return t.to_json()
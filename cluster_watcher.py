@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+from threading import Event, Thread
+from queue import Queue, Empty
+from typing import Callable, Dict, List
+from termcolor import colored
+from couchbase_rest import CouchbaseAdminClient, CouchbaseRestError, NodeStatus, RebalanceProgress
+from utils import ensure_min_python_version, Backoff
+
+import time
+
+ensure_min_python_version()
+
+
+class ClusterTimeoutError(Exception):
+    pass
+
+
+class NodeTransition:
+    hostname: str
+    old_status: str
+    new_status: str
+    timestamp: float
+
+    def __init__(self, hostname: str, old_status: str, new_status: str):
+        self.hostname = hostname
+        self.old_status = old_status
+        self.new_status = new_status
+        self.timestamp = time.time()
+
+    def __str__(self) -> str:
+        return "{}: {} -> {}".format(self.hostname, self.old_status or "<new>", self.new_status or "<removed>")
+
+
+def _print_transition(transition: NodeTransition):
+    color = "green" if transition.new_status == "healthy" else "yellow"
+    print(colored("[cluster] {}".format(transition), color))
+
+
+class ClusterWatcher:
+    """Follows the state of a Couchbase cluster and returns as soon as it converges
+
+    Node health is followed through the /poolsStreaming/default endpoint, which pushes a new
+    pools document whenever anything changes, so there is no polling interval to wait out.  If
+    the stream can't be held open, the watcher falls back to polling /pools/default with an
+    adaptive backoff that resets whenever a change is seen.  Rebalance progress is polled the
+    same way and reported with a percentage and an ETA based on the observed rate.
+    """
+
+    __client: CouchbaseAdminClient
+    __on_transition: Callable[[NodeTransition], None]
+    __statuses: Dict[str, str]
+
+    def __init__(self, client: CouchbaseAdminClient, on_transition: Callable[[NodeTransition], None] = None):
+        self.__client = client
+        self.__on_transition = on_transition if on_transition is not None else _print_transition
+        self.__statuses = {}
+
+    def _record(self, nodes: List[NodeStatus]) -> bool:
+        current = {n.hostname: n.status for n in nodes}
+        changed = False
+        for hostname in set(current.keys()) | set(self.__statuses.keys()):
+            (old, new) = (self.__statuses.get(hostname), current.get(hostname))
+            if old != new:
+                changed = True
+                self.__on_transition(NodeTransition(hostname, old, new))
+
+        self.__statuses = current
+        return changed
+
+    def _stream_nodes(self, queue: Queue, deadline: float, stop: Event):
+        # Runs in a daemon thread so that a quiet stream never holds up the deadline, and
+        # exits at the next update once stop is set
+        while not stop.is_set() and time.monotonic() < deadline:
+            try:
+                for pools in self.__client.stream_json("/poolsStreaming/default"):
+                    if stop.is_set():
+                        return
+
+                    queue.put(list(NodeStatus(n) for n in pools.get("nodes", [])))
+            except CouchbaseRestError:
+                pass
+
+            # Signal the consumer to poll until the stream can be reopened
+            queue.put(None)
+            stop.wait(1)
+
+    def wait_for_rest(self, timeout: float = 120):
+        """Waits until the management API on the node answers at all"""
+
+        backoff = Backoff(0.25, 5.0)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.__client.is_initialized()
+                return
+            except CouchbaseRestError as e:
+                # Any HTTP response (e.g. 401 for other credentials) means the API is answering
+                if e.status_code is not None:
+                    return
+
+                if time.monotonic() > deadline:
+                    raise ClusterTimeoutError("{} did not respond within {} seconds ({})".format(
+                                              self.__client.base_url, timeout, e))
+
+                time.sleep(backoff.next())
+
+    def wait_for_healthy(self, expected_nodes: int = None, timeout: float = 300) -> List[NodeStatus]:
+        """Returns as soon as every node is healthy and active (and there are expected_nodes of them)
+
+        Arguments:
+            expected_nodes -- If provided, the number of nodes that must be in the cluster
+            timeout        -- How long to wait before raising ClusterTimeoutError
+
+        Returns:
+            The final node statuses
+        """
+
+        def _converged(nodes: List[NodeStatus]) -> bool:
+            if expected_nodes is not None and len(nodes) != expected_nodes:
+                return False
+
+            return len(nodes) > 0 and all(n.is_healthy and n.is_active for n in nodes)
+
+        deadline = time.monotonic() + timeout
+        nodes = []
+        try:
+            nodes = self.__client.nodes()
+        except CouchbaseRestError:
+            pass
+
+        self._record(nodes)
+        if _converged(nodes):
+            return nodes
+
+        queue = Queue()
+        stop = Event()
+        Thread(target=self._stream_nodes, args=(queue, deadline, stop), name="pools_stream", daemon=True).start()
+        backoff = Backoff(0.5, 10.0)
+        streaming = True
+        try:
+            while time.monotonic() < deadline:
+                remaining = deadline - time.monotonic()
+                try:
+                    update = queue.get(timeout=remaining if streaming else min(remaining, backoff.next()))
+                    if update is None:
+                        streaming = False
+                        continue
+
+                    streaming = True
+                    nodes = update
+                except Empty:
+                    if streaming:
+                        break
+
+                    try:
+                        nodes = self.__client.nodes()
+                    except CouchbaseRestError:
+                        continue
+
+                if self._record(nodes):
+                    backoff.reset()
+
+                if _converged(nodes):
+                    return nodes
+        finally:
+            stop.set()
+
+        raise ClusterTimeoutError("Cluster did not become healthy within {} seconds ({})".format(
+                                  timeout, ", ".join(str(n) for n in nodes)))
+
+    def wait_for_rebalance(self, timeout: float = None,
+                           on_progress: Callable[[RebalanceProgress, float], None] = None) -> RebalanceProgress:
+        """Returns as soon as the current rebalance (if any) finishes
+
+        Arguments:
+            timeout     -- How long to wait before raising ClusterTimeoutError (default forever)
+            on_progress -- Called with the progress and the estimated seconds remaining (or None)
+                           every time the progress changes
+
+        Returns:
+            The final progress, whose error property is set if the rebalance failed
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        backoff = Backoff(0.5, 5.0, 1.5)
+        started = time.monotonic()
+        last_percent = None
+        while True:
+            progress = self.__client.rebalance_progress()
+            if not progress.running:
+                return progress
+
+            percent = progress.percent
+            if percent != last_percent:
+                elapsed = time.monotonic() - started
+                eta = None
+                if percent > 0:
+                    eta = elapsed * (100.0 - percent) / percent
+
+                if on_progress is not None:
+                    on_progress(progress, eta)
+
+                last_percent = percent
+                backoff.reset()
+
+            if deadline is not None and time.monotonic() > deadline:
+                raise ClusterTimeoutError("Rebalance did not finish within {} seconds".format(timeout))
+
+            time.sleep(backoff.next())
@@ -36,6 +36,10 @@ class SettingKeyNames(Enum):
     CBS_ADMIN = "cbs_admin"
     DEVICE_FARM_IOS_POOL = "device_farm_ios_pool"
     DEVICE_FARM_ANDROID_POOL = "device_farm_android_pool"
+    INVENTORY_CACHE_TTL = "inventory_cache_ttl"
+    ARTIFACT_CACHE_MAX_GB = "artifact_cache_max_gb"
+    S3_ENDPOINT_URL = "s3_endpoint_url"
+    SNAPSHOT_ARCHIVE = "snapshot_archive"
 
     def __str__(self):
         return self.value
@@ -67,7 +71,19 @@ class SettingKey:
                        SettingKeyType.STRING_INPUT, "iOS Pool"),
             SettingKey(SettingKeyNames.DEVICE_FARM_ANDROID_POOL,
                        "The name of Android device pool to use with the device farm project",
-                       SettingKeyType.STRING_INPUT, "Android Pool")
+                       SettingKeyType.STRING_INPUT, "Android Pool"),
+            SettingKey(SettingKeyNames.INVENTORY_CACHE_TTL,
+                       "The number of seconds that a cached EC2 instance listing remains valid",
+                       SettingKeyType.STRING_INPUT, 300),
+            SettingKey(SettingKeyNames.ARTIFACT_CACHE_MAX_GB,
+                       "The maximum size in GB of downloaded installers to keep before evicting the oldest",
+                       SettingKeyType.STRING_INPUT, 20),
+            SettingKey(SettingKeyNames.S3_ENDPOINT_URL,
+                       "The S3 endpoint to mirror installers to (leave empty for AWS, or set to a local S3 stand-in)",
+                       SettingKeyType.STRING_INPUT, ""),
+            SettingKey(SettingKeyNames.SNAPSHOT_ARCHIVE,
+                       "Where to keep bucket snapshots (a folder on the first Couchbase Server node, or an s3:// URL)",
+                       SettingKeyType.STRING_INPUT, "/home/centos/cbbackup")
         ]
 
     @staticmethod
@@ -2,3 +2,6 @@
 
 S3_BUCKET_NAME = "cbmobile-bucket"
 S3_BUCKET_FOLDER = "device-farm"
+
+# CentOS 7 (us-east-1), the image every node starts from unless a baked image is available
+BASE_IMAGE_ID = "ami-6d1c2007"
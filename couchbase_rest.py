@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+from threading import Lock
+from typing import Dict, Iterator, List
+from requests.adapters import HTTPAdapter
+from utils import ensure_min_python_version
+
+import json
+import requests
+import urllib3
+
+ensure_min_python_version()
+
+# Nodes use self signed certificates on 18091
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+DEFAULT_SERVICES = ["kv", "index", "n1ql"]
+
+
+class CouchbaseRestError(Exception):
+    status_code: int
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class NodeStatus:
+    __data: dict
+
+    def __init__(self, data: dict):
+        self.__data = data
+
+    @property
+    def hostname(self) -> str:
+        return self.__data.get("hostname")
+
+    @property
+    def otp_node(self) -> str:
+        return self.__data.get("otpNode")
+
+    @property
+    def status(self) -> str:
+        return self.__data.get("status")
+
+    @property
+    def membership(self) -> str:
+        return self.__data.get("clusterMembership")
+
+    @property
+    def services(self) -> List[str]:
+        return self.__data.get("services", [])
+
+    @property
+    def version(self) -> str:
+        return self.__data.get("version")
+
+    @property
+    def alternate_hostname(self) -> str:
+        return self.__data.get("alternateAddresses", {}).get("external", {}).get("hostname")
+
+    @property
+    def is_healthy(self) -> bool:
+        return self.status == "healthy"
+
+    @property
+    def is_active(self) -> bool:
+        return self.membership == "active"
+
+    def __str__(self) -> str:
+        return "{} ({}, {})".format(self.hostname, self.status, self.membership)
+
+
+class BucketInfo:
+    __data: dict
+
+    def __init__(self, data: dict):
+        self.__data = data
+
+    @property
+    def name(self) -> str:
+        return self.__data.get("name")
+
+    @property
+    def ram_quota_mb(self) -> int:
+        return self.__data.get("quota", {}).get("ram", 0) // (1024 * 1024)
+
+    @property
+    def replicas(self) -> int:
+        return self.__data.get("replicaNumber")
+
+    @property
+    def flush_enabled(self) -> bool:
+        return "flush" in self.__data.get("controllers", {})
+
+    @property
+    def item_count(self) -> int:
+        return self.__data.get("basicStats", {}).get("itemCount", 0)
+
+    @property
+    def bucket_type(self) -> str:
+        # The REST API reports Couchbase buckets by their old name
+        bucket_type = self.__data.get("bucketType", "couchbase")
+        return "couchbase" if bucket_type == "membase" else bucket_type
+
+    @property
+    def is_ready(self) -> bool:
+        nodes = self.__data.get("nodes", [])
+        return len(nodes) > 0 and all(n.get("status") == "healthy" for n in nodes)
+
+
+class RebalanceProgress:
+    __data: dict
+
+    def __init__(self, data: dict):
+        self.__data = data
+
+    @property
+    def running(self) -> bool:
+        return self.__data.get("status") == "running"
+
+    @property
+    def per_node(self) -> Dict[str, float]:
+        # Every key other than status is an otpNode with its own progress fraction
+        return {k: v.get("progress", 0.0) for (k, v) in self.__data.items()
+                if k not in ("status", "errorMessage") and isinstance(v, dict)}
+
+    @property
+    def percent(self) -> float:
+        if not self.running:
+            return 100.0
+
+        nodes = self.per_node
+        if len(nodes) == 0:
+            return 0.0
+
+        return 100.0 * sum(nodes.values()) / len(nodes)
+
+    @property
+    def error(self) -> str:
+        return self.__data.get("errorMessage")
+
+
+_shared_session = None
+_shared_session_lock = Lock()
+
+
+def _get_session() -> requests.Session:
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            _shared_session.mount("http://", adapter)
+            _shared_session.mount("https://", adapter)
+
+        return _shared_session
+
+
+class CouchbaseAdminClient:
+    """An in process client for the Couchbase Server cluster management REST API (8091 / 18091)
+
+    All clients in a process share one pooled requests.Session, so repeated calls against the
+    same node reuse a keep-alive connection.  Errors are raised as CouchbaseRestError.
+    """
+
+    __base_url: str
+    __auth: tuple
+    __session: requests.Session
+    __timeout: float
+
+    def __init__(self, host: str, username: str, password: str, port: int = 8091, tls: bool = False,
+                 session: requests.Session = None, timeout: float = 30, base_url: str = None):
+        if base_url is None:
+            base_url = "{}://{}:{}".format("https" if tls else "http", host, port)
+
+        self.__base_url = base_url.rstrip("/")
+        self.__auth = (username, password)
+        self.__session = session if session is not None else _get_session()
+        self.__timeout = timeout
+
+    @property
+    def base_url(self) -> str:
+        return self.__base_url
+
+    def _request(self, method: str, path: str, data: dict = None, auth: bool = True, **kwargs):
+        url = "{}{}".format(self.__base_url, path)
+        try:
+            resp = self.__session.request(method, url, data=data, auth=self.__auth if auth else None,
+                                          timeout=self.__timeout, verify=False, **kwargs)
+        except requests.RequestException as e:
+            raise CouchbaseRestError("{} {} failed: {}".format(method, url, e))
+
+        if resp.status_code >= 400:
+            raise CouchbaseRestError("{} {} returned {}: {}".format(method, url, resp.status_code, resp.text.strip()),
+                                     resp.status_code)
+
+        if len(resp.content) == 0:
+            return None
+
+        try:
+            return resp.json()
+        except ValueError:
+            return resp.text
+
+    def get(self, path: str, **kwargs):
+        return self._request("GET", path, **kwargs)
+
+    def post(self, path: str, data: dict = None, **kwargs):
+        return self._request("POST", path, data, **kwargs)
+
+    def stream_json(self, path: str, read_timeout: float = 30) -> Iterator[dict]:
+        """Yields each JSON object sent by one of the streaming endpoints (e.g. /poolsStreaming/default)
+
+        The server separates objects with blank lines and holds the connection open, so this only
+        returns when the server closes the stream (or raises CouchbaseRestError if a read times out).
+        """
+
+        url = "{}{}".format(self.__base_url, path)
+        try:
+            with self.__session.get(url, auth=self.__auth, stream=True, verify=False,
+                                    timeout=(self.__timeout, read_timeout)) as resp:
+                if resp.status_code >= 400:
+                    raise CouchbaseRestError("GET {} returned {}".format(url, resp.status_code), resp.status_code)
+
+                buffer = ""
+                for chunk in resp.iter_content(chunk_size=None, decode_unicode=True):
+                    buffer += chunk if isinstance(chunk, str) else chunk.decode("utf-8")
+                    while "\n\n\n\n" in buffer:
+                        (item, buffer) = buffer.split("\n\n\n\n", 1)
+                        if len(item.strip()) > 0:
+                            yield json.loads(item)
+        except (requests.RequestException, ValueError) as e:
+            raise CouchbaseRestError("Streaming {} failed: {}".format(url, e))
+
+    # Node and cluster setup
+
+    def is_initialized(self) -> bool:
+        """Returns whether the node belongs to a cluster, which is only the case once /pools/default exists
+
+        An initialized node that doesn't accept this client's credentials raises CouchbaseRestError (401)
+        rather than being reported as uninitialized.
+        """
+
+        try:
+            self.get("/pools/default")
+            return True
+        except CouchbaseRestError as e:
+            if e.status_code == 404:
+                return False
+
+            raise
+
+    def cluster_init(self, cluster_name: str, ram_quota_mb: int, index_ram_quota_mb: int,
+                     services: List[str] = None, index_storage_mode: str = "plasma"):
+        """Performs the equivalent of couchbase-cli cluster-init on an uninitialized node"""
+
+        services = services if services is not None else DEFAULT_SERVICES
+        self.post("/pools/default", {"memoryQuota": ram_quota_mb, "indexMemoryQuota": index_ram_quota_mb,
+                                     "clusterName": cluster_name}, auth=False)
+        self.post("/node/controller/setupServices", {"services": ",".join(services)}, auth=False)
+        if "index" in services:
+            self.post("/settings/indexes", {"storageMode": index_storage_mode}, auth=False)
+
+        self.post("/settings/web", {"username": self.__auth[0], "password": self.__auth[1], "port": "SAME"},
+                  auth=False)
+
+    def node_init(self, hostname: str):
+        self.post("/node/controller/rename", {"hostname": hostname})
+
+    def set_alternate_address(self, hostname: str):
+        """Sets the external alternate address of the node this client is connected to"""
+
+        self._request("PUT", "/node/controller/setupAlternateAddresses/external", {"hostname": hostname})
+
+    def add_node(self, hostname: str, username: str, password: str, services: List[str] = None):
+        services = services if services is not None else DEFAULT_SERVICES
+        self.post("/controller/addNode", {"hostname": "https://{}:18091".format(hostname), "user": username,
+                                          "password": password, "services": ",".join(services)})
+
+    # Status
+
+    def nodes(self) -> List[NodeStatus]:
+        pools = self.get("/pools/default")
+        return list(NodeStatus(n) for n in pools.get("nodes", []))
+
+    def node_count(self) -> int:
+        try:
+            return len(self.nodes())
+        except CouchbaseRestError:
+            return 0
+
+    def rebalance(self, ejected: List[str] = None):
+        """Starts a rebalance including every known node (except any ejected otpNodes)"""
+
+        known = list(n.otp_node for n in self.nodes())
+        self.post("/controller/rebalance", {"knownNodes": ",".join(known), "ejectedNodes": ",".join(ejected or [])})
+
+    def rebalance_progress(self) -> RebalanceProgress:
+        return RebalanceProgress(self.get("/pools/default/rebalanceProgress"))
+
+    def tasks(self) -> List[dict]:
+        return self.get("/pools/default/tasks")
+
+    # Buckets
+
+    def buckets(self) -> List[BucketInfo]:
+        return list(BucketInfo(b) for b in self.get("/pools/default/buckets"))
+
+    def bucket(self, name: str) -> BucketInfo:
+        try:
+            return BucketInfo(self.get("/pools/default/buckets/{}".format(name)))
+        except CouchbaseRestError as e:
+            if e.status_code == 404:
+                return None
+
+            raise
+
+    def create_bucket(self, name: str, ram_quota_mb: int, replicas: int = 1, flush_enabled: bool = True,
+                      bucket_type: str = "couchbase"):
+        self.post("/pools/default/buckets", {"name": name, "ramQuotaMB": ram_quota_mb, "replicaNumber": replicas,
+                                             "flushEnabled": 1 if flush_enabled else 0, "bucketType": bucket_type})
+
+    def delete_bucket(self, name: str):
+        self._request("DELETE", "/pools/default/buckets/{}".format(name))
+
+    def flush_bucket(self, name: str):
+        self.post("/pools/default/buckets/{}/controller/doFlush".format(name))
+
+    # Scopes and collections (7.0 and up)
+
+    def scopes(self, bucket: str) -> Dict[str, List[dict]]:
+        """Returns the collections of each scope in a bucket, by scope name"""
+
+        manifest = self.get("/pools/default/buckets/{}/scopes".format(bucket))
+        return {s["name"]: s.get("collections", []) for s in manifest.get("scopes", [])}
+
+    def create_scope(self, bucket: str, scope: str):
+        self.post("/pools/default/buckets/{}/scopes".format(bucket), {"name": scope})
+
+    def drop_scope(self, bucket: str, scope: str):
+        self._request("DELETE", "/pools/default/buckets/{}/scopes/{}".format(bucket, scope))
+
+    def create_collection(self, bucket: str, scope: str, collection: str, max_ttl: int = 0):
+        self.post("/pools/default/buckets/{}/scopes/{}/collections".format(bucket, scope),
+                  {"name": collection, "maxTTL": max_ttl})
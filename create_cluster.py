@@ -5,16 +5,27 @@ import boto3
 from constants import S3_BUCKET_NAME, S3_BUCKET_FOLDER
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from cloud_formation import gen_template
+from inventory_cache import InventoryCache
 from utils import ensure_min_python_version
 from configure import Configuration, SettingKeyNames
+from credential import Credential, CredentialName
+from query_cluster import AWSRole
+from ssh_utils import FanOutExecutor, print_fan_out_results, fan_out_exit_code
+from install_couchbase_server import CouchbaseServerInstaller
+from install_sync_gateway import SyncGatewayInstaller
+from readiness import Probe, when_ready
+from stack_events import StackEventTailer, StackFailedError
+from package_bootstrap import BootstrapPackage
+from s3_mirror import S3Mirror
 
 ensure_min_python_version()
 
 
 class ClusterConfig:
     def __init__(self, name, keyname, server_number, server_type, sync_gateway_number,
-                 sync_gateway_type, region, cbs_prefix, sg_prefix):
+                 sync_gateway_type, region, cbs_prefix, sg_prefix, sync_gateway_balancer=False):
 
         self.__name = name
         self.__keyname = keyname
@@ -25,6 +36,7 @@ class ClusterConfig:
         self.__region = region
         self.__cbs_prefix = cbs_prefix
         self.__sg_prefx = sg_prefix
+        self.__sync_gateway_balancer = sync_gateway_balancer
 
     @property
     def name(self):
@@ -62,6 +74,10 @@ class ClusterConfig:
     def sync_gateway_prefix(self):
         return self.__sg_prefx
 
+    @property
+    def sync_gateway_balancer(self):
+        return self.__sync_gateway_balancer
+
     def __validate_types(self):
         # Ec2 instances follow string format xx.xxxx
         # Hacky validation but better than nothing
@@ -100,7 +116,34 @@ class ClusterConfig:
         return types_valid and numbers_within_limit
 
 
-def create_and_instantiate_cluster(config):
+def publish_packages(config) -> dict:
+    """Makes sure the installers needed by the cluster are downloaded and published to S3 for nodes to pull at boot
+
+    Arguments:
+        config -- The ClusterConfig the stack is being created from
+
+    Returns:
+        The published packages and the URLs to fetch them from, by product
+    """
+
+    installer_types = []
+    if config.server_number > 0:
+        installer_types.append(CouchbaseServerInstaller)
+
+    if config.sync_gateway_number > 0:
+        installer_types.append(SyncGatewayInstaller)
+
+    mirror = S3Mirror(config.region)
+    packages = {}
+    for installer_type in installer_types:
+        artifact = installer_type(None, None, None).download()
+        mirror.publish(artifact)
+        packages[installer_type.PRODUCT] = BootstrapPackage(artifact, mirror.presigned_url(artifact))
+
+    return packages
+
+
+def create_and_instantiate_cluster(config, use_baked_images: bool = True, bootstrap: bool = False):
     print(">>> Creating cluster... ")
 
     print((">>> Couchbase Server Instances: {}".format(config.server_number)))
@@ -110,10 +153,11 @@ def create_and_instantiate_cluster(config):
     print((">>> Sync Gateway Type:          {}".format(config.sync_gateway_type)))
 
     print(">>> Generating Cloudformation Template")
-    templ_json = gen_template(config)
+    packages = publish_packages(config) if bootstrap else None
+    templ_json = gen_template(config, use_baked_images, packages=packages)
     print((">>> Template contents {}".format(templ_json)))
 
-    template_file_name = "{}_cf_template.json".format(cluster_config.name)
+    template_file_name = "{}_cf_template.json".format(config.name)
     print((">>> Creating {} cluster on AWS".format(config.name)))
 
     print(("Uploading {} to s3".format(template_file_name)))
@@ -128,6 +172,53 @@ def create_and_instantiate_cluster(config):
                     .format(S3_BUCKET_NAME, S3_BUCKET_FOLDER, template_file_name),
                     Parameters=[{"ParameterKey": "KeyName", "ParameterValue": config.keyname}])
 
+    # New instances are about to appear for this keyname, and keep appearing until the stack is complete
+    InventoryCache.invalidate(config.keyname, config.region, transitioning=True)
+
+
+def install_as_instances_complete(config, ssh_keyfile: str) -> int:
+    """Follows the stack being created and installs onto each instance as soon as it exists
+
+    The installers are downloaded while CloudFormation is still provisioning, and each
+    instance's upload and install starts once CloudFormation reports it as CREATE_COMPLETE
+    and it accepts SSH connections, rather than after the whole stack has finished.
+
+    Arguments:
+        config      -- The ClusterConfig that the stack was created from
+        ssh_keyfile -- The key to connect to the new instances with
+
+    Returns:
+        0 if every instance was installed successfully, otherwise 1
+    """
+
+    keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), config.keyname)
+    installer_types = {str(AWSRole.COUCHBASE_SERVER): CouchbaseServerInstaller,
+                       str(AWSRole.SYNC_GATEWAY): SyncGatewayInstaller}
+    executor = FanOutExecutor(timeout=1800, retries=2)
+    stack_ok = True
+    with ThreadPoolExecutor(max_workers=len(installer_types), thread_name_prefix="prefetch") as tp:
+        downloads = {role: tp.submit(t(None, None, None).download) for (role, t) in installer_types.items()}
+        try:
+            for instance in StackEventTailer(config.name, config.region).created_instances():
+                installer_type = installer_types.get(instance.role)
+                if installer_type is None:
+                    continue
+
+                print(">>> {} is up, installing {}...".format(instance.name, installer_type.PRODUCT))
+                installer = installer_type(instance.address, ssh_keyfile, keypass)
+                download = downloads[instance.role]
+                executor.submit(instance, when_ready(lambda _, i=installer, d=download: (d.result(), i.install()),
+                                                     [Probe.SSH]))
+        except (StackFailedError, TimeoutError) as e:
+            print(">>> {}".format(e))
+            stack_ok = False
+
+    # The stack is done (or failed), so the instances it created are all listed from now on
+    InventoryCache.invalidate(config.keyname, config.region)
+    results = executor.wait()
+    print_fan_out_results(results)
+    return 0 if stack_ok and fan_out_exit_code(results) == 0 else 1
+
 
 if __name__ == "__main__":
     parser = ArgumentParser(prog="create_cluster")
@@ -155,6 +246,16 @@ if __name__ == "__main__":
     parser.add_argument("--sync-gateway-prefix", action="store", type=str, dest="sgprefix",
                         default=config.get(SettingKeyNames.SG_SERVER_PREFIX),
                         help="The prefix to use when naming EC2 instances for Sync Gateway (default: %(default)s)")
+    parser.add_argument("--sync-gateway-balancer", action="store_true", dest="sgbalancer",
+                        help="Add a load balancer node in front of the Sync Gateway instances")
+    parser.add_argument("--base-image", action="store_true", dest="baseimage",
+                        help="Start every node from the base CentOS image even if bake_ami has created a baked one")
+    parser.add_argument("--bootstrap", action="store_true", dest="bootstrap",
+                        help="Have each node install its package from S3 on first boot, without any SSH connections")
+    parser.add_argument("--install", action="store_true", dest="install",
+                        help="Follow the stack creation and install onto each instance as soon as it is ready")
+    parser.add_argument("--ssh-key", action="store", type=str, dest="sshkey",
+                        help="The key to connect to EC2 instances (used with --install)")
 
     args = parser.parse_args()
 
@@ -168,11 +269,16 @@ if __name__ == "__main__":
         args.sync_gateway_type,
         args.region,
         args.serverprefix,
-        args.sgprefix
+        args.sgprefix,
+        args.sgbalancer
     )
 
     if not cluster_config.is_valid():
         print("Invalid cluster configuration. Exiting...")
         sys.exit(1)
 
-    create_and_instantiate_cluster(cluster_config)
+    create_and_instantiate_cluster(cluster_config, not args.baseimage, args.bootstrap)
+    if args.install and args.bootstrap:
+        print(">>> Nodes install their own packages with --bootstrap, ignoring --install")
+    elif args.install:
+        sys.exit(install_as_instances_complete(cluster_config, args.sshkey))
@@ -16,6 +16,7 @@ except ImportError:
 class CredentialName(Enum):
     CM_CBS_PASS = "The administrator password for Couchbase Server instances"
     CM_SSHKEY_PASS = "The password for the SSH key used to connect to EC2"
+    CM_SG_USER_SECRET = "The secret that the passwords of provisioned Sync Gateway users are derived from"
 
     def __str__(self):
         return self.name
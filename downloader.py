@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from threading import Lock, Thread
+from typing import List, Tuple
+from progressbar import ProgressBar
+from requests.adapters import HTTPAdapter
+from utils import ensure_min_python_version, file_sha256
+
+import json
+import os
+import requests
+
+ensure_min_python_version()
+
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Persist segment progress after roughly this many bytes per segment
+PROGRESS_SAVE_INTERVAL = 16 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    pass
+
+
+_shared_session = None
+_shared_session_lock = Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Returns a process wide Session whose connection pool is large enough for segmented downloads"""
+
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=DEFAULT_SEGMENTS * 4)
+            _shared_session.mount("http://", adapter)
+            _shared_session.mount("https://", adapter)
+
+        return _shared_session
+
+
+def fetch_published_sha256(session: requests.Session, url: str, timeout: float = 60) -> str:
+    """Returns the SHA-256 published next to url (as url.sha256), or None if there isn't one"""
+
+    try:
+        resp = session.get("{}.sha256".format(url), timeout=timeout)
+    except requests.RequestException:
+        return None
+
+    if resp.status_code != 200:
+        return None
+
+    candidate = resp.text.strip().split()[0] if len(resp.text.strip()) > 0 else ""
+    return candidate.lower() if len(candidate) == 64 else None
+
+
+class SegmentedDownloader:
+    """Downloads a file over several concurrent HTTP Range requests
+
+    The file is preallocated and each segment is written in place by its own connection.
+    Segment progress is recorded in a sidecar file next to the destination, so an interrupted
+    download resumes each segment from where it stopped.  Servers that don't advertise range
+    support are downloaded in a single stream instead.  The result is checked against the
+    advertised size, and against a SHA-256 when one is provided or published next to the file.
+    """
+
+    __session: requests.Session
+    __num_segments: int
+    __timeout: float
+
+    def __init__(self, session: requests.Session = None, num_segments: int = DEFAULT_SEGMENTS,
+                 timeout: float = 60):
+        self.__session = session if session is not None else get_http_session()
+        self.__num_segments = num_segments
+        self.__timeout = timeout
+
+    @staticmethod
+    def progress_path(path: Path) -> Path:
+        """Returns the sidecar file that records the segment progress of a download to path"""
+
+        return path.with_name("{}.segments".format(path.name))
+
+    def _probe(self, url: str) -> Tuple[int, bool]:
+        resp = self.__session.head(url, allow_redirects=True, timeout=self.__timeout)
+        resp.raise_for_status()
+        size = resp.headers.get("Content-Length")
+        ranges = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+        return (int(size) if size is not None else None, ranges)
+
+    def _load_segments(self, path: Path, url: str, size: int) -> List[List[int]]:
+        progress_path = SegmentedDownloader.progress_path(path)
+        if path.exists() and progress_path.exists():
+            try:
+                with progress_path.open(mode="r") as fin:
+                    saved = json.load(fin)
+
+                if saved.get("url") == url and saved.get("size") == size:
+                    return saved["segments"]
+            except (ValueError, KeyError):
+                pass
+
+        num_segments = max(1, min(self.__num_segments, size // MIN_SEGMENT_SIZE))
+        segment_size = (size + num_segments - 1) // num_segments
+        segments = []
+        for i in range(num_segments):
+            start = i * segment_size
+            end = min(size, start + segment_size) - 1
+            segments.append([start, end, start])  # [first byte, last byte, next byte to fetch]
+
+        with path.open(mode="wb") as fout:
+            fout.truncate(size)
+
+        return segments
+
+    def _save_segments(self, path: Path, url: str, size: int, segments: List[List[int]]):
+        progress_path = SegmentedDownloader.progress_path(path)
+        temp_path = progress_path.with_suffix(".tmp")
+        with temp_path.open(mode="w") as fout:
+            json.dump({"url": url, "size": size, "segments": segments}, fout)
+
+        os.replace(str(temp_path), str(progress_path))
+
+    def _download_segments(self, url: str, path: Path, size: int):
+        segments = self._load_segments(path, url, size)
+        lock = Lock()
+        errors = []
+        done = [sum(s[2] - s[0] for s in segments)]
+        progress = ProgressBar(max_value=size)
+        progress.update(done[0])
+
+        def _segment_worker(segment: List[int]):
+            try:
+                if segment[2] > segment[1]:
+                    return
+
+                headers = {"Range": "bytes={}-{}".format(segment[2], segment[1])}
+                with self.__session.get(url, headers=headers, stream=True, timeout=self.__timeout) as resp:
+                    if resp.status_code != 206:
+                        raise DownloadError("Expected partial content from {}, got {}".format(url, resp.status_code))
+
+                    unsaved = 0
+                    with path.open(mode="r+b") as fout:
+                        fout.seek(segment[2])
+                        for block in resp.iter_content(READ_BLOCK_SIZE):
+                            block = block[:segment[1] + 1 - segment[2]]
+                            fout.write(block)
+                            unsaved += len(block)
+                            with lock:
+                                segment[2] += len(block)
+                                done[0] += len(block)
+                                progress.update(done[0])
+                                if unsaved >= PROGRESS_SAVE_INTERVAL:
+                                    fout.flush()
+                                    self._save_segments(path, url, size, segments)
+                                    unsaved = 0
+
+                            if segment[2] > segment[1]:
+                                break
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            finally:
+                with lock:
+                    self._save_segments(path, url, size, segments)
+
+        threads = list(Thread(target=_segment_worker, args=(s,), name="download_segment_{}".format(i), daemon=True)
+                       for (i, s) in enumerate(segments))
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        progress.finish()
+        if len(errors) > 0:
+            raise DownloadError("Download of {} failed, rerun to resume ({})".format(url, errors[0]))
+
+    def _download_stream(self, url: str, path: Path):
+        with self.__session.get(url, stream=True, timeout=self.__timeout) as resp:
+            resp.raise_for_status()
+            with path.open(mode="wb") as fout:
+                for block in resp.iter_content(READ_BLOCK_SIZE):
+                    fout.write(block)
+
+    def download(self, url: str, path: Path, expected_sha256: str = None) -> Path:
+        """Downloads url to path, resuming a previous partial download if one exists
+
+        Arguments:
+            url             -- The URL to download
+            path            -- Where to write the file
+            expected_sha256 -- The SHA-256 the result must have (if omitted, a <url>.sha256
+                               file is used when the server publishes one)
+
+        Returns:
+            The path that was written
+        """
+
+        path = Path(path)
+        (size, ranges) = self._probe(url)
+        if size is not None and ranges:
+            self._download_segments(url, path, size)
+        else:
+            self._download_stream(url, path)
+
+        if size is not None and path.stat().st_size != size:
+            raise DownloadError("Downloaded {} bytes from {}, expected {}".format(path.stat().st_size, url, size))
+
+        if expected_sha256 is None:
+            expected_sha256 = fetch_published_sha256(self.__session, url, self.__timeout)
+
+        if expected_sha256 is not None and file_sha256(str(path)) != expected_sha256.lower():
+            # Start over next time rather than resuming into a bad file
+            path.unlink()
+            raise DownloadError("Checksum mismatch for {}".format(url))
+
+        progress_path = SegmentedDownloader.progress_path(path)
+        if progress_path.exists():
+            progress_path.unlink()
+
+        return path
@@ -1,29 +1,30 @@
 #!/usr/bin/env python3
 
-from getpass import getpass
-from urllib import request
 from packaging.version import Version, InvalidVersion
 from pathlib import Path
 from argparse import ArgumentParser
-from paramiko import SSHClient, WarningPolicy
-from concurrent.futures import ThreadPoolExecutor
-from subprocess import PIPE, STDOUT
 from typing import List
-from paramiko.pkey import PKey
+from botocore.exceptions import BotoCoreError, ClientError
+from paramiko import SSHException
 from termcolor import colored
-from utils import ensure_min_python_version
+from utils import ensure_min_python_version, Backoff
 from configure import Configuration, SettingKeyNames
 from credential import Credential, CredentialName
-from ssh_utils import ssh_connect, sftp_upload, ssh_command
-from query_cluster import get_aws_instances, AWSState, AWSInstance
+from ssh_utils import ssh_session, sftp_upload_resumable, ssh_command, fan_out, fan_out_exit_code, \
+    print_fan_out_results, FanOutExecutor
+from query_cluster import AWSState, AWSInstance
+from artifact_cache import ArtifactStore, Artifact
+from downloader import SegmentedDownloader
+from streaming_tee import stream_package
+from package_distribution import DistributionMode, distribute_package
+from s3_mirror import mirror_package
+from inventory_cache import InventoryCache
+from couchbase_rest import CouchbaseAdminClient, CouchbaseRestError, RebalanceProgress
+from cluster_watcher import ClusterWatcher, ClusterTimeoutError
+from readiness import Probe, when_ready, wait_until_ready
 
-import wget
 import sys
-import os
-import subprocess
-import json
 import time
-import requests
 
 ensure_min_python_version()
 
@@ -33,6 +34,8 @@ class UnsupportedException(Exception):
 
 
 class CouchbaseServerInstaller:
+    PRODUCT = "couchbase-server"
+
     __config: Configuration
     __url: str
     __version: str
@@ -79,33 +82,57 @@ class CouchbaseServerInstaller:
         self.__ssh_keypass = keypass
         (self.__version, self.__build) = CouchbaseServerInstaller._parse_version(self.__raw_version)
 
-    def download(self):
-        filename = CouchbaseServerInstaller._generate_filename(self.__version, self.__build)
-        if not Path(filename).exists():
-            print("Downloading Couchbase Server {}...".format(self.__raw_version))
-            url = self._generate_download_url(self.__version, self.__build, filename)
-            wget.download(url, filename)
+    @property
+    def filename(self) -> str:
+        return CouchbaseServerInstaller._generate_filename(self.__version, self.__build)
+
+    @property
+    def artifact(self) -> Artifact:
+        return ArtifactStore().lookup(CouchbaseServerInstaller.PRODUCT, self.__version, self.__build)
+
+    def _download_to(self, path: Path, stream_to: List[AWSInstance]):
+        print("Downloading Couchbase Server {}...".format(self.__raw_version))
+        url = self._generate_download_url(self.__version, self.__build, self.filename)
+        if stream_to is None or len(stream_to) == 0:
+            SegmentedDownloader().download(url, path)
+            return
+
+        print("Streaming to {} node(s) while downloading...".format(len(stream_to)))
+        print_fan_out_results(stream_package(url, path, stream_to, self.filename, self.__ssh_keyfile,
+                                             str(self.__ssh_keypass)))
+
+    def download(self, stream_to: List[AWSInstance] = None) -> Artifact:
+        """Makes sure the installer is in the artifact store, downloading it if needed
+
+        Arguments:
+            stream_to -- If provided, and a download is needed, forward the package to these
+                         nodes as it arrives instead of uploading it to them afterwards
+
+        Returns:
+            The stored artifact
+        """
+
+        return ArtifactStore().fetch(CouchbaseServerInstaller.PRODUCT, self.__version, self.__build, self.filename,
+                                     lambda path: self._download_to(path, stream_to))
 
     def install(self):
-        filename = CouchbaseServerInstaller._generate_filename(self.__version, self.__build)
-        if not Path(filename).exists():
+        artifact = self.artifact
+        if artifact is None:
             raise Exception("Unable to find installer, please call download first")
 
         print("Installing Couchbase Server to {}...".format(self.__url))
-        ssh_client = SSHClient()
-        ssh_client.load_system_host_keys()
-        ssh_client.set_missing_host_key_policy(WarningPolicy())
-        ssh_connect(ssh_client, self.__url, self.__ssh_keyfile, str(self.__ssh_keypass))
-        (_, stdout, _) = ssh_client.exec_command("test -f {}".format(filename))
-        if stdout.channel.recv_exit_status() == 0:
-            print("Install file already present on remote host, skipping upload...")
-        else:
-            print("Uploading file to remote host...")
-            sftp = ssh_client.open_sftp()
-            sftp_upload(sftp, filename, filename)
-            sftp.close()
+        with ssh_session(self.__url, self.__ssh_keyfile, str(self.__ssh_keypass)) as ssh_client:
+            # The content hash doubles as the dedup key, so nodes holding a matching copy skip the upload
+            if not sftp_upload_resumable(ssh_client, str(artifact.path), artifact.filename, sha256=artifact.sha256):
+                print("Install file already present on remote host, skipped upload...")
+
+            exit_code = ssh_command(ssh_client, self.__url, "sudo yum install -y {}".format(artifact.filename))
+
+        # Raising makes a failed install count as a failure in the fan out results and the bring up graph
+        if exit_code != 0:
+            raise Exception("Installing {} on {} failed (yum exit code {})".format(artifact.filename, self.__url,
+                                                                                   exit_code))
 
-        ssh_command(ssh_client, self.__url, "sudo yum install -y {}".format(filename))
         print("Install finished!")
 
     def _generate_download_url(self, version: str, build: str, filename: str):
@@ -117,151 +144,75 @@ class CouchbaseServerInstaller:
         return "http://latestbuilds.service.couchbase.com/builds/releases/{}/{}".format(version, filename)
 
 
-def _run_cli_command(command: List[str], prefix: str):
-    process = _start_cli_command(command)
-
-    if prefix is None:
-        for line in process.stdout:
-            print(line.decode("utf-8"), end="")
-    else:
-        for line in process.stdout:
-            print("[{}] {}".format(prefix, line.decode("utf-8")), end="")
-
-    process.wait()
-    return process.returncode
-
-
-def _start_cli_command(command: List[str]):
-    path = Path(os.path.dirname(__file__)).absolute() / "couchbase-cli" / "couchbase-cli"
-    command.insert(0, str(path))
-    if os.name == "nt":
-        print(Path(sys.executable).resolve())
-        command.insert(0, Path(sys.executable).resolve())
-
-    return subprocess.Popen(command, stdout=PIPE, stderr=STDOUT, env=os.environ)
-
-
 def initialize_couchbase_cluster(instance: AWSInstance, username: str, password: str):
     print("Initializing {} with a new cluster...".format(instance.name))
-    for i in range(5):
-        retcode = _run_cli_command([
-            "cluster-init",
-            "-c", cluster_init_node.address,
-            "--cluster-username", username,
-            "--cluster-password", password,
-            "--services",  "data,index,query",
-            "--cluster-ramsize", "4096",
-            "--cluster-index-ramsize", "1024",
-            "--cluster-name", "device-farm"
-        ], instance.name)
-
-        if retcode == 0:
+    client = CouchbaseAdminClient(instance.address, username, password)
+    ClusterWatcher(client).wait_for_rest()
+    backoff = Backoff(1.0, 10.0)
+    attempts = 5
+    for i in range(attempts):
+        try:
+            if not client.is_initialized():
+                client.cluster_init("device-farm", 4096, 1024)
+
             break
+        except CouchbaseRestError as e:
+            if i == attempts - 1:
+                raise Exception("Failed to initialize a cluster on {} after {} attempts ({})".format(
+                                instance.name, attempts, e))
 
-        print(colored("Failed to initialize cluster, retrying in 2 seconds ({} attempts remaining)...".format(5 - i),
-                      "yellow"))
-        time.sleep(2)
+            delay = backoff.next()
+            print(colored("Failed to initialize cluster ({}), retrying in {:.1f} seconds ({} attempts remaining)..."
+                          .format(e, delay, attempts - 1 - i), "yellow"))
+            time.sleep(delay)
 
     print("Setting hostname to {}...".format(instance.internal_address))
-    _run_cli_command([
-        "node-init",
-        "-c", instance.address,
-        "-u", username,
-        "-p", password,
-        "--node-init-hostname", instance.internal_address
-    ], instance.name)
+    client.node_init(instance.internal_address)
 
 
 def add_server_nodes(cluster: AWSInstance, nodes: List[AWSInstance], cluster_user: str,
                      cluster_pass: str, node_user: str, node_pass: str):
-    def _server_add_worker(cluster_instance: AWSInstance, server_instance: AWSInstance):
-        return _run_cli_command([
-            "server-add",
-            "-c", cluster.address,
-            "-u", cluster_user,
-            "-p", cluster_pass,
-            "--services",  "data,index,query",
-            "--server-add", "{}:18091".format(server_instance.internal_address),
-            "--server-add-username", node_user,
-            "--server-add-password", node_pass
-        ], server_instance.name)
-
-    futures = []
-    results = []
-    with ThreadPoolExecutor(thread_name_prefix="cb_install") as tp:
-        for i in instances[1:]:
-            print("Adding {} as a new node to the {} cluster...".format(i.name, cluster.name))
-            futures.append(tp.submit(_server_add_worker, instances[0], i))
-
-        for f in futures:
-            results.append(f.result())
-
-    return max(results)
+    client = CouchbaseAdminClient(cluster.address, cluster_user, cluster_pass)
+
+    def _server_add_worker(server_instance: AWSInstance):
+        print("Adding {} as a new node to the {} cluster...".format(server_instance.name, cluster.name))
+        client.add_node(server_instance.internal_address, node_user, node_pass)
+        return 0
+
+    results = fan_out(nodes, _server_add_worker, timeout=300)
+    print_fan_out_results(results)
+    return fan_out_exit_code(results)
 
 
 def rebalance_cluster(instance: AWSInstance, username: str, password: str):
-    return _run_cli_command([
-        "rebalance",
-        "-c", instance.address,
-        "-u", username,
-        "-p", password
-    ], instance.name)
+    def _print_progress(progress: RebalanceProgress, eta: float):
+        eta_str = "unknown" if eta is None else "{:.0f}s".format(eta)
+        print("[{}] Rebalance {:.1f}% complete (ETA {})".format(instance.name, progress.percent, eta_str))
 
+    client = CouchbaseAdminClient(instance.address, username, password)
+    print("Rebalancing the {} cluster...".format(instance.name))
+    client.rebalance()
+    progress = ClusterWatcher(client).wait_for_rebalance(on_progress=_print_progress)
+    if progress.error is not None:
+        print(colored("Rebalance failed: {}".format(progress.error), "red"))
+        return 1
 
-def get_node_count(instance: AWSInstance, username: str, password: str):
-    process = _start_cli_command([
-        "host-list",
-        "-c", instance.address,
-        "-u", username,
-        "-p", password,
-        "-o", "json"
-    ])
-
-    process.wait()
-    if process.returncode != 0:
-        return 0
+    return 0
 
-    result = json.loads(process.stdout.readlines()[-1])
-    return len(result["nodes"])
-
-
-def wait_for_healthy_nodes(instance: AWSInstance, username: str, password: str):
-    NUM_ATTEMPTS = 5
-    for i in range(NUM_ATTEMPTS):
-        print("Checking for healthy nodes, attempt {} of {}...".format(i + 1, NUM_ATTEMPTS))
-        process = _start_cli_command([
-            "server-list",
-            "-c", instance.address,
-            "-u", username,
-            "-p", password
-        ])
-
-        process.wait()
-        if process.returncode != 0:
-            raise Exception("Failed to get server list from cluster!")
-
-        ready = True
-        for line in process.stdout:
-            if line[:2] != "ns_":
-                continue
-
-            components = line.split(' ')
-            if components[2] != "healthy":
-                print(colored("{} is not healthy ({})".format(components[0], components[2]), "yellow"))
-                ready = False
-
-        if ready:
-            print("...All nodes healthy")
-            break
 
-        for s in range(5):
-            print(".", end="")
-            time.sleep(1)
+def get_node_count(instance: AWSInstance, username: str, password: str):
+    return CouchbaseAdminClient(instance.address, username, password).node_count()
 
-        print()
 
-    if not ready:
-        raise Exception("Server nodes failed to become healthy!")
+def wait_for_healthy_nodes(instance: AWSInstance, username: str, password: str, expected_nodes: int = None):
+    print("Waiting for all nodes to become healthy...")
+    client = CouchbaseAdminClient(instance.address, username, password)
+    try:
+        ClusterWatcher(client).wait_for_healthy(expected_nodes)
+    except ClusterTimeoutError as e:
+        raise Exception("Server nodes failed to become healthy! ({})".format(e))
+
+    print("...All nodes healthy")
 
 
 if __name__ == "__main__":
@@ -281,36 +232,87 @@ if __name__ == "__main__":
                         help="The key to connect to EC2 instances")
     parser.add_argument("--setup-only", action="store_true", dest="setuponly",
                         help="Skip the program installation, and configure only")
+    parser.add_argument("--distribution", action="store", type=lambda s: DistributionMode(s),
+                        choices=list(DistributionMode), default=DistributionMode.DIRECT,
+                        help="How to get the installer onto the nodes: upload to each node, upload to one node " +
+                        "and relay between nodes inside the VPC, or publish to s3 once and have each node fetch it " +
+                        "from there (default %(default)s)")
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="If the installer needs downloading, send it to the nodes while it downloads")
     parser.add_argument("--username", action="store", default=config.get(SettingKeyNames.CBS_ADMIN),
                         help="The administrator username for Couchbase Server (default %(default)s)")
     parser.add_argument("--password", action="store",
                         help="The administrator password for Couchbase Server (If not provided, " +
                         "run credential.py for information on how it is resolved)")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
 
     args = parser.parse_args()
+    inventory = InventoryCache()
 
-    futures = []
-    instances = list(filter(lambda x: x.name.startswith(args.servername),
-                     get_aws_instances(AWSState.RUNNING, args.keyname, args.region)))
-
-    num_instances = len(instances)
-    if num_instances == 0:
-        print("No instances found, nothing to do!")
-        sys.exit(0)
-
+    instances = []
     if not args.setuponly:
         keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), args.keyname)
-        with ThreadPoolExecutor(thread_name_prefix="cb_install") as tp:
+        executor = FanOutExecutor(timeout=1800, retries=2)
+
+        if args.distribution != DistributionMode.DIRECT or args.stream:
+            # Get the package onto the nodes up front, the installs below then find it already present
+            # (any node that this fails for falls back to a direct upload)
+            instances.extend(inventory.iter_instances(AWSState.RUNNING, args.keyname, args.region, args.servername,
+                                                      refresh=args.refresh))
+            if len(instances) > 0:
+                peer = args.distribution == DistributionMode.PEER
+                installer = CouchbaseServerInstaller(instances[0].address, args.sshkey, keypass)
+
+                # With peer distribution only the seed needs the stream, the relay takes care of the rest,
+                # and with s3 the nodes fetch it themselves
+                stream_to = None
+                if args.stream and args.distribution != DistributionMode.S3:
+                    stream_to = instances[:1] if peer else instances
+
+                artifact = installer.download(stream_to)
+                if peer:
+                    try:
+                        print_fan_out_results(distribute_package(instances, artifact, args.sshkey, str(keypass)))
+                    except (IOError, SSHException) as e:
+                        print(colored("Peer distribution failed ({}), uploading to each node instead".format(e),
+                                      "yellow"))
+                elif args.distribution == DistributionMode.S3:
+                    try:
+                        print_fan_out_results(mirror_package(instances, artifact, args.sshkey, str(keypass),
+                                                             args.region))
+                    except (BotoCoreError, ClientError) as e:
+                        print(colored("Mirroring to s3 failed ({}), uploading to each node instead".format(e),
+                                      "yellow"))
+
             for instance in instances:
+                installer = CouchbaseServerInstaller(instance.address, args.sshkey, keypass)
+                executor.submit(instance, when_ready(lambda _, i=installer: i.install(), [Probe.SSH]))
+        else:
+            # Start installing on each node as soon as discovery returns it
+            for instance in inventory.iter_instances(AWSState.RUNNING, args.keyname, args.region, args.servername,
+                                                     refresh=args.refresh):
+                instances.append(instance)
                 installer = CouchbaseServerInstaller(instance.address, args.sshkey, keypass)
                 installer.download()  # Make sure only one does the downloading
-                futures.append(tp.submit(lambda i: i.install(), installer))
+                executor.submit(instance, when_ready(lambda _, i=installer: i.install(), [Probe.SSH]))
 
-            for f in futures:
-                f.result()
+        results = executor.wait()
+        print_fan_out_results(results)
+        if fan_out_exit_code(results) != 0:
+            sys.exit(1)
     else:
         print("Skipping program installation, continuing to setup...")
+        instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.servername,
+                                            refresh=args.refresh)
+
+    num_instances = len(instances)
+    if num_instances == 0:
+        print("No instances found, nothing to do!")
+        sys.exit(0)
 
+    # Every node is about to be talked to over REST, so wait for all of their management ports
+    wait_until_ready(instances, [Probe.CBS_REST])
     couchbase_pw = Credential("Couchbase Server password", args.password, str(CredentialName.CM_CBS_PASS), args.keyname)
     num_nodes = get_node_count(instances[0], args.username, str(couchbase_pw))
     if num_nodes == num_instances:
@@ -326,4 +328,4 @@ if __name__ == "__main__":
                      str(couchbase_pw))
     rebalance_cluster(cluster_init_node, args.username, str(couchbase_pw))
 
-    wait_for_healthy_nodes(instances[0], args.username, str(couchbase_pw))
+    wait_for_healthy_nodes(instances[0], args.username, str(couchbase_pw), num_instances)
@@ -2,15 +2,26 @@
 
 from configure import Configuration, SettingKeyNames
 from pathlib import Path
-from paramiko import SSHClient, WarningPolicy
+from typing import List
 from credential import Credential, CredentialName
-from ssh_utils import ssh_connect, ssh_command, sftp_upload
+from ssh_utils import ssh_session, ssh_command, sftp_upload, sftp_upload_resumable, fan_out, fan_out_exit_code, \
+    print_fan_out_results, FanOutExecutor
 from argparse import ArgumentParser
-from query_cluster import get_aws_instances, AWSState, AWSInstance
-from concurrent.futures import ThreadPoolExecutor
+from query_cluster import AWSState, AWSInstance
+from artifact_cache import ArtifactStore, Artifact
+from downloader import SegmentedDownloader
+from streaming_tee import stream_package
+from package_distribution import DistributionMode, distribute_package
+from s3_mirror import mirror_package
+from inventory_cache import InventoryCache
+from sg_config import SGProfile, SG_CONFIG_PATH, generate_sg_config, diff_sg_config, bootstrap_changed
+from sg_admin import SGAdminClient, SGAdminError
+from botocore.exceptions import BotoCoreError, ClientError
+from paramiko import SSHException
+from termcolor import colored
+from readiness import Probe, when_ready, wait_until_ready
 from utils import ensure_min_python_version
 
-import wget
 import sys
 import json
 
@@ -18,6 +29,8 @@ ensure_min_python_version()
 
 
 class SyncGatewayInstaller:
+    PRODUCT = "sync-gateway"
+
     __config: Configuration
     __url: str
     __version: str
@@ -50,33 +63,57 @@ class SyncGatewayInstaller:
         self.__ssh_keypass = keypass
         (self.__version, self.__build) = SyncGatewayInstaller._parse_version(self.__raw_version)
 
-    def download(self):
-        filename = SyncGatewayInstaller._generate_filename(self.__version, self.__build)
-        if not Path(filename).exists():
-            print("Downloading Sync Gateway {}...".format(self.__raw_version))
-            url = self._generate_download_url(self.__version, self.__build, filename)
-            wget.download(url, filename)
+    @property
+    def filename(self) -> str:
+        return SyncGatewayInstaller._generate_filename(self.__version, self.__build)
+
+    @property
+    def artifact(self) -> Artifact:
+        return ArtifactStore().lookup(SyncGatewayInstaller.PRODUCT, self.__version, self.__build)
+
+    def _download_to(self, path: Path, stream_to: List[AWSInstance]):
+        print("Downloading Sync Gateway {}...".format(self.__raw_version))
+        url = self._generate_download_url(self.__version, self.__build, self.filename)
+        if stream_to is None or len(stream_to) == 0:
+            SegmentedDownloader().download(url, path)
+            return
+
+        print("Streaming to {} node(s) while downloading...".format(len(stream_to)))
+        print_fan_out_results(stream_package(url, path, stream_to, self.filename, self.__ssh_keyfile,
+                                             str(self.__ssh_keypass)))
+
+    def download(self, stream_to: List[AWSInstance] = None) -> Artifact:
+        """Makes sure the installer is in the artifact store, downloading it if needed
+
+        Arguments:
+            stream_to -- If provided, and a download is needed, forward the package to these
+                         nodes as it arrives instead of uploading it to them afterwards
+
+        Returns:
+            The stored artifact
+        """
+
+        return ArtifactStore().fetch(SyncGatewayInstaller.PRODUCT, self.__version, self.__build, self.filename,
+                                     lambda path: self._download_to(path, stream_to))
 
     def install(self):
-        filename = SyncGatewayInstaller._generate_filename(self.__version, self.__build)
-        if not Path(filename).exists():
+        artifact = self.artifact
+        if artifact is None:
             raise Exception("Unable to find installer, please call download first")
 
         print("Installing Sync Gateway to {}...".format(self.__url))
-        ssh_client = SSHClient()
-        ssh_client.load_system_host_keys()
-        ssh_client.set_missing_host_key_policy(WarningPolicy())
-        ssh_connect(ssh_client, self.__url, self.__ssh_keyfile, str(self.__ssh_keypass))
-        (_, stdout, _) = ssh_client.exec_command("test -f {}".format(filename))
-        if stdout.channel.recv_exit_status() == 0:
-            print("Install file already present on remote host, skipping upload...")
-        else:
-            print("Uploading file to remote host...")
-            sftp = ssh_client.open_sftp()
-            sftp_upload(sftp, filename, filename)
-            sftp.close()
+        with ssh_session(self.__url, self.__ssh_keyfile, str(self.__ssh_keypass)) as ssh_client:
+            # The content hash doubles as the dedup key, so nodes holding a matching copy skip the upload
+            if not sftp_upload_resumable(ssh_client, str(artifact.path), artifact.filename, sha256=artifact.sha256):
+                print("Install file already present on remote host, skipped upload...")
+
+            exit_code = ssh_command(ssh_client, self.__url, "sudo yum install -y {}".format(artifact.filename))
+
+        # Raising makes a failed install count as a failure in the fan out results and the bring up graph
+        if exit_code != 0:
+            raise Exception("Installing {} on {} failed (yum exit code {})".format(artifact.filename, self.__url,
+                                                                                   exit_code))
 
-        ssh_command(ssh_client, self.__url, "sudo yum install -y {}".format(filename))
         print("Install finished!")
 
     def _generate_download_url(self, version: str, build: str, filename: str):
@@ -89,55 +126,103 @@ class SyncGatewayInstaller:
                 version, filename)
 
 
-def deploy_sg_config(instance: AWSInstance, cb_node: AWSInstance, ssh_keyfile: str, keypass: Credential):
-    template = {
-        "logging": {
-            "log_file_path": "/var/tmp/sglogs",
-            "console": {
-                "enabled": False
-            },
-            "debug": {
-                "enabled": True
-            }
-        },
-        "databases": {
-            "db": {
-                "server": "couchbase://{}".format(cb_node.internal_address),
-                "username": "sg",
-                "password": "letmein",
-                "bucket": "device-farm-data",
-                "users": {"GUEST": {"disabled": False, "admin_channels": ["*"]}},
-                "allow_conflicts": False,
-                "revs_limit": 20,
-                "enable_shared_bucket_access": True,
-                "import_docs": "continuous"
-            }
-        },
-        "interface": "0.0.0.0:4984",
-        "adminInterface": "{}:4985".format(instance.private_ip)
-    }
+def read_deployed_sg_config(instance: AWSInstance, ssh_keyfile: str, keypass: Credential) -> dict:
+    """Returns the config currently deployed on a node, or None if there isn't one"""
+
+    with ssh_session(instance.address, ssh_keyfile, str(keypass)) as ssh_client:
+        (_, stdout, _) = ssh_client.exec_command("sudo cat {} 2>/dev/null".format(SG_CONFIG_PATH))
+        content = stdout.read().decode("utf-8")
+        if stdout.channel.recv_exit_status() != 0:
+            return None
+
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
 
+
+def deploy_sg_config(instance: AWSInstance, cb_node: AWSInstance, ssh_keyfile: str, keypass: Credential,
+                     profile: SGProfile = SGProfile.DEFAULT):
+    with ssh_session(instance.address, ssh_keyfile, str(keypass)) as ssh_client:
+        ssh_command(ssh_client, instance.name, "sudo systemctl stop sync_gateway")
+        _upload_sg_config(ssh_client, instance, generate_sg_config(instance, cb_node, profile))
+        ssh_command(ssh_client, instance.name, "sudo systemctl start sync_gateway")
+
+
+def _upload_sg_config(ssh_client, instance: AWSInstance, config: dict):
     config_filename = "{}_config.json".format(instance.name)
     with open(config_filename, "w") as fout:
-        json.dump(template, fout)
-
-    ssh_client = SSHClient()
-    ssh_client.load_system_host_keys()
-    ssh_client.set_missing_host_key_policy(WarningPolicy())
-    ssh_connect(ssh_client, instance.address, ssh_keyfile, str(keypass))
-    ssh_command(ssh_client, instance.name, "sudo systemctl stop sync_gateway")
+        json.dump(config, fout)
 
     sftp = ssh_client.open_sftp()
     sftp_upload(sftp, config_filename, config_filename)
     sftp.close()
+    ssh_command(ssh_client, instance.name, "sudo chown sync_gateway {0}; sudo mv {0} {1}".format(config_filename,
+                                                                                                 SG_CONFIG_PATH))
+
+
+def apply_sg_config(instance: AWSInstance, cb_node: AWSInstance, ssh_keyfile: str, keypass: Credential,
+                    profile: SGProfile = SGProfile.DEFAULT) -> str:
+    """Brings a node's config in line with the profile while disturbing it as little as possible
+
+    Changes that are confined to databases are pushed through the admin API, which reloads just
+    the affected databases in place and keeps the process, its caches and other databases' clients
+    untouched.  Only bootstrap level changes (logging, interfaces, compression) or a failed reload
+    fall back to restarting Sync Gateway.  The file on disk is always updated too, so that a later
+    restart comes back with the same config.
+
+    Arguments:
+        instance    -- The Sync Gateway node
+        cb_node     -- The Couchbase Server node to connect to
+        ssh_keyfile -- The key to connect to the node with
+        keypass     -- The password for the key
+        profile     -- The performance profile to apply
+
+    Returns:
+        unchanged, reloaded or restarted
+    """
+
+    deployed = read_deployed_sg_config(instance, ssh_keyfile, keypass)
+    generated = generate_sg_config(instance, cb_node, profile)
+    if deployed == generated:
+        return "unchanged"
+
+    with ssh_session(instance.address, ssh_keyfile, str(keypass)) as ssh_client:
+        _upload_sg_config(ssh_client, instance, generated)
+
+    restart = deployed is None or bootstrap_changed(deployed, generated)
+    if not restart:
+        admin = SGAdminClient(instance, ssh_keyfile, str(keypass))
+        try:
+            for (db, config) in generated["databases"].items():
+                if deployed.get("databases", {}).get(db) != config:
+                    print("[{}] Reloading database {} through the admin API...".format(instance.name, db))
+                    admin.take_offline(db)
+                    admin.put_database_config(db, config)
+                    admin.bring_online(db)
+        except SGAdminError as e:
+            print(colored("[{}] Reload failed ({}), restarting instead".format(instance.name, e), "yellow"))
+            restart = True
+
+    if not restart:
+        return "reloaded"
+
+    with ssh_session(instance.address, ssh_keyfile, str(keypass)) as ssh_client:
+        ssh_command(ssh_client, instance.name, "sudo systemctl restart sync_gateway")
+
+    return "restarted"
+
+
+def print_sg_config_diff(instance: AWSInstance, cb_node: AWSInstance, ssh_keyfile: str, keypass: Credential,
+                         profile: SGProfile) -> int:
+    diff = diff_sg_config(read_deployed_sg_config(instance, ssh_keyfile, keypass),
+                          generate_sg_config(instance, cb_node, profile), instance.name)
+    if len(diff) == 0:
+        print("[{}] Deployed config already matches the {} profile".format(instance.name, profile))
+    else:
+        print(diff)
 
-    command = """
-              sudo chown sync_gateway {0};
-              sudo mv {0} /home/sync_gateway/sync_gateway.json;
-              sudo systemctl start sync_gateway
-              """.format(config_filename)
-    ssh_command(ssh_client, instance.name, command)
-    ssh_client.close()
+    return 0
 
 
 if __name__ == "__main__":
@@ -160,36 +245,102 @@ if __name__ == "__main__":
                         help="The key to connect to EC2 instances")
     parser.add_argument("--setup-only", action="store_true", dest="setuponly",
                         help="Skip the program installation, and configure only")
+    parser.add_argument("--distribution", action="store", type=lambda s: DistributionMode(s),
+                        choices=list(DistributionMode), default=DistributionMode.DIRECT,
+                        help="How to get the installer onto the nodes: upload to each node, upload to one node " +
+                        "and relay between nodes inside the VPC, or publish to s3 once and have each node fetch it " +
+                        "from there (default %(default)s)")
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="If the installer needs downloading, send it to the nodes while it downloads")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+    parser.add_argument("--profile", action="store", type=lambda s: SGProfile(s), choices=list(SGProfile),
+                        default=SGProfile.DEFAULT,
+                        help="The performance profile to generate the Sync Gateway config from (default %(default)s)")
+    parser.add_argument("--restart", action="store_true", dest="restart",
+                        help="Always restart Sync Gateway to apply the config, instead of reloading it when possible")
+    parser.add_argument("--diff", action="store_true", dest="diff",
+                        help="Show how the generated config differs from the deployed one, without deploying it")
 
     args = parser.parse_args()
+    inventory = InventoryCache()
 
-    futures = []
-    instances = get_aws_instances(AWSState.RUNNING, args.keyname, args.region)
-    sg_instances = list(filter(lambda x: x.name.startswith(args.sgname), instances))
-
-    if len(sg_instances) == 0:
-        print("No instances found, nothing to do!")
-        sys.exit(0)
-
-    
+    sg_instances = []
     keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), args.keyname)
     if not args.setuponly:
-        with ThreadPoolExecutor(thread_name_prefix="sg_install") as tp:
+        executor = FanOutExecutor(timeout=1800, retries=2)
+
+        if args.distribution != DistributionMode.DIRECT or args.stream:
+            # Get the package onto the nodes up front, the installs below then find it already present
+            # (any node that this fails for falls back to a direct upload)
+            sg_instances.extend(inventory.iter_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname,
+                                                         refresh=args.refresh))
+            if len(sg_instances) > 0:
+                peer = args.distribution == DistributionMode.PEER
+                installer = SyncGatewayInstaller(sg_instances[0].address, args.sshkey, keypass)
+
+                # With peer distribution only the seed needs the stream, the relay takes care of the rest,
+                # and with s3 the nodes fetch it themselves
+                stream_to = None
+                if args.stream and args.distribution != DistributionMode.S3:
+                    stream_to = sg_instances[:1] if peer else sg_instances
+
+                artifact = installer.download(stream_to)
+                if peer:
+                    try:
+                        print_fan_out_results(distribute_package(sg_instances, artifact, args.sshkey, str(keypass)))
+                    except (IOError, SSHException) as e:
+                        print(colored("Peer distribution failed ({}), uploading to each node instead".format(e),
+                                      "yellow"))
+                elif args.distribution == DistributionMode.S3:
+                    try:
+                        print_fan_out_results(mirror_package(sg_instances, artifact, args.sshkey, str(keypass),
+                                                             args.region))
+                    except (BotoCoreError, ClientError) as e:
+                        print(colored("Mirroring to s3 failed ({}), uploading to each node instead".format(e),
+                                      "yellow"))
+
             for instance in sg_instances:
+                installer = SyncGatewayInstaller(instance.address, args.sshkey, keypass)
+                executor.submit(instance, when_ready(lambda _, i=installer: i.install(), [Probe.SSH]))
+        else:
+            # Start installing on each node as soon as discovery returns it
+            for instance in inventory.iter_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname,
+                                                     refresh=args.refresh):
+                sg_instances.append(instance)
                 installer = SyncGatewayInstaller(instance.address, args.sshkey, keypass)
                 installer.download()  # Make sure only one does the downloading
-                futures.append(tp.submit(lambda i: i.install(), installer))
+                executor.submit(instance, when_ready(lambda _, i=installer: i.install(), [Probe.SSH]))
 
-            for f in futures:
-                f.result()
+        results = executor.wait()
+        print_fan_out_results(results)
+        if fan_out_exit_code(results) != 0:
+            sys.exit(1)
     else:
         print("Skipping program installation, continuing to setup...")
+        sg_instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname,
+                                               refresh=args.refresh)
+
+    if len(sg_instances) == 0:
+        print("No instances found, nothing to do!")
+        sys.exit(0)
+
+    cb_node = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.servername)[0]
+    if args.diff:
+        print_fan_out_results(fan_out(sg_instances, lambda i: print_sg_config_diff(i, cb_node, args.sshkey, keypass,
+                                                                                   args.profile)))
+        sys.exit(0)
+
+    wait_until_ready([cb_node], [Probe.CBS_REST])
+    if args.restart:
+        deploy = when_ready(lambda i: deploy_sg_config(i, cb_node, args.sshkey, keypass, args.profile), [Probe.SSH])
+    else:
+        deploy = when_ready(lambda i: apply_sg_config(i, cb_node, args.sshkey, keypass, args.profile), [Probe.SSH])
 
-    cb_node = next(i for i in instances if i.name.startswith(args.servername))
-    futures = []
-    with ThreadPoolExecutor(thread_name_prefix="sg_install") as tp:
-        for instance in sg_instances:
-            futures.append(tp.submit(deploy_sg_config, instance, cb_node, args.sshkey, keypass))
+    results = fan_out(sg_instances, deploy, timeout=300, retries=2)
+    print_fan_out_results(results)
+    if fan_out_exit_code(results) != 0:
+        sys.exit(1)
 
-        for f in futures:
-            f.result()
+    # Only report success once every Sync Gateway is actually serving both of its interfaces
+    wait_until_ready(sg_instances, [Probe.SG_PUBLIC, Probe.SG_ADMIN], ssh_keyfile=args.sshkey, keypass=str(keypass))
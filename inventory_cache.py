@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from typing import Iterator, List
+from utils import ensure_min_python_version, file_lock
+from configure import Configuration, SettingKeyNames
+from query_cluster import iter_aws_instances, AWSState, AWSInstance
+
+import json
+import os
+import time
+import hashlib
+
+ensure_min_python_version()
+
+# While instances are being created, started or stopped a listing can be missing some of them, so
+# it's only trusted briefly until the change is known to be done (or the window has passed)
+TRANSITION_TTL = 15.0
+TRANSITION_WINDOW = 900.0
+
+
+class InventoryCache:
+    """A persistent cache of EC2 instance listings, stored under ~/cluster_management/inventory
+
+    Entries are keyed by EC2 keyname, region and (optionally) CloudFormation stack, and contain the
+    unfiltered listing for each instance state so that any name prefix can be answered from a single
+    entry.  Entries expire after a configurable TTL, and are removed whenever the topology is known
+    to have changed (see invalidate).  Empty listings are never cached, and while the topology is
+    changing entries expire after TRANSITION_TTL instead.
+    """
+
+    __ttl: float
+
+    @staticmethod
+    def _get_cache_folder() -> Path:
+        cache_folder = Path.home() / "cluster_management" / "inventory"
+        cache_folder.mkdir(mode=0o755, parents=True, exist_ok=True)
+        return cache_folder
+
+    @staticmethod
+    def _key_prefix(keyname: str, region: str) -> str:
+        # Keynames are user provided, so hash them rather than trusting them as filenames
+        digest = hashlib.sha1(keyname.encode("utf-8")).hexdigest()[:16]
+        return "{}_{}".format(region, digest)
+
+    @staticmethod
+    def _get_cache_file(keyname: str, region: str, stack: str) -> Path:
+        filename = "{}_{}.json".format(InventoryCache._key_prefix(keyname, region), stack or "_all")
+        return InventoryCache._get_cache_folder() / filename
+
+    @staticmethod
+    def _get_transition_file(keyname: str, region: str) -> Path:
+        return InventoryCache._get_cache_folder() / "{}.transition".format(InventoryCache._key_prefix(keyname, region))
+
+    @staticmethod
+    def invalidate(keyname: str, region: str, transitioning: bool = False):
+        """Removes every cached entry for the given keyname and region, regardless of stack
+
+        Arguments:
+            keyname       -- The name of the SSH key that the EC2 instances are using
+            region        -- The region that the instances are in (e.g. us-east-1)
+            transitioning -- True if the instances are still being created, started or stopped, and
+                             False once that is done
+        """
+
+        prefix = InventoryCache._key_prefix(keyname, region)
+        for entry in InventoryCache._get_cache_folder().glob("{}_*.json".format(prefix)):
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+
+        transition_file = InventoryCache._get_transition_file(keyname, region)
+        if transitioning:
+            transition_file.touch()
+        else:
+            try:
+                transition_file.unlink()
+            except FileNotFoundError:
+                pass
+
+    def __init__(self, ttl: float = None):
+        if ttl is None:
+            config = Configuration()
+            config.load()
+            ttl = float(config.get(SettingKeyNames.INVENTORY_CACHE_TTL))
+
+        self.__ttl = ttl
+
+    def _read(self, cache_file: Path) -> dict:
+        if not cache_file.exists():
+            return {}
+
+        try:
+            with cache_file.open(mode="r") as fin:
+                return json.load(fin)
+        except (ValueError, OSError):
+            # A corrupt or half written entry is the same as a missing one
+            return {}
+
+    def _write(self, cache_file: Path, state: AWSState, instances: List[AWSInstance]):
+        # Another process may be writing the entry for a different state, so don't lose its update
+        with file_lock(cache_file.with_suffix(".lock")):
+            data = self._read(cache_file)
+            data[str(state)] = {
+                "timestamp": time.time(),
+                "instances": list(i.to_dict() for i in instances)
+            }
+
+            # Write to a temporary file and rename so that concurrent readers never see a partial entry
+            temp_file = cache_file.with_suffix(".{}.tmp".format(os.getpid()))
+            with temp_file.open(mode="w") as fout:
+                json.dump(data, fout)
+
+            os.replace(str(temp_file), str(cache_file))
+
+    def _ttl(self, keyname: str, region: str) -> float:
+        try:
+            since_transition = time.time() - InventoryCache._get_transition_file(keyname, region).stat().st_mtime
+        except FileNotFoundError:
+            return self.__ttl
+
+        return min(self.__ttl, TRANSITION_TTL) if since_transition < TRANSITION_WINDOW else self.__ttl
+
+    def _lookup(self, cache_file: Path, state: AWSState, ttl: float) -> List[AWSInstance]:
+        entry = self._read(cache_file).get(str(state))
+        if entry is None or time.time() - entry.get("timestamp", 0) > ttl:
+            return None
+
+        return list(AWSInstance(i) for i in entry["instances"])
+
+    def iter_instances(self, state: AWSState, keyname: str, region: str, name_prefix: str = None,
+                       stack: str = None, refresh: bool = False) -> Iterator[AWSInstance]:
+        """Yields the instances matching the given criteria, using the cache when possible
+
+        On a cache miss the instances are streamed from EC2 as they are discovered, and the
+        entry is only written once the listing has been fully consumed (and only if it found any).
+
+        Arguments:
+            state       -- The state that the instances must be in
+            keyname     -- The name of the SSH key that the instances are using
+            region      -- The region to query (e.g. us-east-1)
+            name_prefix -- If provided, only instances whose name starts with this
+            stack       -- If provided, only instances belonging to this CloudFormation stack
+            refresh     -- If true, ignore any cached entry and query EC2 again
+
+        Returns:
+            A generator of AWSInstance objects
+        """
+
+        cache_file = InventoryCache._get_cache_file(keyname, region, stack)
+        cached = None if refresh else self._lookup(cache_file, state, self._ttl(keyname, region))
+        if cached is not None:
+            for instance in cached:
+                if name_prefix is None or (instance.name or "").startswith(name_prefix):
+                    yield instance
+
+            return
+
+        found = []
+        for instance in iter_aws_instances(state, keyname, region, stack=stack):
+            found.append(instance)
+            if name_prefix is None or (instance.name or "").startswith(name_prefix):
+                yield instance
+
+        # An empty listing usually means the instances aren't up yet, so ask EC2 again next time
+        if len(found) > 0:
+            self._write(cache_file, state, found)
+
+    def get_instances(self, state: AWSState, keyname: str, region: str, name_prefix: str = None,
+                      stack: str = None, refresh: bool = False) -> List[AWSInstance]:
+        """Retrieves the full list of instances matching the given criteria
+
+        See iter_instances for a description of the arguments
+        """
+
+        return list(self.iter_instances(state, keyname, region, name_prefix, stack, refresh))
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+from troposphere import Base64, Join, Ref
+from artifact_cache import Artifact
+from utils import ensure_min_python_version
+
+ensure_min_python_version()
+
+# How long CloudFormation waits for every node to report that its install finished
+DEFAULT_BOOTSTRAP_TIMEOUT = 1800
+
+
+class BootstrapPackage:
+    artifact: Artifact
+    url: str
+
+    def __init__(self, artifact: Artifact, url: str):
+        self.artifact = artifact
+        self.url = url
+
+
+def package_user_data(name: str, package: BootstrapPackage, wait_handle) -> Base64:
+    """Generates the UserData for a node that installs a package on its first boot
+
+    The node downloads the package from S3 through a presigned URL, checks it against the
+    expected SHA-256, installs it, and then reports the outcome to the wait condition handle so
+    that the stack only finishes creating once every node has its package installed.  The
+    package is left in the home directory, so the install scripts see it as already uploaded.
+
+    Arguments:
+        name        -- The logical name of the node, reported as the signal's UniqueId
+        package     -- The package to install, and the URL to fetch it from
+        wait_handle -- The WaitConditionHandle resource to signal
+
+    Returns:
+        The Base64 encoded UserData property
+    """
+
+    artifact = package.artifact
+    return Base64(Join("", [
+        "#!/bin/bash\n",
+        "WAIT_HANDLE='", Ref(wait_handle), "'\n",
+        "PACKAGE=/home/centos/{}\n".format(artifact.filename),
+        "signal() {\n",
+        "  curl -s -X PUT -H 'Content-Type:' --retry 5 ",
+        "--data-binary \"{\\\"Status\\\":\\\"$1\\\",\\\"Reason\\\":\\\"$2\\\",",
+        "\\\"UniqueId\\\":\\\"", name, "\\\",\\\"Data\\\":\\\"$2\\\"}\" \"$WAIT_HANDLE\"\n",
+        "}\n",
+        "if curl -sSf --retry 5 -o \"$PACKAGE\" '{}' && \\\n".format(package.url),
+        "   echo '{}  '\"$PACKAGE\" | sha256sum -c - && \\\n".format(artifact.sha256),
+        "   chown centos:centos \"$PACKAGE\" && yum install -y \"$PACKAGE\"; then\n",
+        "  signal SUCCESS 'Installed {}'\n".format(artifact.filename),
+        "else\n",
+        "  signal FAILURE 'Failed to install {}'\n".format(artifact.filename),
+        "fi\n"
+    ]))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+from paramiko import RSAKey
+from io import StringIO
+from threading import Condition
+from typing import List
+from enum import Enum
+from termcolor import colored
+from query_cluster import AWSInstance
+from ssh_utils import ssh_session, sftp_upload_resumable, sftp_write_secret, remote_sha256, HostResult, FanOutExecutor
+from artifact_cache import Artifact
+from utils import ensure_min_python_version
+
+import shlex
+import time
+
+ensure_min_python_version()
+
+DISTRIBUTION_KEY_COMMENT = "cbl-device-farm-distribution"
+DISTRIBUTION_KEY_PATH = ".ssh/cbl_device_farm_distribution"
+
+# The number of copies a single node will send at once
+DEFAULT_PEER_FANOUT = 2
+
+
+class DistributionMode(Enum):
+    DIRECT = "direct"
+    PEER = "peer"
+    S3 = "s3"
+
+    def __str__(self):
+        return self.value
+
+
+class PeerDistributor:
+    """Copies a package to many nodes by uploading it once and relaying it inside the VPC
+
+    The package is uploaded over the WAN to a single seed node.  Every node that holds a
+    verified copy then becomes a source for the nodes that don't, sending over their private
+    addresses, so the number of holders roughly doubles with each round of copies.  Nodes
+    authenticate to each other with a throwaway key pair that only exists for the duration of
+    the distribution.
+    """
+
+    __instances: List[AWSInstance]
+    __artifact: Artifact
+    __filename: str
+    __ssh_keyfile: str
+    __keypass: str
+    __fanout: int
+    __sha256: str
+    __public_key: str
+    __private_key: str
+
+    def __init__(self, instances: List[AWSInstance], artifact: Artifact, ssh_keyfile: str, keypass: str = None,
+                 fanout: int = DEFAULT_PEER_FANOUT):
+        self.__instances = instances
+        self.__artifact = artifact
+        self.__filename = artifact.filename
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__fanout = fanout
+        self.__sha256 = artifact.sha256
+
+        key = RSAKey.generate(2048)
+        key_io = StringIO()
+        key.write_private_key(key_io)
+        self.__private_key = key_io.getvalue()
+        self.__public_key = "{} {} {}".format(key.get_name(), key.get_base64(), DISTRIBUTION_KEY_COMMENT)
+
+    def _run(self, instance: AWSInstance, command: str) -> int:
+        with ssh_session(instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            (_, stdout, _) = ssh_client.exec_command(command)
+            stdout.read()
+            return stdout.channel.recv_exit_status()
+
+    def _setup_node(self, instance: AWSInstance) -> int:
+        # Every node may act as both a source and a destination during the distribution
+        command = "mkdir -p ~/.ssh && chmod 700 ~/.ssh && echo {} >> ~/.ssh/authorized_keys".format(
+                  shlex.quote(self.__public_key))
+        exit_code = self._run(instance, command)
+        if exit_code != 0:
+            return exit_code
+
+        # The private key never goes on a command line, where other users on the node could read it
+        with ssh_session(instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            sftp_write_secret(ssh_client, DISTRIBUTION_KEY_PATH, self.__private_key)
+
+        return 0
+
+    def _teardown_node(self, instance: AWSInstance) -> int:
+        command = "sed -i '/{}/d' ~/.ssh/authorized_keys; rm -f ~/{}".format(
+                  DISTRIBUTION_KEY_COMMENT, DISTRIBUTION_KEY_PATH)
+        return self._run(instance, command)
+
+    def _has_package(self, instance: AWSInstance) -> bool:
+        with ssh_session(instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            return remote_sha256(ssh_client, self.__filename) == self.__sha256
+
+    def _relay(self, source: AWSInstance, destination: AWSInstance):
+        remote_file = shlex.quote(self.__filename)
+        part_file = shlex.quote("{}.part".format(self.__filename))
+        ssh_opts = "-i ~/{} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR".format(
+                   DISTRIBUTION_KEY_PATH)
+        command = "scp {0} {1} {2}:{3} && ssh {0} {2} mv -f {3} {1}".format(
+                  ssh_opts, remote_file, destination.internal_address, part_file)
+        print("Relaying {} from {} to {}...".format(self.__filename, source.name, destination.name))
+        if self._run(source, command) != 0:
+            raise IOError("Copy from {} to {} failed".format(source.name, destination.name))
+
+        if not self._has_package(destination):
+            raise IOError("Checksum mismatch on {} after copy from {}".format(destination.name, source.name))
+
+    def _seed(self, instance: AWSInstance):
+        print("Uploading {} to seed node {}...".format(self.__filename, instance.name))
+        with ssh_session(instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            sftp_upload_resumable(ssh_client, str(self.__artifact.path), self.__filename, sha256=self.__sha256)
+
+    def distribute(self) -> List[HostResult]:
+        """Makes sure every instance holds a verified copy of the package
+
+        Returns:
+            One HostResult per instance describing how long its copy took
+        """
+
+        if len(self.__instances) == 0:
+            return []
+
+        try:
+            setup = FanOutExecutor(self.__ssh_keyfile, self.__keypass, retries=2)
+            for instance in self.__instances:
+                setup.submit(instance, self._setup_node)
+
+            failed = list(r.name for r in setup.wait() if not r.succeeded)
+            if len(failed) > 0:
+                raise IOError("Unable to prepare {} for peer distribution".format(", ".join(failed)))
+
+            return self._distribute()
+        finally:
+            # Also runs if only some nodes were set up, so that no node keeps the key
+            teardown = FanOutExecutor(self.__ssh_keyfile, self.__keypass, retries=2)
+            for instance in self.__instances:
+                teardown.submit(instance, self._teardown_node)
+
+            teardown.wait()
+
+    def _distribute(self) -> List[HostResult]:
+        condition = Condition()
+        holders = []
+        missing = []
+        busy = {}
+        results = []
+
+        for instance in self.__instances:
+            if self._has_package(instance):
+                holders.append(instance)
+            else:
+                missing.append(instance)
+
+        if len(holders) == 0:
+            seed = missing.pop(0)
+            result = HostResult(seed)
+            start = time.monotonic()
+            self._seed(seed)
+            result.duration = time.monotonic() - start
+            result.attempts = 1
+            result.exit_code = 0
+            results.append(result)
+            holders.append(seed)
+
+        def _copy(source: AWSInstance, destination: AWSInstance) -> int:
+            try:
+                self._relay(source, destination)
+            finally:
+                with condition:
+                    busy[source.id] -= 1
+                    condition.notify_all()
+
+            # The destination can now serve copies of its own
+            with condition:
+                holders.append(destination)
+                condition.notify_all()
+
+            return 0
+
+        executor = FanOutExecutor(self.__ssh_keyfile, self.__keypass,
+                                  max_workers=len(self.__instances) * self.__fanout, per_host_limit=1, retries=0)
+        with condition:
+            while len(missing) > 0:
+                source = next((h for h in holders if busy.get(h.id, 0) < self.__fanout), None)
+                if source is None:
+                    condition.wait(5)
+                    continue
+
+                destination = missing.pop(0)
+                busy[source.id] = busy.get(source.id, 0) + 1
+                executor.submit(destination, lambda d, s=source: _copy(s, d))
+
+        for result in executor.wait():
+            if not result.succeeded:
+                print(colored("Peer copy to {} failed ({})".format(result.name, result.error), "red"))
+
+            results.append(result)
+
+        return results
+
+
+def distribute_package(instances: List[AWSInstance], artifact: Artifact, ssh_keyfile: str, keypass: str = None,
+                       fanout: int = DEFAULT_PEER_FANOUT) -> List[HostResult]:
+    return PeerDistributor(instances, artifact, ssh_keyfile, keypass, fanout).distribute()
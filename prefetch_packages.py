@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from install_couchbase_server import CouchbaseServerInstaller
+from install_sync_gateway import SyncGatewayInstaller
+from utils import ensure_min_python_version
+from configure import Configuration, SettingKeyNames
+
+ensure_min_python_version()
+
+
+def prefetch_packages(cbs: bool = True, sg: bool = True):
+    """Downloads the configured Couchbase Server and Sync Gateway installers into the artifact store at the same time
+
+    Arguments:
+        cbs -- Whether to download Couchbase Server
+        sg  -- Whether to download Sync Gateway
+
+    Returns:
+        The list of downloaded (or already present) artifacts
+    """
+
+    installers = []
+    if cbs:
+        installers.append(CouchbaseServerInstaller(None, None, None))
+
+    if sg:
+        installers.append(SyncGatewayInstaller(None, None, None))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(installers)), thread_name_prefix="prefetch") as tp:
+        futures = list(tp.submit(i.download) for i in installers)
+        return list(f.result() for f in futures)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="prefetch_packages")
+    config = Configuration()
+    config.load()
+
+    parser.add_argument("--skip-server", action="store_true", dest="skipcbs",
+                        help="Don't download Couchbase Server {}".format(config.get(SettingKeyNames.CBS_VERSION)))
+    parser.add_argument("--skip-sync-gateway", action="store_true", dest="skipsg",
+                        help="Don't download Sync Gateway {}".format(config.get(SettingKeyNames.SG_VERSION)))
+    args = parser.parse_args()
+
+    for artifact in prefetch_packages(not args.skipcbs, not args.skipsg):
+        print("{} is ready at {}".format(artifact, artifact.path))
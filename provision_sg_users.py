@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List
+from progressbar import ProgressBar
+from configure import Configuration, SettingKeyNames
+from credential import CredentialName, Credential
+from inventory_cache import InventoryCache
+from query_cluster import AWSState
+from readiness import Probe, wait_until_ready
+from run_device_farm_test import publish_device_file
+from sg_admin import SGAdminError, SGAdminHTTPClient, sg_admin_tunnel
+from sg_config import SG_DATABASE_NAME
+from sg_endpoints import ASSIGNMENT_ALGORITHM
+from utils import Backoff, RateLimiter, ensure_min_python_version
+
+import hashlib
+import hmac
+import json
+import random
+import sys
+import time
+
+ensure_min_python_version()
+
+MAPPING_VERSION = 1
+MAPPING_FILENAME = "device_farm_sg_users.json"
+PASSWORD_DERIVATION = "hmac-sha256"
+MAX_RETRIES = 3
+
+
+class PrincipalSpec:
+    """Describes a generated set of Sync Gateway roles and users
+
+    Each role is granted a few channels, and each user is given a few roles and a few channels of
+    its own.  The grants are generated from the seed and the principal's name, and the passwords
+    from the secret and the user's name, so provisioning the same spec again produces exactly the
+    same principals.  The channels are named like the ones seed_bucket.py puts documents in.
+    """
+
+    __users: int
+    __roles: int
+    __channels: int
+    __roles_per_user: int
+    __channels_per_role: int
+    __channels_per_user: int
+    __user_prefix: str
+    __role_prefix: str
+    __seed: int
+    __secret: str
+
+    def __init__(self, users: int, roles: int, channels: int, roles_per_user: int, channels_per_role: int,
+                 channels_per_user: int, user_prefix: str = "device-user-", role_prefix: str = "role-",
+                 seed: int = 0, secret: str = ""):
+        self.__users = users
+        self.__roles = roles
+        self.__channels = channels
+        self.__roles_per_user = min(roles_per_user, roles)
+        self.__channels_per_role = min(channels_per_role, channels)
+        self.__channels_per_user = min(channels_per_user, channels)
+        self.__user_prefix = user_prefix
+        self.__role_prefix = role_prefix
+        self.__seed = seed
+        self.__secret = secret
+
+    def _rng(self, name: str) -> random.Random:
+        return random.Random("{}-{}".format(self.__seed, name))
+
+    def _channels(self, rng: random.Random, count: int) -> List[str]:
+        return sorted("channel-{}".format(c) for c in rng.sample(range(self.__channels), count))
+
+    def role_name(self, index: int) -> str:
+        return "{}{:04d}".format(self.__role_prefix, index)
+
+    def user_name(self, index: int) -> str:
+        return "{}{:06d}".format(self.__user_prefix, index)
+
+    def password(self, name: str) -> str:
+        # The devices derive the same password from the secret built into the test package
+        return hmac.new(self.__secret.encode("utf-8"), name.encode("utf-8"), hashlib.sha256).hexdigest()[:20]
+
+    def roles(self) -> Dict[str, dict]:
+        roles = {}
+        for i in range(self.__roles):
+            name = self.role_name(i)
+            roles[name] = {"name": name, "admin_channels": self._channels(self._rng(name), self.__channels_per_role)}
+
+        return roles
+
+    def users(self) -> Dict[str, dict]:
+        role_names = list(self.role_name(i) for i in range(self.__roles))
+        users = {}
+        for i in range(self.__users):
+            name = self.user_name(i)
+            rng = self._rng(name)
+            users[name] = {
+                "name": name,
+                "password": self.password(name),
+                "admin_roles": sorted(rng.sample(role_names, self.__roles_per_user)),
+                "admin_channels": self._channels(rng, self.__channels_per_user)
+            }
+
+        return users
+
+
+def _matches(existing: dict, wanted: dict) -> bool:
+    # GET never returns the password, which is derived from the same secret and name anyway
+    return set(existing.get("admin_channels") or []) == set(wanted.get("admin_channels", [])) and \
+        set(existing.get("admin_roles") or []) == set(wanted.get("admin_roles", []))
+
+
+def upsert_principal(client: SGAdminHTTPClient, db: str, kind: str, name: str, body: dict, limiter: RateLimiter,
+                     force: bool = False) -> str:
+    """Creates or updates a user or role, unless it already has the wanted grants
+
+    Arguments:
+        client  -- The admin client to use
+        db      -- The database to provision
+        kind    -- Either "user" or "role"
+        name    -- The name of the principal
+        body    -- The principal, as sent to the admin API
+        limiter -- Limits the rate of admin API requests across all threads
+        force   -- If True, write the principal without checking it first
+
+    Returns:
+        "created", "updated", "replaced" (with force) or "unchanged"
+    """
+
+    (get, put) = (client.user, client.put_user) if kind == "user" else (client.role, client.put_role)
+    backoff = Backoff(0.5, 10.0)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            existing = None
+            if not force:
+                limiter.acquire()
+                existing = get(db, name)
+                if existing is not None and _matches(existing, body):
+                    return "unchanged"
+
+            limiter.acquire()
+            put(db, name, body)
+            if force:
+                return "replaced"
+
+            return "created" if existing is None else "updated"
+        except SGAdminError as e:
+            # Apart from being throttled, a client error won't go away by retrying
+            client_error = e.status_code is not None and 400 <= e.status_code < 500 and e.status_code != 429
+            if attempt == MAX_RETRIES or client_error:
+                raise
+
+            time.sleep(backoff.next())
+
+
+def provision_principals(client: SGAdminHTTPClient, db: str, kind: str, principals: Dict[str, dict],
+                         concurrency: int, limiter: RateLimiter, force: bool = False) -> Dict[str, int]:
+    """Upserts many principals of one kind at once
+
+    Returns:
+        The number of principals with each outcome, with failures counted as "failed"
+    """
+
+    outcomes = {}
+    print("Provisioning {} {}s...".format(len(principals), kind))
+    start = time.monotonic()
+    progress = ProgressBar(max_value=max(1, len(principals)))
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="provision_{}".format(kind)) as tp:
+        futures = {tp.submit(upsert_principal, client, db, kind, name, body, limiter, force): name
+                   for (name, body) in principals.items()}
+        for (done, future) in enumerate(as_completed(futures), 1):
+            try:
+                outcome = future.result()
+            except SGAdminError as e:
+                print("Failed to provision {} {}: {}".format(kind, futures[future], e))
+                outcome = "failed"
+
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            progress.update(done)
+
+    progress.finish()
+    elapsed = time.monotonic() - start
+    print("{} {}s in {:.1f}s ({:.0f}/sec): {}".format(len(principals), kind, elapsed,
+          len(principals) / elapsed if elapsed > 0 else 0.0,
+          ", ".join("{} {}".format(v, k) for (k, v) in sorted(outcomes.items()))))
+    return outcomes
+
+
+def build_user_mapping(spec: PrincipalSpec, db: str) -> dict:
+    """Builds the file that devices pick their credentials from
+
+    A device should pick its user the same way it picks a Sync Gateway from the endpoint manifest
+    (sg_endpoints.assign_endpoint, with the usernames in place of the endpoints), so that every device
+    keeps its user between runs and the devices spread evenly over the users.  The file holds no
+    passwords, since it is public once published; the devices derive them from the secret instead
+    (the first 20 hex digits of the HMAC-SHA256 of the username).
+    """
+
+    roles = spec.roles()
+    users = []
+    for user in spec.users().values():
+        channels = set(user["admin_channels"])
+        for role in user["admin_roles"]:
+            channels.update(roles[role]["admin_channels"])
+
+        users.append({"username": user["name"], "channels": sorted(channels)})
+
+    return {
+        "version": MAPPING_VERSION,
+        "generated": int(time.time()),
+        "database": db,
+        "assignment": ASSIGNMENT_ALGORITHM,
+        "password": PASSWORD_DERIVATION,
+        "users": users
+    }
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="provision_sg_users")
+    config = Configuration()
+    config.load()
+
+    parser.add_argument("keyname", action="store", type=str,
+                        help="The name of the SSH key that the EC2 instances are using")
+    parser.add_argument("users", action="store", type=int,
+                        help="The number of users to provision")
+    parser.add_argument("--region", action="store", type=str, dest="region",
+                        default=config.get(SettingKeyNames.AWS_REGION),
+                        help="The EC2 region to query (default %(default)s)")
+    parser.add_argument("--sg-name-prefix", action="store", type=str, dest="sgname",
+                        default=config.get(SettingKeyNames.SG_SERVER_PREFIX),
+                        help="The prefix of the Sync Gateway instance names in EC2 (default %(default)s)")
+    parser.add_argument("--ssh-key", action="store", type=str, dest="sshkey",
+                        help="The key to connect to EC2 instances")
+    parser.add_argument("--roles", action="store", type=int, dest="roles", default=50,
+                        help="The number of roles to provision (default %(default)s)")
+    parser.add_argument("--channels", action="store", type=int, dest="channels", default=100,
+                        help="The number of distinct channels to grant (default %(default)s)")
+    parser.add_argument("--roles-per-user", action="store", type=int, dest="rolesperuser", default=2,
+                        help="The number of roles each user has (default %(default)s)")
+    parser.add_argument("--channels-per-role", action="store", type=int, dest="channelsperrole", default=5,
+                        help="The number of channels granted to each role (default %(default)s)")
+    parser.add_argument("--channels-per-user", action="store", type=int, dest="channelsperuser", default=1,
+                        help="The number of channels granted to each user directly (default %(default)s)")
+    parser.add_argument("--user-prefix", action="store", type=str, dest="userprefix", default="device-user-",
+                        help="The prefix of the generated usernames (default %(default)s)")
+    parser.add_argument("--seed", action="store", type=int, dest="seed", default=0,
+                        help="The random seed, which decides the grants (default %(default)s)")
+    parser.add_argument("--secret", action="store", type=str, dest="secret",
+                        help="The secret that the passwords are derived from, which the test clients are built " +
+                        "with (If not provided, run credential.py for information on how it is resolved)")
+    parser.add_argument("--concurrency", action="store", type=int, dest="concurrency", default=16,
+                        help="The number of admin API requests in flight at once (default %(default)s)")
+    parser.add_argument("--rate", action="store", type=float, dest="rate", default=200.0,
+                        help="The maximum number of admin API requests per second (default %(default)s)")
+    parser.add_argument("--force", action="store_true", dest="force",
+                        help="Write every user and role, even if it already has the same grants")
+    parser.add_argument("--output", action="store", type=str, dest="output",
+                        default=str(Path.home() / "cluster_management" / MAPPING_FILENAME),
+                        help="Where to write the usernames for the devices (default %(default)s)")
+    parser.add_argument("--publish", action="store_true", dest="publish",
+                        help="Also upload the usernames to the device farm folder in S3 as " + MAPPING_FILENAME)
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+
+    args = parser.parse_args()
+    sg_instances = InventoryCache().get_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname,
+                                                  refresh=args.refresh)
+    if len(sg_instances) == 0:
+        print("No Sync Gateway instances found for the prefix {}".format(args.sgname))
+        sys.exit(1)
+
+    keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), args.keyname)
+    secret = Credential("Sync Gateway user secret", args.secret, str(CredentialName.CM_SG_USER_SECRET), args.keyname)
+    principal_spec = PrincipalSpec(args.users, args.roles, args.channels, args.rolesperuser, args.channelsperrole,
+                                   args.channelsperuser, args.userprefix, seed=args.seed, secret=str(secret))
+
+    # Principals are stored in the bucket, so provisioning through one node is enough for all of them
+    sg = sg_instances[0]
+    wait_until_ready([sg], [Probe.SG_ADMIN], ssh_keyfile=args.sshkey, keypass=str(keypass))
+    rate_limiter = RateLimiter(args.rate, args.concurrency)
+    failed = 0
+    with sg_admin_tunnel(sg, args.sshkey, str(keypass), args.concurrency) as admin:
+        # Users refer to their roles, so every role has to exist first
+        failed += provision_principals(admin, SG_DATABASE_NAME, "role", principal_spec.roles(), args.concurrency,
+                                       rate_limiter, args.force).get("failed", 0)
+        failed += provision_principals(admin, SG_DATABASE_NAME, "user", principal_spec.users(), args.concurrency,
+                                       rate_limiter, args.force).get("failed", 0)
+
+    mapping = json.dumps(build_user_mapping(principal_spec, SG_DATABASE_NAME), indent=2)
+    Path(args.output).parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    with open(args.output, "w") as fout:
+        fout.write(mapping)
+
+    print("Wrote the usernames of {} users to {}".format(args.users, args.output))
+    if args.publish:
+        publish_device_file(MAPPING_FILENAME, mapping, args.region)
+
+    sys.exit(1 if failed > 0 else 0)
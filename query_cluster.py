@@ -5,12 +5,16 @@ import sys
 
 from enum import Enum
 from argparse import ArgumentParser
+from typing import Dict, Iterator, List
 from utils import ensure_min_python_version
 from tabulate import tabulate
 from configure import Configuration, SettingKeyNames
 
 ensure_min_python_version()
 
+STACK_NAME_TAG = "aws:cloudformation:stack-name"
+DEFAULT_PAGE_SIZE = 100
+
 
 class AWSState(Enum):
     STOPPED = 0
@@ -20,6 +24,15 @@ class AWSState(Enum):
         return self.name
 
 
+class AWSRole(Enum):
+    COUCHBASE_SERVER = "couchbaseserver"
+    SYNC_GATEWAY = "syncgateway"
+    SYNC_GATEWAY_BALANCER = "syncgatewaybalancer"
+
+    def __str__(self):
+        return self.value
+
+
 class AWSInstanceKeys(Enum):
     NAME = "Name"
     ID = "Id"
@@ -27,6 +40,7 @@ class AWSInstanceKeys(Enum):
     PRIVATE_ADDRESS = "PrivateAddress"
     PUBLIC_IP = "Ip"
     PRIVATE_IP = "PrivateIp"
+    TAGS = "Tags"
 
     def __str__(self):
         return self.value
@@ -62,6 +76,21 @@ class AWSInstance:
     def private_ip(self) -> str:
         return self.__data.get(str(AWSInstanceKeys.PRIVATE_IP))
 
+    @property
+    def tags(self) -> Dict[str, str]:
+        return self.__data.get(str(AWSInstanceKeys.TAGS), {})
+
+    @property
+    def role(self) -> str:
+        return self.tags.get("Type")
+
+    @property
+    def stack(self) -> str:
+        return self.tags.get(STACK_NAME_TAG)
+
+    def to_dict(self) -> dict:
+        return dict(self.__data)
+
     def __str__(self) -> str:
         if self.address is not None:
             return "{} ({}) @ {} ({})".format(self.name, self.id, self.address, self.internal_address)
@@ -69,7 +98,8 @@ class AWSInstance:
         return "{} ({})".format(self.name, self.id)
 
 
-def get_aws_instances(state: AWSState, keyName: str, region: str):
+def _build_filters(state: AWSState, keyName: str, name_prefix: str, role: AWSRole, stack: str,
+                   tags: Dict[str, str]) -> List[dict]:
     state_code = 16
     if state == AWSState.STOPPED:
         state_code = 80
@@ -78,30 +108,105 @@ def get_aws_instances(state: AWSState, keyName: str, region: str):
         {"Name": "key-name", "Values": [keyName]},
         {"Name": "instance-state-code", "Values": [str(state_code)]}
     ]
+
+    # EC2 filter values support trailing wildcards, so prefix matching can be
+    # done by the API instead of on the client
+    if name_prefix is not None:
+        filters.append({"Name": "tag:Name", "Values": ["{}*".format(name_prefix)]})
+
+    if role is not None:
+        filters.append({"Name": "tag:Type", "Values": [str(role)]})
+
+    if stack is not None:
+        filters.append({"Name": "tag:{}".format(STACK_NAME_TAG), "Values": [stack]})
+
+    if tags is not None:
+        for key, value in tags.items():
+            filters.append({"Name": "tag:{}".format(key), "Values": [value]})
+
+    return filters
+
+
+def _parse_instance(instance: dict, state: AWSState) -> AWSInstance:
+    next_result = {
+        str(AWSInstanceKeys.ID): instance["InstanceId"]
+    }
+
+    if state == AWSState.RUNNING:
+        next_result[str(AWSInstanceKeys.PUBLIC_ADDRESS)] = instance["PublicDnsName"]
+        next_result[str(AWSInstanceKeys.PRIVATE_ADDRESS)] = instance["PrivateDnsName"]
+        next_result[str(AWSInstanceKeys.PUBLIC_IP)] = instance["PublicIpAddress"]
+        next_result[str(AWSInstanceKeys.PRIVATE_IP)] = instance["PrivateIpAddress"]
+
+    tags = {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])}
+    next_result[str(AWSInstanceKeys.TAGS)] = tags
+    if "Name" in tags:
+        next_result[str(AWSInstanceKeys.NAME)] = tags["Name"]
+
+    return AWSInstance(next_result)
+
+
+def iter_aws_instances(state: AWSState, keyName: str, region: str, name_prefix: str = None,
+                       role: AWSRole = None, stack: str = None, tags: Dict[str, str] = None,
+                       page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[AWSInstance]:
+    """Lazily yields the EC2 instances matching the given criteria
+
+    All filtering is performed by the EC2 API, and results are paged through using
+    NextToken so that callers can start working on the first instances before the
+    full listing has been retrieved.
+
+    Arguments:
+        state       -- The state that the instances must be in
+        keyName     -- The name of the SSH key that the instances are using
+        region      -- The region to query (e.g. us-east-1)
+        name_prefix -- If provided, only instances whose Name tag starts with this
+        role        -- If provided, only instances whose Type tag matches this role
+        stack       -- If provided, only instances belonging to this CloudFormation stack
+        tags        -- Any other tag key / value pairs that must match exactly
+        page_size   -- The number of instances to request per page
+
+    Returns:
+        A generator of AWSInstance objects
+    """
+
+    filters = _build_filters(state, keyName, name_prefix, role, stack, tags)
     ec2 = boto3.client("ec2", region_name=region)
-    raw_output = ec2.describe_instances(Filters=filters)
-    output = []
+    paginator = ec2.get_paginator("describe_instances")
+    for page in paginator.paginate(Filters=filters, PaginationConfig={"PageSize": page_size}):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                yield _parse_instance(instance, state)
 
-    for reservation in raw_output["Reservations"]:
-        for instance in reservation["Instances"]:
-            next_result = {
-                str(AWSInstanceKeys.ID): instance["InstanceId"]
-            }
 
-            if state == AWSState.RUNNING:
-                next_result[str(AWSInstanceKeys.PUBLIC_ADDRESS)] = instance["PublicDnsName"]
-                next_result[str(AWSInstanceKeys.PRIVATE_ADDRESS)] = instance["PrivateDnsName"]
-                next_result[str(AWSInstanceKeys.PUBLIC_IP)] = instance["PublicIpAddress"]
-                next_result[str(AWSInstanceKeys.PRIVATE_IP)] = instance["PrivateIpAddress"]
+def get_aws_instances(state: AWSState, keyName: str, region: str, name_prefix: str = None,
+                      role: AWSRole = None, stack: str = None, tags: Dict[str, str] = None) -> List[AWSInstance]:
+    """Retrieves the full list of EC2 instances matching the given criteria
+
+    See iter_aws_instances for a description of the arguments
+    """
+
+    return list(iter_aws_instances(state, keyName, region, name_prefix, role, stack, tags))
 
-            for tag in instance["Tags"]:
-                if tag["Key"] == "Name":
-                    next_result[str(AWSInstanceKeys.NAME)] = tag["Value"]
-                    break
 
-            output.append(AWSInstance(next_result))
+def get_aws_instance(instance_id: str, region: str, state: AWSState = AWSState.RUNNING, ec2=None) -> AWSInstance:
+    """Retrieves a single EC2 instance by its ID
+
+    Arguments:
+        instance_id -- The ID of the instance (e.g. the PhysicalResourceId of a CloudFormation resource)
+        region      -- The region the instance is in
+        state       -- The state the instance is expected to be in, which determines whether addresses are read
+        ec2         -- The EC2 client to use (default a new boto3 client for the region)
+
+    Returns:
+        The instance, or None if it doesn't exist
+    """
+
+    ec2 = ec2 if ec2 is not None else boto3.client("ec2", region_name=region)
+    for reservation in ec2.describe_instances(InstanceIds=[instance_id])["Reservations"]:
+        for instance in reservation["Instances"]:
+            return _parse_instance(instance, state)
 
-    return output
+    return None
 
 
 if __name__ == "__main__":
@@ -118,9 +223,15 @@ if __name__ == "__main__":
     parser.add_argument("--region",
                         action="store", type=str, dest="region", default=config.get(SettingKeyNames.AWS_REGION),
                         help="The EC2 region to query (default %(default)s)")
+    parser.add_argument("--name-prefix", action="store", type=str, dest="nameprefix",
+                        help="Only return instances whose name starts with this prefix")
+    parser.add_argument("--role", action="store", type=lambda s: AWSRole(s), choices=list(AWSRole),
+                        help="Only return instances with the given role")
+    parser.add_argument("--stack", action="store", type=str,
+                        help="Only return instances belonging to the given CloudFormation stack")
 
     args = parser.parse_args()
-    instances = get_aws_instances(args.state, args.keyname, args.region)
+    instances = get_aws_instances(args.state, args.keyname, args.region, args.nameprefix, args.role, args.stack)
     if len(instances) == 0:
         print("No instances found!")
         sys.exit(0)
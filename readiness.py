@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+from enum import Enum
+from typing import Callable, Dict, List
+from termcolor import colored
+from query_cluster import AWSInstance
+from ssh_utils import ssh_session, FanOutExecutor
+from downloader import get_http_session
+from utils import ensure_min_python_version, Backoff
+
+import requests
+import socket
+import time
+
+ensure_min_python_version()
+
+DEFAULT_ATTEMPT_TIMEOUT = 2.0
+DEFAULT_READY_TIMEOUT = 300
+
+
+class NotReadyError(Exception):
+    pass
+
+
+class Probe(Enum):
+    SSH = "ssh"
+    CBS_REST = "cbs-rest"
+    SG_PUBLIC = "sg-public"
+    SG_ADMIN = "sg-admin"
+    SG_METRICS = "sg-metrics"
+
+    def __str__(self):
+        return self.value
+
+
+def _tcp_open(host: str, port: int, timeout: float) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def _http_ok(url: str, timeout: float) -> bool:
+    try:
+        # Any response below 500 means the service is up (401 just means it wants credentials)
+        return get_http_session().get(url, timeout=timeout).status_code < 500
+    except requests.RequestException:
+        return False
+
+
+class ReadinessProber:
+    """Checks that services on a set of instances are accepting connections
+
+    Every (instance, probe) pair is checked concurrently with a short per-attempt timeout and
+    retried with jittered backoff until it passes or the overall deadline expires.  The Sync
+    Gateway admin port only listens on the private interface, so that probe runs over a pooled
+    SSH connection to the node itself.
+    """
+
+    __ssh_keyfile: str
+    __keypass: str
+    __attempt_timeout: float
+    __checks: Dict[Probe, Callable[[AWSInstance], bool]]
+
+    def __init__(self, ssh_keyfile: str = None, keypass: str = None,
+                 attempt_timeout: float = DEFAULT_ATTEMPT_TIMEOUT):
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__attempt_timeout = attempt_timeout
+        self.__checks = {
+            Probe.SSH: lambda i: _tcp_open(i.address, 22, self.__attempt_timeout),
+            Probe.CBS_REST: lambda i: _http_ok("http://{}:8091/pools".format(i.address), self.__attempt_timeout),
+            Probe.SG_PUBLIC: lambda i: _http_ok("http://{}:4984/".format(i.address), self.__attempt_timeout),
+            Probe.SG_ADMIN: self._check_sg_admin,
+            Probe.SG_METRICS: lambda i: _tcp_open(i.address, 9876, self.__attempt_timeout)
+        }
+
+    def _check_sg_admin(self, instance: AWSInstance) -> bool:
+        command = "curl -sf -m {} -o /dev/null http://{}:4985/".format(int(max(1, self.__attempt_timeout)),
+                                                                       instance.private_ip)
+        try:
+            with ssh_session(instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+                (_, stdout, _) = ssh_client.exec_command(command, timeout=self.__attempt_timeout + 5)
+                return stdout.channel.recv_exit_status() == 0
+        except Exception:
+            return False
+
+    def check(self, instance: AWSInstance, probe: Probe) -> bool:
+        return self.__checks[probe](instance)
+
+    def _wait_one(self, instance: AWSInstance, probe: Probe, deadline: float) -> int:
+        backoff = Backoff(0.5, 5.0)
+        start = time.monotonic()
+        while True:
+            if self.check(instance, probe):
+                print("[{}] {} ready after {:.1f}s".format(instance.name, probe, time.monotonic() - start))
+                return 0
+
+            if time.monotonic() > deadline:
+                print(colored("[{}] {} not ready after {:.1f}s".format(instance.name, probe,
+                                                                       time.monotonic() - start), "red"))
+                return 1
+
+            time.sleep(min(backoff.next(), max(0, deadline - time.monotonic())))
+
+    def wait(self, instances: List[AWSInstance], probes: List[Probe], timeout: float = DEFAULT_READY_TIMEOUT):
+        """Blocks until every probe passes on every instance
+
+        Arguments:
+            instances -- The instances to check
+            probes    -- The probes that must pass on each of them
+            timeout   -- How long to wait before raising NotReadyError
+        """
+
+        if len(instances) == 0 or len(probes) == 0:
+            return
+
+        deadline = time.monotonic() + timeout
+        executor = FanOutExecutor(max_workers=max(16, len(instances) * len(probes)), per_host_limit=len(probes))
+        for instance in instances:
+            for probe in probes:
+                executor.submit(instance, lambda i, p=probe: self._wait_one(i, p, deadline))
+
+        failed = sorted(set(r.name for r in executor.wait() if not r.succeeded))
+        if len(failed) > 0:
+            raise NotReadyError("{} did not become ready ({}) within {} seconds".format(
+                                ", ".join(failed), ", ".join(str(p) for p in probes), timeout))
+
+
+def wait_until_ready(instances: List[AWSInstance], probes: List[Probe], timeout: float = DEFAULT_READY_TIMEOUT,
+                     ssh_keyfile: str = None, keypass: str = None):
+    ReadinessProber(ssh_keyfile, keypass).wait(instances, probes, timeout)
+
+
+def when_ready(task: Callable[[AWSInstance], int], probes: List[Probe], timeout: float = DEFAULT_READY_TIMEOUT,
+               ssh_keyfile: str = None, keypass: str = None) -> Callable[[AWSInstance], int]:
+    """Wraps a FanOutExecutor task so that it starts as soon as its own node passes the probes
+
+    Arguments:
+        task        -- The task to run against each instance
+        probes      -- The probes that must pass on that instance first
+        timeout     -- How long to wait for the probes before failing the task
+        ssh_keyfile -- The key to use for probes that run over SSH
+        keypass     -- The password for the key, if any
+
+    Returns:
+        A callable suitable for FanOutExecutor.submit or fan_out
+    """
+
+    prober = ReadinessProber(ssh_keyfile, keypass)
+
+    def _gated(instance: AWSInstance) -> int:
+        prober.wait([instance], probes, timeout)
+        return task(instance)
+
+    return _gated
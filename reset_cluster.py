@@ -1,61 +1,131 @@
 #!/usr/bin/env python3
 
-from couchbase.cluster import Cluster, PasswordAuthenticator
-from couchbase.exceptions import BucketNotFoundError
-from query_cluster import get_aws_instances, AWSState, AWSInstance
+from bucket_reset import BucketResetter, ResetStrategyName, server_version
+from bucket_snapshot import BucketSnapshots
+from couchbase_rest import CouchbaseAdminClient
+from query_cluster import AWSState, AWSInstance
+from inventory_cache import InventoryCache
 from argparse import ArgumentParser
-from paramiko import SSHClient, WarningPolicy
-from ssh_utils import ssh_command, ssh_connect
-from install_sync_gateway import deploy_sg_config
-from typing import List
+from ssh_utils import ssh_command, ssh_session, fan_out, fan_out_exit_code, print_fan_out_results, HostResult, \
+    DEFAULT_FAN_OUT_WORKERS
+from install_sync_gateway import deploy_sg_config, apply_sg_config
+from sg_config import SGProfile, SG_DATABASE_NAME
+from sg_admin import SGAdminClient, SGAdminError
+from readiness import Probe, wait_until_ready, when_ready
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 from utils import ensure_min_python_version
 from configure import Configuration, SettingKeyNames
 from credential import CredentialName, Credential
 
+import sys
+import time
+
 ensure_min_python_version()
 
 
-def reset_couchbase_cluster(cluster: Cluster, bucket_name: str):
-    try:
-        bucket = cluster.open_bucket(bucket_name)
-        print("Flushing bucket {}...".format(bucket_name))
-        bucket.flush()
-    except BucketNotFoundError:
-        bucket_mgr = cluster.cluster_manager()
-        bucket_mgr.bucket_create(bucket_name, ram_quota=4096, flush_enabled=True, replicas=1)
-        print("Created new bucket {}...".format(bucket_name))
+def reset_couchbase_cluster(client: CouchbaseAdminClient, bucket_name: str,
+                            strategy: ResetStrategyName = ResetStrategyName.AUTO, scope: str = None,
+                            snapshots: BucketSnapshots = None, snapshot: str = None):
+    BucketResetter(client, bucket_name, scope, snapshots=snapshots, snapshot=snapshot).reset(strategy)
+
 
+def _workers(instances: List[AWSInstance]) -> int:
+    # One worker per node, so that a stage takes about as long however many nodes there are
+    return max(DEFAULT_FAN_OUT_WORKERS, len(instances))
+
+
+def set_alternate_hostnames(instances: List[AWSInstance], cb_user: str, cb_pass: str) -> List[HostResult]:
+    """Sets the external hostname of every node at once, each through its own node's REST API"""
 
-def set_alternate_hostnames(instances: List[AWSInstance], ssh_keyfile: str, cb_user: str, cb_pass: str):
     print("Setting up external hostnames on {} nodes".format(len(instances)))
-    ssh_client = SSHClient()
-    ssh_client.load_system_host_keys()
-    ssh_client.set_missing_host_key_policy(WarningPolicy())
-    ssh_connect(ssh_client, instances[0].address, ssh_keyfile)
 
-    format_str = ("/opt/couchbase/bin/couchbase-cli setting-alternate-address -c localhost:8091 -u {} -p {} " +
-                  "--node {} --set --hostname {}")
+    def _set_alternate_address(instance: AWSInstance) -> int:
+        CouchbaseAdminClient(instance.address, cb_user, cb_pass).set_alternate_address(instance.address)
+        return 0
 
-    for i in instances:
-        ssh_command(ssh_client, instances[0].name, format_str.format(cb_user, cb_pass,
-                    i.internal_address, i.address))
+    return fan_out(instances, when_ready(_set_alternate_address, [Probe.CBS_REST]), max_workers=_workers(instances),
+                   timeout=300, retries=2)
 
 
-def change_sync_gateway(url: str, ssh_keyfile: str, start: bool):
+def change_sync_gateway(url: str, ssh_keyfile: str, keypass: Credential, start: bool) -> int:
     print("Connecting to {}...".format(url))
-    ssh_client = SSHClient()
-    ssh_client.load_system_host_keys()
-    ssh_client.set_missing_host_key_policy(WarningPolicy())
-    ssh_connect(ssh_client, url, ssh_keyfile)
+    with ssh_session(url, ssh_keyfile, str(keypass)) as ssh_client:
+        if start:
+            print("Starting Sync Gateway...")
+            return ssh_command(ssh_client, url, "sudo systemctl start sync_gateway")
+        else:
+            print("Stopping Sync Gateway...")
+            return ssh_command(ssh_client, url, "sudo systemctl stop sync_gateway")
+
+
+def take_sync_gateway_offline(instance: AWSInstance, ssh_keyfile: str, keypass: Credential) -> bool:
+    """Takes the Sync Gateway database offline without stopping the process
+
+    Returns:
+        False if the admin API isn't answering, in which case Sync Gateway has to be stopped instead
+    """
+
+    print("Taking Sync Gateway database on {} offline...".format(instance.name))
+    try:
+        SGAdminClient(instance, ssh_keyfile, str(keypass)).take_offline(SG_DATABASE_NAME)
+        return True
+    except SGAdminError as e:
+        print("Admin API unavailable on {} ({}), stopping Sync Gateway instead".format(instance.name, e))
+        return False
+
+
+def stop_sync_gateways(instances: List[AWSInstance], ssh_keyfile: str, keypass: Credential,
+                       restart: bool) -> Tuple[Dict[str, bool], List[HostResult]]:
+    """Detaches every Sync Gateway from the bucket at once
 
-    if start:
-        print("Starting Sync Gateway...")
-        ssh_command(ssh_client, url, "sudo systemctl start sync_gateway")
-    else:
-        print("Stopping Sync Gateway...")
-        ssh_command(ssh_client, url, "sudo systemctl stop sync_gateway")
+    Arguments:
+        instances   -- The Sync Gateway nodes
+        ssh_keyfile -- The key to connect to the nodes with
+        keypass     -- The password for the key
+        restart     -- If True, always stop the process instead of taking the database offline
 
-    ssh_client.close()
+    Returns:
+        Whether each node (by name) was only taken offline, and the result of each node
+    """
+
+    # Where the admin API is available the database is only taken offline, so the process and its
+    # warm caches survive the reset and coming back takes seconds rather than a restart cycle
+    hot_reset = {}
+
+    def _stop(instance: AWSInstance) -> int:
+        hot_reset[instance.name] = not restart and take_sync_gateway_offline(instance, ssh_keyfile, keypass)
+        if hot_reset[instance.name]:
+            return 0
+
+        return change_sync_gateway(instance.address, ssh_keyfile, keypass, False)
+
+    results = fan_out(instances, when_ready(_stop, [Probe.SSH]), max_workers=_workers(instances), timeout=300,
+                      retries=1)
+    return (hot_reset, results)
+
+
+def start_sync_gateways(instances: List[AWSInstance], cb_node: AWSInstance, ssh_keyfile: str, keypass: Credential,
+                        profile: SGProfile, hot_reset: Dict[str, bool]) -> List[HostResult]:
+    """Deploys the config to every Sync Gateway and brings them all back at once
+
+    Nodes that were stopped get the config deployed and are started again, and nodes that were
+    only taken offline get the config applied in place and are brought back online.
+    """
+
+    def _start(instance: AWSInstance) -> int:
+        if not hot_reset.get(instance.name, False):
+            print("Deploying updated Sync Gateway config to {}...".format(instance.name))
+            deploy_sg_config(instance, cb_node, ssh_keyfile, keypass, profile)
+            return 0
+
+        print("Applying Sync Gateway config to {}...".format(instance.name))
+        if apply_sg_config(instance, cb_node, ssh_keyfile, keypass, profile) != "restarted":
+            SGAdminClient(instance, ssh_keyfile, str(keypass)).bring_online(SG_DATABASE_NAME)
+
+        return 0
+
+    return fan_out(instances, _start, max_workers=_workers(instances), timeout=300, retries=1)
 
 
 if __name__ == "__main__":
@@ -73,6 +143,19 @@ if __name__ == "__main__":
                         help="The prefix of the Couchbase Server nodes in EC2 (default %(default)s)")
     parser.add_argument("--bucket-name", action="store", type=str, dest="bucketname", default="device-farm-data",
                         help="The name of the bucket to reset (default %(default)s)")
+    parser.add_argument("--reset-strategy", action="store", type=lambda s: ResetStrategyName(s),
+                        choices=list(ResetStrategyName), dest="resetstrategy", default=ResetStrategyName.AUTO,
+                        help="How to empty the bucket, auto picks the fastest supported one (default %(default)s)")
+    parser.add_argument("--scope", action="store", type=str, dest="scope",
+                        help="The scope holding the data, which allows the recreate-scope strategy (7.0 and up)")
+    parser.add_argument("--snapshot", action="store", type=str, dest="snapshot",
+                        help="Reset the bucket to this snapshot instead of leaving it empty")
+    parser.add_argument("--save-snapshot", action="store", type=str, dest="savesnapshot",
+                        help="Save the bucket as a snapshot with this name and exit, without resetting anything")
+    parser.add_argument("--snapshot-archive", action="store", type=str, dest="snapshotarchive",
+                        default=config.get(SettingKeyNames.SNAPSHOT_ARCHIVE),
+                        help="Where snapshots are kept, a folder on the first Couchbase Server node or an s3:// URL " +
+                        "(default %(default)s)")
     parser.add_argument("--sg-name-prefix", action="store", type=str, dest="sgname",
                         default=config.get(SettingKeyNames.SG_SERVER_PREFIX),
                         help="The prefix of the Sync Gateway instance names in EC2 (default %(default)s)")
@@ -83,34 +166,59 @@ if __name__ == "__main__":
     parser.add_argument("--password", action="store",
                         help="The administrator password for Couchbase Server (If not provided, " +
                         "run credential.py for information on how it is resolved)")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+    parser.add_argument("--restart", action="store_true", dest="restart",
+                        help="Stop and restart Sync Gateway around the reset, instead of taking its database offline")
+    parser.add_argument("--profile", action="store", type=lambda s: SGProfile(s), choices=list(SGProfile),
+                        default=SGProfile.DEFAULT,
+                        help="The performance profile to generate the Sync Gateway config from (default %(default)s)")
 
     args = parser.parse_args()
-    all_instances = get_aws_instances(AWSState.RUNNING, args.keyname, args.region)
-    sg_instances = list(instance for instance in all_instances
-                        if args.sgname in instance.name)
-    cb_instances = list(instance for instance in all_instances
-                        if args.servername in instance.name)
+    inventory = InventoryCache()
+    sg_instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.sgname,
+                                           refresh=args.refresh)
+    cb_instances = inventory.get_instances(AWSState.RUNNING, args.keyname, args.region, args.servername)
 
     if len(sg_instances) == 0:
         print("No Sync Gateway instances found for the prefix {}".format(args.sgname))
 
-    for sg in sg_instances:
-        change_sync_gateway(sg.address, args.sshkey, False)
-
-    if len(cb_instances) > 0:
-        couchbase_pw = Credential("Couchbase Server password", args.password, str(CredentialName.CM_CBS_PASS),
-                                  args.keyname)
-        set_alternate_hostnames(cb_instances, args.sshkey, args.username, str(couchbase_pw))
-        cb_cluster_url = cb_instances[0].address
-        print("Connecting to couchbase://{}:8091".format(cb_cluster_url))
-        cluster = Cluster("couchbase://{}:8091".format(cb_cluster_url))
-        authenticator = PasswordAuthenticator(args.username, str(couchbase_pw))
-        cluster.authenticate(authenticator)
-        reset_couchbase_cluster(cluster, args.bucketname)
-    else:
+    if len(cb_instances) == 0:
         print("No couchbase server found with the name {}".format(args.servername))
-
-    for sg in sg_instances:
-        print("Deploying updated Sync Gateway config...")
-        deploy_sg_config(sg, cb_instances[0], args.sshkey)
-        change_sync_gateway(sg.address, args.sshkey, True)
+        sys.exit(1)
+
+    keypass = Credential("SSH Key Password", None, str(CredentialName.CM_SSHKEY_PASS), args.keyname)
+    couchbase_pw = Credential("Couchbase Server password", args.password, str(CredentialName.CM_CBS_PASS),
+                              args.keyname)
+    cb_cluster_url = cb_instances[0].address
+    # A flush only returns once it has finished, which takes longer than the default timeout
+    client = CouchbaseAdminClient(cb_cluster_url, args.username, str(couchbase_pw), timeout=300)
+    snapshots = BucketSnapshots(cb_instances[0], args.sshkey, str(keypass), args.username, str(couchbase_pw),
+                                args.snapshotarchive, args.region)
+    if args.savesnapshot is not None:
+        snapshots.save(args.bucketname, args.savesnapshot, server_version(client))
+        sys.exit(0)
+
+    reset_start = time.monotonic()
+
+    # Each stage runs on every node at once and the next one starts when all of them are done.  Detaching
+    # Sync Gateway and fixing the external hostnames don't depend on each other, so those two overlap.
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="reset_cluster") as tp:
+        stopping = tp.submit(stop_sync_gateways, sg_instances, args.sshkey, keypass, args.restart)
+        addressing = tp.submit(set_alternate_hostnames, cb_instances, args.username, str(couchbase_pw))
+        (hot_reset, results) = stopping.result()
+        results += addressing.result()
+
+    print_fan_out_results(results)
+    if fan_out_exit_code(results) != 0:
+        print("Not resetting bucket {} because some nodes failed to prepare".format(args.bucketname))
+        sys.exit(1)
+
+    print("Connecting to http://{}:8091".format(cb_cluster_url))
+    reset_couchbase_cluster(client, args.bucketname, args.resetstrategy, args.scope, snapshots, args.snapshot)
+
+    results = start_sync_gateways(sg_instances, cb_instances[0], args.sshkey, keypass, args.profile, hot_reset)
+    print_fan_out_results(results)
+    wait_until_ready(sg_instances, [Probe.SG_PUBLIC, Probe.SG_ADMIN], ssh_keyfile=args.sshkey, keypass=str(keypass))
+    print("Reset finished in {:.1f}s".format(time.monotonic() - reset_start))
+    sys.exit(fan_out_exit_code(results))
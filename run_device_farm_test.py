@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
 import boto3
+import json
 import sys
 
-from query_cluster import get_aws_instances, AWSState
+from query_cluster import AWSState, AWSRole
+from inventory_cache import InventoryCache
+from readiness import Probe, ReadinessProber
+from sg_endpoints import EndpointMode, healthy_sync_gateways, build_manifest
 from utils import ensure_min_python_version
 from argparse import ArgumentParser
 from configure import Configuration, SettingKeyNames
@@ -15,6 +19,8 @@ from tabulate import tabulate
 
 ensure_min_python_version()
 
+MANIFEST_FILENAME = "device_farm_sg_manifest.json"
+
 
 class AppType(Enum):
     IOS = "IOS_APP"
@@ -24,24 +30,73 @@ class AppType(Enum):
         return str.lower(self.name)
 
 
-def write_sync_gateway_address(keyname: str, prefix: str, region: str):
-    filename = "device_farm_sg_address.txt"
-    sg_address = next((i.address for i in get_aws_instances(AWSState.RUNNING, keyname, region)
-                      if prefix in i.name), None)
-    if sg_address is None:
-        print(colored("No Sync Gateway instances found!", "red"))
-        return False
-
-    with open(filename, "w") as fout:
-        fout.write(sg_address)
+def publish_device_file(filename: str, body: str, region: str):
+    """Uploads a file for the devices to read into the public device farm folder in S3"""
 
-    print("Uploading SG address to s3")
     s3 = boto3.resource("s3", region_name=region)
     bucket = s3.Bucket(S3_BUCKET_NAME)
     key = "{}/{}".format(S3_BUCKET_FOLDER, filename)
-    bucket.put_object(Key=key, Body=sg_address)
+    bucket.put_object(Key=key, Body=body)
     s3_obj = bucket.Object(key)
     s3_obj.Acl().put(ACL="public-read")
+
+
+def remove_device_file(filename: str, region: str):
+    """Removes a file from the public device farm folder in S3 (it's fine if it isn't there)"""
+
+    s3 = boto3.resource("s3", region_name=region)
+    s3.Object(S3_BUCKET_NAME, "{}/{}".format(S3_BUCKET_FOLDER, filename)).delete()
+
+
+def write_sync_gateway_address(keyname: str, prefix: str, region: str, refresh: bool = False,
+                               mode: EndpointMode = EndpointMode.SINGLE):
+    """Publishes where the devices should find Sync Gateway
+
+    Arguments:
+        keyname -- The name of the SSH key that the EC2 instances are using
+        prefix  -- The prefix of the Sync Gateway instance names
+        region  -- The EC2 region to query
+        refresh -- Whether to ignore the cached instance inventory
+        mode    -- single publishes the first Sync Gateway, manifest additionally publishes every
+                   healthy Sync Gateway for devices to spread across, and balancer publishes the
+                   stack's load balancer node in front of the Sync Gateways
+
+    Returns:
+        True if an address was published
+    """
+
+    filename = "device_farm_sg_address.txt"
+    inventory = InventoryCache()
+    if mode == EndpointMode.BALANCER:
+        candidates = inventory.get_instances(AWSState.RUNNING, keyname, region, refresh=refresh)
+        sg_instances = list(i for i in candidates if i.role == str(AWSRole.SYNC_GATEWAY_BALANCER))
+        if len(sg_instances) == 0:
+            print(colored("No Sync Gateway load balancer found (create the stack with --sync-gateway-balancer)", "red"))
+            return False
+    else:
+        sg_instances = list(i for i in inventory.get_instances(AWSState.RUNNING, keyname, region, prefix,
+                                                               refresh=refresh)
+                            if i.role != str(AWSRole.SYNC_GATEWAY_BALANCER))
+        if len(sg_instances) == 0:
+            print(colored("No Sync Gateway instances found!", "red"))
+            return False
+
+    # Don't hand the devices an address that isn't serving yet
+    ReadinessProber().wait(sg_instances[:1], [Probe.SG_PUBLIC], timeout=120)
+    sg_address = sg_instances[0].address
+    with open(filename, "w") as fout:
+        fout.write(sg_address)
+
+    print("Uploading SG address to s3")
+    publish_device_file(filename, sg_address, region)
+    if mode == EndpointMode.MANIFEST:
+        healthy = healthy_sync_gateways(sg_instances)
+        print("Uploading SG manifest with {} of {} Sync Gateways to s3".format(len(healthy), len(sg_instances)))
+        publish_device_file(MANIFEST_FILENAME, json.dumps(build_manifest(healthy)), region)
+    else:
+        # The devices prefer the manifest over the address, so don't leave one behind from an earlier run
+        remove_device_file(MANIFEST_FILENAME, region)
+
     return True
 
 
@@ -156,6 +211,10 @@ if __name__ == "__main__":
                         help="The prefix of the Sync Gateway instance names in EC2 (default %(default)s)")
     parser.add_argument("--skip-s3-upload", action="store_true", dest="skipupload",
                         help="If set, don't upload the SG address to S3")
+    parser.add_argument("--sg-endpoints", action="store", type=lambda s: EndpointMode(s), dest="sgendpoints",
+                        choices=list(EndpointMode), default=EndpointMode.SINGLE,
+                        help="Which Sync Gateway address(es) to publish: the first one, a manifest of every " +
+                        "healthy one, or the stack's load balancer (default %(default)s)")
     parser.add_argument("--ios-pool", action="store", dest="iospool",
                         default=config.get(SettingKeyNames.DEVICE_FARM_IOS_POOL),
                         help="The name of the iOS device pool to use with the project (default %(default)s)")
@@ -164,10 +223,12 @@ if __name__ == "__main__":
                         help="The name of the iOS device pool to use with the project (default %(default)s)")
     parser.add_argument("--dry-run", action="store_true", dest="dryrun",
                         help="Only fetch the properties needed to schedule a run, without scheduling it")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
     args = parser.parse_args()
 
     if not args.skipupload and not args.dryrun:
-        if not write_sync_gateway_address(args.keyname, args.sgname, args.region):
+        if not write_sync_gateway_address(args.keyname, args.sgname, args.region, args.refresh, args.sgendpoints):
             sys.exit(1)
 
     project_arn = get_project_arn(args.project_name, "us-west-2")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+from typing import List
+from boto3.s3.transfer import TransferConfig
+from artifact_cache import Artifact
+from configure import Configuration, SettingKeyNames
+from constants import S3_BUCKET_NAME, S3_BUCKET_FOLDER
+from query_cluster import AWSInstance
+from ssh_utils import ssh_session, remote_sha256, fan_out, HostResult
+from utils import ensure_min_python_version
+
+import boto3
+import botocore.exceptions
+import shlex
+
+ensure_min_python_version()
+
+PACKAGE_FOLDER = "{}/packages".format(S3_BUCKET_FOLDER)
+SHA256_METADATA_KEY = "sha256"
+DEFAULT_URL_EXPIRY = 6 * 60 * 60
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+
+
+class S3Mirror:
+    """A copy of the installer packages in S3, so that nodes fetch them from inside AWS rather than over the WAN
+
+    Each package is published once, keyed by its SHA-256, using a parallel multipart upload, and
+    the hash is also stored in the object's metadata so that publishing again is skipped when the
+    object already matches.  Objects stay private, nodes fetch them through presigned URLs.  The
+    endpoint can be pointed at a local S3 stand-in (see the s3_endpoint_url setting).
+    """
+
+    __bucket: str
+    __client: object
+
+    def __init__(self, region: str = None, bucket: str = S3_BUCKET_NAME, endpoint_url: str = None, client=None):
+        self.__bucket = bucket
+        if client is None:
+            if endpoint_url is None:
+                config = Configuration()
+                config.load()
+                endpoint_url = config.get(SettingKeyNames.S3_ENDPOINT_URL) or None
+
+            if endpoint_url is None:
+                # Presigned URLs are only valid when signed for the region the bucket lives in
+                location = boto3.client("s3", region_name=region).get_bucket_location(Bucket=bucket)
+                region = location.get("LocationConstraint") or "us-east-1"
+
+            client = boto3.client("s3", region_name=region, endpoint_url=endpoint_url)
+
+        self.__client = client
+
+    @staticmethod
+    def key(artifact: Artifact) -> str:
+        return "{}/{}/{}".format(PACKAGE_FOLDER, artifact.sha256, artifact.filename)
+
+    def _stored_sha256(self, artifact: Artifact) -> str:
+        try:
+            head = self.__client.head_object(Bucket=self.__bucket, Key=S3Mirror.key(artifact))
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+
+            raise
+
+        if head.get("ContentLength") != artifact.size:
+            return None
+
+        return head.get("Metadata", {}).get(SHA256_METADATA_KEY)
+
+    def publish(self, artifact: Artifact) -> bool:
+        """Uploads a package, unless an identical copy is already in the bucket
+
+        Arguments:
+            artifact -- The package to publish
+
+        Returns:
+            True if it was uploaded, False if it was already present
+        """
+
+        if self._stored_sha256(artifact) == artifact.sha256:
+            print("{} is already mirrored in s3".format(artifact))
+            return False
+
+        print("Uploading {} to s3...".format(artifact))
+        transfer_config = TransferConfig(multipart_threshold=MULTIPART_CHUNK_SIZE,
+                                         multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                                         max_concurrency=MULTIPART_CONCURRENCY, use_threads=True)
+        self.__client.upload_file(str(artifact.path), self.__bucket, S3Mirror.key(artifact),
+                                  ExtraArgs={"Metadata": {SHA256_METADATA_KEY: artifact.sha256}},
+                                  Config=transfer_config)
+        return True
+
+    def presigned_url(self, artifact: Artifact, expires: int = DEFAULT_URL_EXPIRY) -> str:
+        return self.__client.generate_presigned_url("get_object", Params={"Bucket": self.__bucket,
+                                                                          "Key": S3Mirror.key(artifact)},
+                                                    ExpiresIn=expires)
+
+    def fetch_to_nodes(self, instances: List[AWSInstance], artifact: Artifact, ssh_keyfile: str,
+                       keypass: str = None) -> List[HostResult]:
+        """Has each node download a published package straight from S3 into its home directory
+
+        Nodes that already hold a matching copy are skipped, and the download is verified
+        before it is moved into place, so the install step finds it already uploaded.
+
+        Arguments:
+            instances   -- The nodes to download to
+            artifact    -- The package, which must already be published
+            ssh_keyfile -- The key to connect to the nodes with
+            keypass     -- The password for the key, if any
+
+        Returns:
+            One HostResult per node
+        """
+
+        url = self.presigned_url(artifact)
+        part_filename = "{}.part".format(artifact.filename)
+        command = "curl -sSf --retry 5 -o {0} {1} && echo '{2}  {0}' | sha256sum -c --quiet - && mv -f {0} {3}"\
+            .format(shlex.quote(part_filename), shlex.quote(url), artifact.sha256, shlex.quote(artifact.filename))
+
+        def _fetch(instance: AWSInstance) -> int:
+            with ssh_session(instance.address, ssh_keyfile, keypass) as ssh_client:
+                if remote_sha256(ssh_client, artifact.filename) == artifact.sha256:
+                    return 0
+
+                (_, stdout, stderr) = ssh_client.exec_command(command)
+                exit_code = stdout.channel.recv_exit_status()
+                if exit_code != 0:
+                    raise Exception("Fetching from s3 failed: {}".format(stderr.read().decode("utf-8").strip()))
+
+                return exit_code
+
+        return fan_out(instances, _fetch, timeout=1800, retries=1)
+
+
+def mirror_package(instances: List[AWSInstance], artifact: Artifact, ssh_keyfile: str, keypass: str = None,
+                   region: str = None) -> List[HostResult]:
+    mirror = S3Mirror(region)
+    mirror.publish(artifact)
+    return mirror.fetch_to_nodes(instances, artifact, ssh_keyfile, keypass)
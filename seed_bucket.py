@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, FIRST_EXCEPTION, wait
+from typing import Dict
+from couchbase.cluster import Cluster, PasswordAuthenticator
+from couchbase.exceptions import CouchbaseError
+from progressbar import ProgressBar
+from configure import Configuration, SettingKeyNames
+from credential import CredentialName, Credential
+from inventory_cache import InventoryCache
+from query_cluster import AWSState
+from seed_dataset import ChannelDistribution, SeedCheckpoint, SeedSpec, shard_range
+from utils import Backoff, ensure_min_python_version
+
+import os
+import sys
+import time
+
+ensure_min_python_version()
+
+DEFAULT_BATCH_SIZE = 500
+MAX_BATCH_RETRIES = 5
+
+# How often the progress of the workers is collected
+PROGRESS_INTERVAL = 2.0
+
+
+def _upsert_batch(bucket, docs: Dict[str, dict]):
+    backoff = Backoff(0.1, 5.0)
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        try:
+            bucket.upsert_multi(docs)
+            return
+        except CouchbaseError as e:
+            # Only the documents that failed (e.g. temporary out of memory on a node) are sent again
+            failed = {k: docs[k] for (k, result) in e.all_results.items() if not result.success}
+            if attempt == MAX_BATCH_RETRIES or len(failed) == 0:
+                raise
+
+            docs = failed
+            time.sleep(backoff.next())
+
+
+def seed_shard(address: str, username: str, password: str, bucket_name: str, spec: SeedSpec, shard: int,
+               shards: int, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Writes one shard of a dataset, resuming from its checkpoint (run in its own process)
+
+    Each batch is sent with upsert_multi, which puts every document in the batch on the wire before
+    waiting for any of the responses, and each process has its own connection to every data node.
+
+    Returns:
+        The number of documents written by this call
+    """
+
+    indexes = shard_range(spec.count, shard, shards)
+    checkpoint = SeedCheckpoint(bucket_name, spec, shard, shards)
+    next_index = max(indexes.start, checkpoint.read(indexes.start))
+    first_index = next_index
+    generate = spec.generator()
+
+    cluster = Cluster("couchbase://{}".format(address))
+    cluster.authenticate(PasswordAuthenticator(username, password))
+    bucket = cluster.open_bucket(bucket_name)
+    while next_index < indexes.stop:
+        batch_end = min(indexes.stop, next_index + batch_size)
+        _upsert_batch(bucket, {spec.key(i): generate(i) for i in range(next_index, batch_end)})
+        next_index = batch_end
+        checkpoint.write(next_index)
+
+    return next_index - first_index
+
+
+def seed_bucket(address: str, username: str, password: str, bucket_name: str, spec: SeedSpec, workers: int,
+                client_index: int = 0, client_count: int = 1, batch_size: int = DEFAULT_BATCH_SIZE,
+                restart: bool = False) -> float:
+    """Generates a dataset into a bucket with one process per shard
+
+    The dataset is split into workers * client_count shards, and this client writes the workers shards
+    numbered from client_index * workers.  Running the same command on client_count machines (each
+    with its own client_index) spreads the generation over all of them.
+
+    Arguments:
+        address      -- The address of a Couchbase Server node to bootstrap from
+        username     -- The user to write as
+        password     -- The password for the user
+        bucket_name  -- The bucket to write to
+        spec         -- The dataset to generate
+        workers      -- The number of processes (and shards) on this client
+        client_index -- Which of the clients this is
+        client_count -- How many clients share the dataset
+        batch_size   -- The number of documents in each upsert_multi
+        restart      -- If True, ignore the checkpoints of an earlier run and start again
+
+    Returns:
+        The number of documents written per second
+    """
+
+    shards = workers * client_count
+    my_shards = list(range(client_index * workers, (client_index + 1) * workers))
+    checkpoints = {s: SeedCheckpoint(bucket_name, spec, s, shards) for s in my_shards}
+    if restart:
+        for checkpoint in checkpoints.values():
+            checkpoint.clear()
+
+    def _written() -> int:
+        total = 0
+        for (s, checkpoint) in checkpoints.items():
+            indexes = shard_range(spec.count, s, shards)
+            total += max(indexes.start, checkpoint.read(indexes.start)) - indexes.start
+
+        return total
+
+    total = sum(len(shard_range(spec.count, s, shards)) for s in my_shards)
+    already_written = _written()
+    if already_written > 0:
+        print("Resuming with {} of {} documents already written".format(already_written, total))
+
+    print("Seeding {} documents into {} with {} processes...".format(total, bucket_name, workers))
+    start = time.monotonic()
+    progress = ProgressBar(max_value=total)
+    with ProcessPoolExecutor(max_workers=workers) as pp:
+        futures = list(pp.submit(seed_shard, address, username, password, bucket_name, spec, s, shards, batch_size)
+                       for s in my_shards)
+        while True:
+            (_, not_done) = wait(futures, timeout=PROGRESS_INTERVAL, return_when=FIRST_EXCEPTION)
+            written = _written()
+            progress.update(written)
+            if len(not_done) == 0 or any(f.done() and f.exception() is not None for f in futures):
+                break
+
+        progress.finish()
+        written = sum(f.result() for f in futures)
+
+    elapsed = time.monotonic() - start
+    rate = written / elapsed if elapsed > 0 else 0.0
+    print("Seeded {} documents in {:.1f}s ({:.0f} docs/sec)".format(written, elapsed, rate))
+    return rate
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="seed_bucket")
+    config = Configuration()
+    config.load()
+
+    parser.add_argument("keyname", action="store", type=str,
+                        help="The name of the SSH key that the EC2 instances are using")
+    parser.add_argument("count", action="store", type=int,
+                        help="The number of documents in the dataset")
+    parser.add_argument("--region", action="store", type=str, dest="region",
+                        default=config.get(SettingKeyNames.AWS_REGION),
+                        help="The EC2 region to query (default %(default)s)")
+    parser.add_argument("--server-name-prefix", action="store", type=str, dest="servername",
+                        default=config.get(SettingKeyNames.CBS_SERVER_PREFIX),
+                        help="The prefix of the Couchbase Server nodes in EC2 (default %(default)s)")
+    parser.add_argument("--bucket-name", action="store", type=str, dest="bucketname", default="device-farm-data",
+                        help="The name of the bucket to seed (default %(default)s)")
+    parser.add_argument("--username", action="store", default=config.get(SettingKeyNames.CBS_ADMIN),
+                        help="The administrator username for Couchbase Server (default %(default)s)")
+    parser.add_argument("--password", action="store",
+                        help="The administrator password for Couchbase Server (If not provided, " +
+                        "run credential.py for information on how it is resolved)")
+    parser.add_argument("--doc-size", action="store", type=int, dest="docsize", default=1024,
+                        help="The approximate size of each document in bytes (default %(default)s)")
+    parser.add_argument("--channels", action="store", type=int, dest="channels", default=100,
+                        help="The number of distinct channels to assign documents to (default %(default)s)")
+    parser.add_argument("--channels-per-doc", action="store", type=int, dest="channelsperdoc", default=1,
+                        help="The number of channels each document is in (default %(default)s)")
+    parser.add_argument("--channel-distribution", action="store", type=lambda s: ChannelDistribution(s),
+                        choices=list(ChannelDistribution), dest="distribution", default=ChannelDistribution.UNIFORM,
+                        help="How documents are spread over the channels (default %(default)s)")
+    parser.add_argument("--key-pattern", action="store", type=str, dest="keypattern", default="seed::{:010d}",
+                        help="The format of the document keys, given the document index (default %(default)s)")
+    parser.add_argument("--seed", action="store", type=int, dest="seed", default=0,
+                        help="The random seed, which decides the generated contents (default %(default)s)")
+    parser.add_argument("--workers", action="store", type=int, dest="workers", default=os.cpu_count(),
+                        help="The number of processes writing documents (default %(default)s)")
+    parser.add_argument("--batch-size", action="store", type=int, dest="batchsize", default=DEFAULT_BATCH_SIZE,
+                        help="The number of documents in each batch (default %(default)s)")
+    parser.add_argument("--client-index", action="store", type=int, dest="clientindex", default=0,
+                        help="Which part of the dataset to write when seeding from several machines " +
+                        "(default %(default)s)")
+    parser.add_argument("--client-count", action="store", type=int, dest="clientcount", default=1,
+                        help="The number of machines seeding the dataset together (default %(default)s)")
+    parser.add_argument("--restart", action="store_true", dest="restart",
+                        help="Start again instead of resuming an interrupted run with the same settings")
+    parser.add_argument("--refresh", action="store_true", dest="refresh",
+                        help="Ignore the cached instance inventory and query EC2 again")
+
+    args = parser.parse_args()
+    if args.clientindex < 0 or args.clientindex >= args.clientcount:
+        print("--client-index must be between 0 and {}".format(args.clientcount - 1))
+        sys.exit(1)
+
+    cb_instances = InventoryCache().get_instances(AWSState.RUNNING, args.keyname, args.region, args.servername,
+                                                  refresh=args.refresh)
+    if len(cb_instances) == 0:
+        print("No couchbase server found with the name {}".format(args.servername))
+        sys.exit(1)
+
+    couchbase_pw = Credential("Couchbase Server password", args.password, str(CredentialName.CM_CBS_PASS),
+                              args.keyname)
+    seed_spec = SeedSpec(args.count, args.docsize, args.channels, args.channelsperdoc, args.distribution,
+                         args.keypattern, args.seed)
+    seed_bucket(cb_instances[0].address, args.username, str(couchbase_pw), args.bucketname, seed_spec, args.workers,
+                args.clientindex, args.clientcount, args.batchsize, args.restart)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from enum import Enum
+from itertools import accumulate
+from pathlib import Path
+from typing import List
+from utils import ensure_min_python_version
+
+import hashlib
+import json
+import os
+import random
+import string
+
+ensure_min_python_version()
+
+
+class ChannelDistribution(Enum):
+    UNIFORM = "uniform"
+    ZIPF = "zipf"
+
+    def __str__(self):
+        return self.value
+
+
+class SeedSpec:
+    """Describes a generated dataset, so that any document can be generated from its index alone
+
+    Every document is generated from a random number generator seeded with the dataset seed and the
+    index, which lets shards generate their part of the dataset independently and lets an interrupted
+    run pick up where it left off while producing exactly the same documents.
+    """
+
+    __count: int
+    __doc_size: int
+    __channels: int
+    __channels_per_doc: int
+    __distribution: ChannelDistribution
+    __key_pattern: str
+    __seed: int
+
+    def __init__(self, count: int, doc_size: int, channels: int, channels_per_doc: int,
+                 distribution: ChannelDistribution, key_pattern: str, seed: int):
+        self.__count = count
+        self.__doc_size = doc_size
+        self.__channels = channels
+        self.__channels_per_doc = min(channels_per_doc, channels)
+        self.__distribution = distribution
+        self.__key_pattern = key_pattern
+        self.__seed = seed
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def fingerprint(self) -> str:
+        settings = [self.__count, self.__doc_size, self.__channels, self.__channels_per_doc,
+                    str(self.__distribution), self.__key_pattern, self.__seed]
+        return hashlib.sha256(json.dumps(settings).encode("utf-8")).hexdigest()[:12]
+
+    def key(self, index: int) -> str:
+        return self.__key_pattern.format(index)
+
+    def _channel_weights(self) -> List[float]:
+        if self.__distribution == ChannelDistribution.UNIFORM:
+            return None
+
+        # Channel n is picked in proportion to 1 / (n + 1), so a few channels hold most documents
+        return list(accumulate(1.0 / (n + 1) for n in range(self.__channels)))
+
+    def document(self, index: int, cum_weights: List[float] = None, padding: str = None) -> dict:
+        rng = random.Random("{}-{}".format(self.__seed, index))
+        channels = set()
+        while len(channels) < self.__channels_per_doc:
+            channels.add(rng.choices(range(self.__channels), cum_weights=cum_weights)[0])
+
+        doc = {
+            "type": "seed",
+            "index": index,
+            "channels": sorted("channel-{}".format(c) for c in channels),
+            "value": rng.random()
+        }
+
+        # Rotating a shared block of random text is much cheaper than generating new text per document
+        size = max(0, self.__doc_size - len(json.dumps(doc)) - 12)
+        offset = rng.randrange(len(padding)) if padding else 0
+        doc["body"] = (padding[offset:] + padding[:offset])[:size] if padding else ""
+        return doc
+
+    def generator(self):
+        """Returns a function from an index to a document, with the shared state prepared once"""
+
+        cum_weights = self._channel_weights()
+        rng = random.Random(self.__seed)
+        padding = "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(max(self.__doc_size, 1)))
+        return lambda index: self.document(index, cum_weights, padding)
+
+
+class SeedCheckpoint:
+    """The next index a shard will write, kept under ~/cluster_management/seed so that a run can resume"""
+
+    __path: Path
+
+    @staticmethod
+    def _get_default_folder() -> Path:
+        folder = Path.home() / "cluster_management" / "seed"
+        folder.mkdir(mode=0o755, parents=True, exist_ok=True)
+        return folder
+
+    def __init__(self, bucket_name: str, spec: SeedSpec, shard: int, shards: int, folder: Path = None):
+        filename = "{}-{}-{}of{}.json".format(bucket_name, spec.fingerprint, shard, shards)
+        self.__path = (folder if folder is not None else SeedCheckpoint._get_default_folder()) / filename
+
+    def read(self, default: int) -> int:
+        try:
+            with self.__path.open(mode="r") as fin:
+                return json.load(fin)["next"]
+        except (ValueError, KeyError, OSError):
+            return default
+
+    def write(self, next_index: int):
+        temp_path = self.__path.with_suffix(".{}.tmp".format(os.getpid()))
+        with temp_path.open(mode="w") as fout:
+            json.dump({"next": next_index}, fout)
+
+        os.replace(str(temp_path), str(self.__path))
+
+    def clear(self):
+        if self.__path.exists():
+            self.__path.unlink()
+
+
+def shard_range(count: int, shard: int, shards: int) -> range:
+    """Returns the indexes of one shard, which together with the other shards cover 0 to count exactly once"""
+
+    return range(shard * count // shards, (shard + 1) * count // shards)
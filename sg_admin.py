@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from query_cluster import AWSInstance
+from ssh_utils import ssh_session, ssh_tunnel
+from utils import ensure_min_python_version
+
+import json
+import requests
+import shlex
+
+ensure_min_python_version()
+
+
+class SGAdminError(Exception):
+    status_code: int
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SGAdminClient:
+    """A client for the Sync Gateway admin REST API (4985)
+
+    The admin interface only listens on the node's private address, so requests are made with
+    curl on the node itself over the pooled SSH connection.  Errors are raised as SGAdminError.
+    """
+
+    __instance: AWSInstance
+    __ssh_keyfile: str
+    __keypass: str
+    __timeout: float
+
+    def __init__(self, instance: AWSInstance, ssh_keyfile: str, keypass: str = None, timeout: float = 30):
+        self.__instance = instance
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__timeout = timeout
+
+    @property
+    def base_url(self) -> str:
+        return "http://{}:4985".format(self.__instance.private_ip)
+
+    def _request(self, method: str, path: str, body: dict = None):
+        url = "{}{}".format(self.base_url, path)
+        command = "curl -s -m {} -X {} -H 'Content-Type: application/json' -w '\\n%{{http_code}}' {}".format(
+                  int(self.__timeout), method, shlex.quote(url))
+        if body is not None:
+            command += " --data-binary @-"
+
+        with ssh_session(self.__instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            (stdin, stdout, _) = ssh_client.exec_command(command, timeout=self.__timeout + 10)
+            if body is not None:
+                stdin.write(json.dumps(body))
+
+            stdin.channel.shutdown_write()
+            output = stdout.read().decode("utf-8")
+            exit_code = stdout.channel.recv_exit_status()
+
+        if exit_code != 0:
+            raise SGAdminError("{} {} failed (curl exit code {})".format(method, url, exit_code))
+
+        (content, _, status) = output.rpartition("\n")
+        status_code = int(status) if status.strip().isdigit() else 0
+        if status_code >= 400 or status_code == 0:
+            raise SGAdminError("{} {} returned {}: {}".format(method, url, status_code, content.strip()), status_code)
+
+        if len(content.strip()) == 0:
+            return None
+
+        try:
+            return json.loads(content)
+        except ValueError:
+            return content
+
+    def server_info(self) -> dict:
+        return self._request("GET", "/")
+
+    def database_config(self, db: str) -> dict:
+        return self._request("GET", "/{}/_config".format(db))
+
+    def put_database_config(self, db: str, config: dict):
+        """Replaces a database's config in place, which reloads only that database (no process restart)"""
+
+        self._request("PUT", "/{}/_config".format(db), config)
+
+    def _change_state(self, db: str, action: str):
+        try:
+            self._request("POST", "/{}/{}".format(db, action))
+        except SGAdminError as e:
+            # Sync Gateway answers 503 when the database is already in the requested state
+            if e.status_code != 503:
+                raise
+
+    def take_offline(self, db: str):
+        """Stops a database serving clients and releases its bucket connection, leaving the process running"""
+
+        self._change_state(db, "_offline")
+
+    def bring_online(self, db: str):
+        """Reconnects a database to its bucket and starts serving clients again"""
+
+        self._change_state(db, "_online")
+
+
+class SGAdminHTTPClient:
+    """A client for the parts of the Sync Gateway admin REST API used to make many requests in a row
+
+    Requests go over a pooled requests.Session, so with a pool as large as the number of threads
+    using the client each thread keeps its own keep-alive connection.  Use sg_admin_tunnel to reach
+    the admin interface of a node.  Errors are raised as SGAdminError.
+    """
+
+    __base_url: str
+    __session: requests.Session
+    __timeout: float
+
+    def __init__(self, base_url: str, pool_size: int = 16, timeout: float = 30):
+        self.__base_url = base_url.rstrip("/")
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount("http://", adapter)
+        self.__timeout = timeout
+
+    def _request(self, method: str, path: str, body: dict = None):
+        url = "{}{}".format(self.__base_url, path)
+        try:
+            resp = self.__session.request(method, url, json=body, timeout=self.__timeout)
+        except requests.RequestException as e:
+            raise SGAdminError("{} {} failed: {}".format(method, url, e))
+
+        if resp.status_code >= 400:
+            raise SGAdminError("{} {} returned {}: {}".format(method, url, resp.status_code, resp.text.strip()),
+                               resp.status_code)
+
+        if len(resp.content) == 0:
+            return None
+
+        try:
+            return resp.json()
+        except ValueError:
+            return resp.text
+
+    def _get_or_none(self, path: str) -> dict:
+        try:
+            return self._request("GET", path)
+        except SGAdminError as e:
+            if e.status_code == 404:
+                return None
+
+            raise
+
+    def user(self, db: str, name: str) -> dict:
+        return self._get_or_none("/{}/_user/{}".format(db, requests.utils.quote(name, safe="")))
+
+    def put_user(self, db: str, name: str, user: dict):
+        """Creates or replaces a user"""
+
+        self._request("PUT", "/{}/_user/{}".format(db, requests.utils.quote(name, safe="")), user)
+
+    def role(self, db: str, name: str) -> dict:
+        return self._get_or_none("/{}/_role/{}".format(db, requests.utils.quote(name, safe="")))
+
+    def put_role(self, db: str, name: str, role: dict):
+        """Creates or replaces a role"""
+
+        self._request("PUT", "/{}/_role/{}".format(db, requests.utils.quote(name, safe="")), role)
+
+
+@contextmanager
+def sg_admin_tunnel(instance: AWSInstance, ssh_keyfile: str, keypass: str = None, pool_size: int = 16):
+    """Yields an SGAdminHTTPClient for a node's admin interface, reached through an SSH tunnel to the node"""
+
+    with ssh_tunnel(instance.address, ssh_keyfile, keypass, instance.private_ip, 4985) as port:
+        yield SGAdminHTTPClient("http://127.0.0.1:{}".format(port), pool_size)
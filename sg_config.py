@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+from enum import Enum
+from typing import Dict
+from query_cluster import AWSInstance
+from utils import ensure_min_python_version
+
+import difflib
+import json
+
+ensure_min_python_version()
+
+SG_CONFIG_PATH = "/home/sync_gateway/sync_gateway.json"
+SG_DATABASE_NAME = "db"
+
+
+class SGProfile(Enum):
+    DEFAULT = "default"
+    THROUGHPUT = "throughput"
+    LATENCY = "latency"
+    DEBUG = "debug"
+
+    def __str__(self):
+        return self.value
+
+
+class ImportNodes(Enum):
+    ALL = "all"
+    WRITER = "writer"
+
+    def __str__(self):
+        return self.value
+
+
+# Anything a profile doesn't mention is left to the Sync Gateway default
+PROFILE_SETTINGS: Dict[SGProfile, dict] = {
+    SGProfile.DEFAULT: {
+        "console_log_level": None,
+        "debug_log": True,
+        "revs_limit": 20,
+        "import_nodes": ImportNodes.ALL
+    },
+    SGProfile.THROUGHPUT: {
+        "console_log_level": None,
+        "debug_log": False,
+        "revs_limit": 20,
+        "rev_cache_size": 50000,
+        "channel_cache_max_number": 100000,
+        "channel_cache_max_length": 1000,
+        "delta_sync": True,
+        "compression_level": 1,
+        "import_nodes": ImportNodes.WRITER,
+        "import_partitions": 16
+    },
+    SGProfile.LATENCY: {
+        "console_log_level": None,
+        "debug_log": False,
+        "revs_limit": 20,
+        "rev_cache_size": 100000,
+        "channel_cache_max_number": 100000,
+        "channel_cache_max_length": 5000,
+        "delta_sync": False,
+        "compression_level": 0,
+        "import_nodes": ImportNodes.WRITER,
+        "import_partitions": 32
+    },
+    SGProfile.DEBUG: {
+        "console_log_level": "debug",
+        "debug_log": True,
+        "revs_limit": 20,
+        "delta_sync": True,
+        "import_nodes": ImportNodes.ALL,
+        "import_partitions": 1
+    }
+}
+
+
+def runs_import(instance: AWSInstance, import_nodes: ImportNodes) -> bool:
+    """Whether a node should import documents written directly to the bucket
+
+    With ImportNodes.WRITER only the node tagged CacheType=writer in the CloudFormation template
+    imports, which leaves the rest of the tier free to serve replications.
+    """
+
+    if import_nodes == ImportNodes.ALL:
+        return True
+
+    return instance.tags.get("CacheType") == "writer"
+
+
+def generate_sg_config(instance: AWSInstance, cb_node: AWSInstance, profile: SGProfile = SGProfile.DEFAULT) -> dict:
+    """Generates the Sync Gateway config for one node according to a performance profile
+
+    Arguments:
+        instance -- The Sync Gateway node the config is for
+        cb_node  -- The Couchbase Server node to connect to
+        profile  -- The performance profile to apply
+
+    Returns:
+        The config, ready to be serialized to JSON
+    """
+
+    settings = PROFILE_SETTINGS[profile]
+    logging = {
+        "log_file_path": "/var/tmp/sglogs",
+        "console": {
+            "enabled": settings["console_log_level"] is not None
+        },
+        "debug": {
+            "enabled": settings["debug_log"]
+        }
+    }
+
+    if settings["console_log_level"] is not None:
+        logging["console"]["log_level"] = settings["console_log_level"]
+        logging["console"]["log_keys"] = ["*"]
+
+    database = {
+        "server": "couchbase://{}".format(cb_node.internal_address),
+        "username": "sg",
+        "password": "letmein",
+        "bucket": "device-farm-data",
+        "users": {"GUEST": {"disabled": False, "admin_channels": ["*"]}},
+        "allow_conflicts": False,
+        "revs_limit": settings["revs_limit"],
+        "enable_shared_bucket_access": True,
+        "import_docs": "continuous" if runs_import(instance, settings["import_nodes"]) else False
+    }
+
+    if "import_partitions" in settings:
+        database["import_partitions"] = settings["import_partitions"]
+
+    cache = {}
+    if "rev_cache_size" in settings:
+        cache["rev_cache"] = {"size": settings["rev_cache_size"]}
+
+    channel_cache = {}
+    if "channel_cache_max_number" in settings:
+        channel_cache["max_number"] = settings["channel_cache_max_number"]
+
+    if "channel_cache_max_length" in settings:
+        channel_cache["max_length"] = settings["channel_cache_max_length"]
+
+    if len(channel_cache) > 0:
+        cache["channel_cache"] = channel_cache
+
+    if len(cache) > 0:
+        database["cache"] = cache
+
+    if "delta_sync" in settings:
+        database["delta_sync"] = {"enabled": settings["delta_sync"]}
+
+    config = {
+        "logging": logging,
+        "databases": {
+            SG_DATABASE_NAME: database
+        },
+        "interface": "0.0.0.0:4984",
+        "adminInterface": "{}:4985".format(instance.private_ip)
+    }
+
+    if "compression_level" in settings:
+        config["compressionLevel"] = settings["compression_level"]
+
+    return config
+
+
+def bootstrap_changed(deployed: dict, generated: dict) -> bool:
+    """Whether two configs differ in anything other than their databases, which requires a restart to apply"""
+
+    def _bootstrap(config: dict) -> dict:
+        return {k: v for (k, v) in config.items() if k != "databases"}
+
+    # Removing a database can't be done through the database config endpoints either
+    if set(deployed.get("databases", {}).keys()) != set(generated.get("databases", {}).keys()):
+        return True
+
+    return _bootstrap(deployed) != _bootstrap(generated)
+
+
+def diff_sg_config(deployed: dict, generated: dict, name: str = "sync_gateway.json") -> str:
+    """Returns a unified diff between two configs (empty if they are equivalent)
+
+    Both are normalized first, so key order and formatting don't show up as differences.
+    """
+
+    def _lines(config: dict):
+        return json.dumps(config, indent=2, sort_keys=True).splitlines(keepends=True) if config is not None else []
+
+    return "".join(difflib.unified_diff(_lines(deployed), _lines(generated), "deployed/{}".format(name),
+                                        "generated/{}".format(name)))
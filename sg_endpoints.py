@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import List
+from query_cluster import AWSInstance
+from readiness import Probe, ReadinessProber
+from utils import ensure_min_python_version
+
+import hashlib
+import time
+
+ensure_min_python_version()
+
+MANIFEST_VERSION = 1
+ASSIGNMENT_ALGORITHM = "rendezvous-sha256"
+
+
+class EndpointMode(Enum):
+    SINGLE = "single"
+    MANIFEST = "manifest"
+    BALANCER = "balancer"
+
+    def __str__(self):
+        return self.value
+
+
+def healthy_sync_gateways(instances: List[AWSInstance]) -> List[AWSInstance]:
+    """Returns the Sync Gateways that are currently serving their public interface, checked concurrently"""
+
+    if len(instances) == 0:
+        return []
+
+    prober = ReadinessProber()
+    with ThreadPoolExecutor(max_workers=min(16, len(instances)), thread_name_prefix="sg_health") as tp:
+        healthy = list(tp.map(lambda i: prober.check(i, Probe.SG_PUBLIC), instances))
+
+    return list(i for (i, ok) in zip(instances, healthy) if ok)
+
+
+def assign_endpoint(device_id: str, endpoints: List[str]) -> str:
+    """Picks the endpoint a device should use (the reference implementation of the manifest's assignment)
+
+    Rendezvous hashing: every endpoint is scored by the SHA-256 of the device ID and the endpoint,
+    and the highest score wins.  The same device always gets the same endpoint for a given list,
+    devices spread evenly across the list, and removing an endpoint only moves the devices that
+    were assigned to it.
+
+    Arguments:
+        device_id -- Any stable identifier for the device
+        endpoints -- The endpoints listed in the manifest
+
+    Returns:
+        The assigned endpoint
+    """
+
+    def _score(endpoint: str) -> str:
+        return hashlib.sha256("{}|{}".format(device_id, endpoint).encode("utf-8")).hexdigest()
+
+    return max(endpoints, key=_score)
+
+
+def build_manifest(instances: List[AWSInstance]) -> dict:
+    """Builds the endpoint manifest for a set of healthy Sync Gateways
+
+    Arguments:
+        instances -- The Sync Gateways to list
+
+    Returns:
+        The manifest, ready to be serialized to JSON
+    """
+
+    return {
+        "version": MANIFEST_VERSION,
+        "generated": int(time.time()),
+        "assignment": ASSIGNMENT_ALGORITHM,
+        "port": 4984,
+        "endpoints": sorted(i.address for i in instances)
+    }
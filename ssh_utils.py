@@ -1,13 +1,279 @@
 #!/usr/bin/env python3
 
-from paramiko import SSHClient, PasswordRequiredException, SSHException, SFTPClient
+from paramiko import SSHClient, PasswordRequiredException, SSHException, SFTPClient, WarningPolicy
+from paramiko import RSAKey, ECDSAKey, Ed25519Key, DSSKey
+from paramiko.pkey import PKey
 from progressbar import ProgressBar
-from getpass import getpass
 from pathlib import Path
-from utils import ensure_min_python_version
+from contextlib import contextmanager
+from threading import Lock, Thread, Event, Condition
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from tabulate import tabulate
+from termcolor import colored
+from query_cluster import AWSInstance
+from utils import ensure_min_python_version, file_sha256
+
+import atexit
+import random
+import shlex
+import socket
+import time
 
 ensure_min_python_version()
 
+DEFAULT_SSH_USER = "centos"
+DEFAULT_KEEPALIVE_INTERVAL = 30
+DEFAULT_IDLE_TIMEOUT = 120
+DEFAULT_FAN_OUT_WORKERS = 16
+
+# sshd only allows 10 unauthenticated connections by default (MaxStartups)
+DEFAULT_FAN_OUT_PER_HOST = 4
+
+# sshd's default MaxSessions is 10, so leave room for the command channels
+DEFAULT_UPLOAD_CHANNELS = 4
+DEFAULT_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+def load_private_key(ssh_keyfile: str, keypass: str = None) -> PKey:
+    """Reads and decrypts a private key file, trying each key type that paramiko supports
+
+    Arguments:
+        ssh_keyfile -- The path to the private key file
+        keypass     -- The passphrase for the key, if it is encrypted
+
+    Returns:
+        The loaded key
+    """
+
+    passphrase = keypass if keypass else None
+    last_error = None
+    for key_class in (RSAKey, ECDSAKey, Ed25519Key, DSSKey):
+        try:
+            return key_class.from_private_key_file(ssh_keyfile, password=passphrase)
+        except PasswordRequiredException:
+            raise
+        except SSHException as e:
+            last_error = e
+
+    raise SSHException("Unable to load private key {} ({})".format(ssh_keyfile, last_error))
+
+
+class _PooledConnection:
+    client: SSHClient
+    leases: int
+    last_used: float
+
+    def __init__(self, client: SSHClient):
+        self.client = client
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def is_active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHConnectionPool:
+    """A thread safe pool of SSH connections keyed by host and user
+
+    Private keys are read and decrypted once per file, and each host keeps a single
+    authenticated transport alive (with keepalives) for as long as it is being used.
+    Every exec_command or open_sftp call on a leased client opens a new channel on
+    the shared transport, so concurrent users of one host cost a single handshake.
+    Connections that have not been leased for idle_timeout seconds are closed by a
+    background reaper.
+    """
+
+    __lock: Lock
+    __connections: Dict[Tuple[str, str], _PooledConnection]
+    __keys: Dict[str, PKey]
+    __idle_timeout: float
+    __keepalive_interval: int
+    __reaper: Thread
+    __stopped: Event
+
+    def __init__(self, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 keepalive_interval: int = DEFAULT_KEEPALIVE_INTERVAL):
+        self.__lock = Lock()
+        self.__connections = {}
+        self.__keys = {}
+        self.__idle_timeout = idle_timeout
+        self.__keepalive_interval = keepalive_interval
+        self.__stopped = Event()
+        self.__reaper = Thread(target=self._reap_loop, name="ssh_pool_reaper", daemon=True)
+        self.__reaper.start()
+
+    def get_key(self, ssh_keyfile: str, keypass: str) -> PKey:
+        if ssh_keyfile is None:
+            return None
+
+        with self.__lock:
+            key = self.__keys.get(ssh_keyfile)
+            if key is None:
+                key = load_private_key(ssh_keyfile, keypass)
+                self.__keys[ssh_keyfile] = key
+
+            return key
+
+    def _connect(self, url: str, username: str, ssh_keyfile: str, keypass: str) -> SSHClient:
+        client = SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(WarningPolicy())
+        pkey = self.get_key(ssh_keyfile, keypass)
+        client.connect(url, username=username, pkey=pkey, look_for_keys=pkey is None)
+        client.get_transport().set_keepalive(self.__keepalive_interval)
+        return client
+
+    def acquire(self, url: str, ssh_keyfile: str, keypass: str = None, username: str = DEFAULT_SSH_USER) -> SSHClient:
+        key = (url, username)
+        with self.__lock:
+            connection = self.__connections.get(key)
+            if connection is not None and connection.is_active:
+                connection.leases += 1
+                connection.last_used = time.monotonic()
+                return connection.client
+
+        # Connect outside of the lock so that slow hosts don't block the others
+        client = self._connect(url, username, ssh_keyfile, keypass)
+        with self.__lock:
+            connection = self.__connections.get(key)
+            if connection is not None and connection.is_active:
+                # Another thread won the race, use its connection instead
+                client.close()
+            else:
+                connection = _PooledConnection(client)
+                self.__connections[key] = connection
+
+            connection.leases += 1
+            connection.last_used = time.monotonic()
+            return connection.client
+
+    def release(self, url: str, username: str = DEFAULT_SSH_USER):
+        with self.__lock:
+            connection = self.__connections.get((url, username))
+            if connection is not None:
+                connection.leases = max(0, connection.leases - 1)
+                connection.last_used = time.monotonic()
+
+    @contextmanager
+    def connection(self, url: str, ssh_keyfile: str, keypass: str = None, username: str = DEFAULT_SSH_USER):
+        client = self.acquire(url, ssh_keyfile, keypass, username)
+        try:
+            yield client
+        finally:
+            self.release(url, username)
+
+    def close_idle(self):
+        now = time.monotonic()
+        to_close = []
+        with self.__lock:
+            for key, connection in list(self.__connections.items()):
+                expired = connection.leases == 0 and now - connection.last_used > self.__idle_timeout
+                if expired or not connection.is_active:
+                    to_close.append(connection.client)
+                    del self.__connections[key]
+
+        for client in to_close:
+            client.close()
+
+    def close_all(self):
+        self.__stopped.set()
+        with self.__lock:
+            to_close = list(c.client for c in self.__connections.values())
+            self.__connections.clear()
+
+        for client in to_close:
+            client.close()
+
+    def _reap_loop(self):
+        while not self.__stopped.wait(min(self.__idle_timeout, 10)):
+            self.close_idle()
+
+
+_shared_pool = None
+_shared_pool_lock = Lock()
+
+
+def get_ssh_pool() -> SSHConnectionPool:
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = SSHConnectionPool()
+            atexit.register(_shared_pool.close_all)
+
+        return _shared_pool
+
+
+def ssh_session(url: str, ssh_keyfile: str, keypass: str = None, username: str = DEFAULT_SSH_USER):
+    """Leases a connected SSHClient for the given host from the process wide pool
+
+    Use as a context manager.  The client must not be closed by the caller.
+    """
+
+    return get_ssh_pool().connection(url, ssh_keyfile, keypass, username)
+
+
+def _pump(source, destination):
+    try:
+        while True:
+            data = source.recv(64 * 1024)
+            if not data:
+                break
+
+            destination.sendall(data)
+    except (OSError, SSHException):
+        pass
+    finally:
+        # Either side closing ends the forwarded connection in both directions
+        source.close()
+        destination.close()
+
+
+@contextmanager
+def ssh_tunnel(url: str, ssh_keyfile: str, keypass: str, remote_host: str, remote_port: int,
+               username: str = DEFAULT_SSH_USER):
+    """Forwards a local port to remote_host:remote_port (as seen from url) over the pooled connection
+
+    Use as a context manager, which yields the local port on 127.0.0.1.  Every connection to the
+    local port is a separate channel on the host's shared transport, so an HTTP connection pool
+    on top of it keeps real keep-alive connections to the remote service.
+    """
+
+    with ssh_session(url, ssh_keyfile, keypass, username) as ssh_client:
+        transport = ssh_client.get_transport()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(64)
+        listener.settimeout(0.5)
+        stopped = Event()
+
+        def _accept_loop():
+            while not stopped.is_set():
+                try:
+                    (local, address) = listener.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+
+                try:
+                    channel = transport.open_channel("direct-tcpip", (remote_host, remote_port), address)
+                except SSHException:
+                    local.close()
+                    continue
+
+                Thread(target=_pump, args=(local, channel), daemon=True).start()
+                Thread(target=_pump, args=(channel, local), daemon=True).start()
+
+        Thread(target=_accept_loop, name="ssh_tunnel", daemon=True).start()
+        try:
+            yield listener.getsockname()[1]
+        finally:
+            stopped.set()
+            listener.close()
+
 
 def sftp_upload(sftp: SFTPClient, filename: str, remote_filename: str):
     file_size = Path(filename).stat().st_size
@@ -16,13 +282,440 @@ def sftp_upload(sftp: SFTPClient, filename: str, remote_filename: str):
     progress.finish()
 
 
-def ssh_connect(client: SSHClient, url: str, ssh_keyfile: str, keypass: str):
-    client.connect(url, username="centos", key_filename=ssh_keyfile, passphrase=keypass)
+def remote_sha256(client: SSHClient, remote_filename: str) -> str:
+    """Returns the SHA-256 of a remote file, or None if it does not exist"""
+
+    (_, stdout, _) = client.exec_command("sha256sum {} 2>/dev/null".format(shlex.quote(remote_filename)))
+    output = stdout.read().decode("utf-8").strip()
+    if stdout.channel.recv_exit_status() != 0 or len(output) == 0:
+        return None
+
+    return output.split()[0]
+
+
+def _remote_chunk_hashes(client: SSHClient, remote_filename: str, chunk_size: int, num_chunks: int) -> List[str]:
+    # Hash every complete chunk of the remote file in one round trip
+    block_size = UPLOAD_BLOCK_SIZE
+    blocks_per_chunk = chunk_size // block_size
+    command = ("for i in $(seq 0 {}); do dd if={} bs={} skip=$((i * {})) count={} 2>/dev/null | sha256sum; done"
+               .format(num_chunks - 1, shlex.quote(remote_filename), block_size, blocks_per_chunk, blocks_per_chunk))
+    (_, stdout, _) = client.exec_command(command)
+    lines = stdout.read().decode("utf-8").splitlines()
+    stdout.channel.recv_exit_status()
+    return list(line.split()[0] for line in lines if len(line.strip()) > 0)
+
+
+def sftp_upload_resumable(client: SSHClient, filename: str, remote_filename: str,
+                          num_channels: int = DEFAULT_UPLOAD_CHANNELS, chunk_size: int = DEFAULT_UPLOAD_CHUNK_SIZE,
+                          sha256: str = None) -> bool:
+    """Uploads a large file over several concurrent, pipelined SFTP channels
+
+    The file is written to remote_filename.part in fixed size chunks.  If a previous attempt
+    was interrupted, the chunks that lie within the partial file's current size are compared
+    by hash and only the missing or damaged ones are sent again.  The result is verified with
+    a remote SHA-256 before being renamed into place, so a partial upload is never mistaken
+    for a complete one.
+
+    Arguments:
+        client          -- A connected SSH client (from ssh_session)
+        filename        -- The local file to upload
+        remote_filename -- The destination path on the remote host
+        num_channels    -- The number of SFTP channels to write with concurrently
+        chunk_size      -- The size of each chunk (a multiple of 1 MiB)
+        sha256          -- The SHA-256 of the local file, if already known
+
+    Returns:
+        True if anything was uploaded, False if the remote file already matched
+    """
+
+    if sha256 is None:
+        sha256 = file_sha256(filename)
+
+    if remote_sha256(client, remote_filename) == sha256:
+        return False
+
+    file_size = Path(filename).stat().st_size
+    part_filename = "{}.part".format(remote_filename)
+    num_chunks = max(1, (file_size + chunk_size - 1) // chunk_size)
+    chunks = list(range(num_chunks))
+
+    sftp = client.open_sftp()
+    try:
+        remote_size = sftp.stat(part_filename).st_size
+    except IOError:
+        remote_size = None
+
+    if remote_size is None or remote_size > file_size:
+        with sftp.open(part_filename, "wb"):
+            pass
+    else:
+        # Resume: only chunks that the partial file covers can already be in place
+        present = min(remote_size // chunk_size, num_chunks)
+        if present > 0:
+            remote_hashes = _remote_chunk_hashes(client, part_filename, chunk_size, present)
+            chunks = list(i for i in chunks if i >= len(remote_hashes) or
+                          remote_hashes[i] != file_sha256(filename, i * chunk_size, chunk_size))
+            print("Resuming upload of {}, {} of {} chunks already present...".format(
+                  remote_filename, num_chunks - len(chunks), num_chunks))
+
+    sftp.close()
+
+    progress = ProgressBar(max_value=file_size)
+    progress_lock = Lock()
+    uploaded = [(num_chunks - len(chunks)) * chunk_size]
+    work = list(chunks)
+
+    def _upload_worker():
+        channel_sftp = client.open_sftp()
+        try:
+            with open(filename, "rb") as fin, channel_sftp.open(part_filename, "r+b") as fout:
+                fout.set_pipelined(True)
+                while True:
+                    with progress_lock:
+                        if len(work) == 0:
+                            return
+
+                        chunk = work.pop(0)
+
+                    offset = chunk * chunk_size
+                    fin.seek(offset)
+                    fout.seek(offset)
+                    remaining = min(chunk_size, file_size - offset)
+                    while remaining > 0:
+                        block = fin.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                        fout.write(block)
+                        remaining -= len(block)
+                        with progress_lock:
+                            uploaded[0] += len(block)
+                            progress.update(min(uploaded[0], file_size))
+        finally:
+            channel_sftp.close()
+
+    threads = list(Thread(target=_upload_worker, name="sftp_upload_{}".format(i), daemon=True)
+                   for i in range(min(num_channels, max(1, len(chunks)))))
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    progress.finish()
+
+    # Trim anything left over from a longer previous file, then verify before moving into place
+    sftp = client.open_sftp()
+    sftp.truncate(part_filename, file_size)
+    sftp.close()
+    if remote_sha256(client, part_filename) != sha256:
+        raise IOError("Checksum mismatch after uploading {} to {}".format(filename, remote_filename))
+
+    (_, stdout, _) = client.exec_command("mv -f {} {}".format(shlex.quote(part_filename),
+                                                              shlex.quote(remote_filename)))
+    if stdout.channel.recv_exit_status() != 0:
+        raise IOError("Unable to move {} into place".format(part_filename))
+
+    return True
+
+
+def sftp_write_secret(client: SSHClient, remote_filename: str, contents: str):
+    """Writes a secret to a file on the remote host that only the SSH user can read
+
+    Anything on a command line can be read by every user on the host, so secrets are written
+    over SFTP instead and commands read them from the file.
+
+    Arguments:
+        client          -- The connected client to write with
+        remote_filename -- Where to write the secret on the remote host (relative to the home folder)
+        contents        -- The secret
+    """
+
+    sftp = client.open_sftp()
+    try:
+        with sftp.open(remote_filename, "w") as fout:
+            # Restrict the file before anything is written to it
+            fout.chmod(0o600)
+            fout.write(contents)
+    finally:
+        sftp.close()
+
+
+@contextmanager
+def remote_secret_file(client: SSHClient, remote_filename: str, contents: str):
+    """Writes a secret with sftp_write_secret for the duration of the block, and removes it when the block exits
+
+    Returns:
+        The remote filename, for use as a context manager
+    """
+
+    try:
+        sftp_write_secret(client, remote_filename, contents)
+        yield remote_filename
+    finally:
+        sftp = client.open_sftp()
+        try:
+            sftp.remove(remote_filename)
+        except IOError:
+            pass
+        finally:
+            sftp.close()
+
+
+def ssh_connect(client: SSHClient, url: str, ssh_keyfile: str, keypass: str = None):
+    pkey = None if ssh_keyfile is None else get_ssh_pool().get_key(ssh_keyfile, keypass)
+    client.connect(url, username=DEFAULT_SSH_USER, pkey=pkey, look_for_keys=pkey is None)
+
+
+def ssh_command(client: SSHClient, remote_name: str, command: str, timeout: float = None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    (_, stdout, _) = client.exec_command(command, get_pty=True, timeout=timeout)
+    try:
+        for line in stdout:
+            print("[{}] {}".format(remote_name, line), end="")
+            if deadline is not None and time.monotonic() > deadline:
+                raise socket.timeout()
+
+        return stdout.channel.recv_exit_status()
+    except socket.timeout:
+        stdout.channel.close()
+        # The command isn't part of the message, since it may hold secrets that shouldn't end up in logs
+        raise TimeoutError("A command on {} did not finish within {} seconds".format(remote_name, timeout))
+
+
+class HostResult:
+    """The outcome of a single fan out task on a single host"""
+
+    name: str
+    address: str
+    exit_code: int
+    value: object
+    duration: float
+    attempts: int
+    error: str
+
+    def __init__(self, instance: AWSInstance):
+        self.name = instance.name
+        self.address = instance.address
+        self.exit_code = None
+        self.value = None
+        self.duration = 0.0
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None and self.exit_code == 0
+
+
+class _FanOutTask:
+    instance: AWSInstance
+    task: object
+    result: HostResult
+    ready_at: float
+    started_at: float
+    deadline: float
+    busy: bool
+
+    def __init__(self, instance: AWSInstance, task: object):
+        self.instance = instance
+        self.task = task
+        self.result = HostResult(instance)
+        self.ready_at = 0.0
+        self.started_at = None
+        self.deadline = None
+        # Whether a thread is still running an attempt, including one that timed out
+        self.busy = False
+
+    @property
+    def host(self) -> str:
+        return self.instance.address
+
+
+class FanOutExecutor:
+    """Runs commands or callables across many instances with bounded concurrency
+
+    At most max_workers threads run at once overall, and at most per_host_limit at once
+    against any single host so that sshd's MaxStartups is never exceeded.  Each attempt
+    has its own deadline; a task that fails with an exception is retried with exponential
+    backoff up to the given number of times.  Tasks can be submitted while earlier ones
+    are already running, and wait() collects the results as they complete.
+
+    A thread can't be killed, so an attempt that times out keeps its host slot until its
+    thread ends, and its retry doesn't start before then.  If the thread is still running
+    another timeout after the retry was due, the task fails instead.
+
+    A task is either a shell command string (run over a pooled SSH connection) or a
+    callable that takes the AWSInstance and returns an exit code.
+    """
+
+    __max_workers: int
+    __per_host_limit: int
+    __timeout: float
+    __retries: int
+    __backoff: float
+    __ssh_keyfile: str
+    __keypass: str
+    __condition: Condition
+    __pending: List[_FanOutTask]
+    __running: Dict[int, _FanOutTask]
+    __host_counts: Dict[str, int]
+    __busy_threads: int
+    __finished: List[HostResult]
+
+    def __init__(self, ssh_keyfile: str = None, keypass: str = None, max_workers: int = DEFAULT_FAN_OUT_WORKERS,
+                 per_host_limit: int = DEFAULT_FAN_OUT_PER_HOST, timeout: float = None, retries: int = 0,
+                 backoff: float = 2.0):
+        self.__max_workers = max_workers
+        self.__per_host_limit = per_host_limit
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__condition = Condition()
+        self.__pending = []
+        self.__running = {}
+        self.__host_counts = {}
+        # Threads still running an attempt, including timed out ones that are no longer in __running
+        self.__busy_threads = 0
+        self.__finished = []
+
+    def submit(self, instance: AWSInstance, task: Union[str, Callable[[AWSInstance], int]]):
+        with self.__condition:
+            self.__pending.append(_FanOutTask(instance, task))
+            self._dispatch()
+
+    def _run_task(self, task: _FanOutTask) -> int:
+        if callable(task.task):
+            return task.task(task.instance)
+
+        with ssh_session(task.host, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            return ssh_command(ssh_client, task.instance.name, task.task, self.__timeout)
+
+    def _worker(self, task: _FanOutTask, attempt: int):
+        error = None
+        value = None
+        try:
+            value = self._run_task(task)
+        except Exception as e:
+            error = e
+
+        with self.__condition:
+            task.busy = False
+            self.__host_counts[task.host] -= 1
+            self.__busy_threads -= 1
+            if self.__running.get(id(task)) is task and task.result.attempts == attempt:
+                del self.__running[id(task)]
+                self._complete(task, value, error)
+            else:
+                # Already given up on by the deadline check, so the result is stale
+                self._dispatch()
+                self.__condition.notify_all()
+
+    def _complete(self, task: _FanOutTask, value: object, error: Exception):
+        task.result.duration += time.monotonic() - task.started_at
+        if error is not None and task.result.attempts <= self.__retries:
+            delay = self.__backoff * (2 ** (task.result.attempts - 1))
+            task.ready_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            print(colored("[{}] Attempt {} failed ({}), retrying in {:.1f} seconds...".format(
+                  task.instance.name, task.result.attempts, error, task.ready_at - time.monotonic()), "yellow"))
+            self.__pending.append(task)
+        else:
+            task.result.value = value
+            if error is not None:
+                task.result.error = str(error)
+            elif isinstance(value, int) and not isinstance(value, bool):
+                task.result.exit_code = value
+            else:
+                task.result.exit_code = 0
+
+            self.__finished.append(task.result)
+
+        self._dispatch()
+        self.__condition.notify_all()
+
+    def _abandon_stuck(self, now: float):
+        for task in list(self.__pending):
+            if task.busy and self.__timeout is not None and now > task.ready_at + self.__timeout:
+                self.__pending.remove(task)
+                task.result.error = "attempt {} was still running {} seconds after it timed out".format(
+                                    task.result.attempts, self.__timeout)
+                self.__finished.append(task.result)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        for task in list(self.__pending):
+            if self.__busy_threads >= self.__max_workers:
+                break
+
+            if task.busy or task.ready_at > now or self.__host_counts.get(task.host, 0) >= self.__per_host_limit:
+                continue
+
+            self.__pending.remove(task)
+            self.__host_counts[task.host] = self.__host_counts.get(task.host, 0) + 1
+            self.__busy_threads += 1
+            self.__running[id(task)] = task
+            task.result.attempts += 1
+            task.busy = True
+            task.started_at = now
+            task.deadline = None if self.__timeout is None else now + self.__timeout
+            Thread(target=self._worker, args=(task, task.result.attempts), name="fan_out_{}".format(task.instance.name),
+                   daemon=True).start()
+
+    def _next_wakeup(self, now: float) -> float:
+        candidates = list(t.ready_at for t in self.__pending if t.ready_at > now)
+        candidates.extend(t.ready_at + self.__timeout for t in self.__pending if t.busy and self.__timeout is not None)
+        candidates.extend(t.deadline for t in self.__running.values() if t.deadline is not None)
+        if len(candidates) == 0:
+            return None
+
+        return max(0.01, min(candidates) - now)
+
+    def wait(self) -> List[HostResult]:
+        """Blocks until every submitted task has finished, failed or timed out
+
+        Returns:
+            One HostResult per submitted task, in order of completion
+        """
+
+        with self.__condition:
+            while True:
+                now = time.monotonic()
+                for task in list(self.__running.values()):
+                    if task.deadline is not None and now > task.deadline:
+                        # The thread can't be killed, so stop waiting for it (it keeps its host slot until it ends)
+                        del self.__running[id(task)]
+                        self._complete(task, None, TimeoutError("timed out after {} seconds".format(self.__timeout)))
+
+                self._abandon_stuck(now)
+                self._dispatch()
+                if len(self.__pending) == 0 and len(self.__running) == 0:
+                    break
+
+                self.__condition.wait(self._next_wakeup(now))
+
+            return list(self.__finished)
+
+
+def fan_out(instances: Iterable[AWSInstance], task: Union[str, Callable[[AWSInstance], int]], ssh_keyfile: str = None,
+            keypass: str = None, **kwargs) -> List[HostResult]:
+    """Runs the same command or callable on every instance, see FanOutExecutor for the keyword arguments"""
+
+    executor = FanOutExecutor(ssh_keyfile, keypass, **kwargs)
+    for instance in instances:
+        executor.submit(instance, task)
+
+    return executor.wait()
+
+
+def print_fan_out_results(results: List[HostResult]):
+    columns = ["Host", "Exit Code", "Duration (s)", "Attempts", "Error"]
+    data = list([r.name, r.exit_code, "{:.1f}".format(r.duration), r.attempts, r.error or ""] for r in results)
+    print(tabulate(data, headers=columns))
+
 
+def fan_out_exit_code(results: List[HostResult]) -> int:
+    """Collapses a result table into a single process exit code (0 only if every host succeeded)"""
 
-def ssh_command(client: SSHClient, remote_name: str, command: str):
-    (_, stdout, _) = client.exec_command(command, get_pty=True)
-    for line in stdout:
-        print("[{}] {}".format(remote_name, line), end="")
+    if len(results) == 0:
+        return 0
 
-    return stdout.channel.recv_exit_status()
+    return max((r.exit_code if r.error is None else 1) for r in results)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+from typing import Iterator, List, Set
+from query_cluster import AWSInstance, get_aws_instance
+from utils import ensure_min_python_version, Backoff
+
+import boto3
+import time
+
+ensure_min_python_version()
+
+EC2_INSTANCE_RESOURCE = "AWS::EC2::Instance"
+STACK_RESOURCE = "AWS::CloudFormation::Stack"
+TERMINAL_STACK_STATUSES = {"CREATE_COMPLETE", "CREATE_FAILED", "ROLLBACK_COMPLETE", "ROLLBACK_FAILED",
+                           "DELETE_COMPLETE", "DELETE_FAILED", "UPDATE_COMPLETE", "UPDATE_ROLLBACK_COMPLETE",
+                           "UPDATE_ROLLBACK_FAILED"}
+
+
+class StackFailedError(Exception):
+    pass
+
+
+class StackEventTailer:
+    """Follows the events of a CloudFormation stack as they happen
+
+    describe_stack_events returns the newest events first, paged with NextToken.  Each poll pages
+    backwards only until it reaches an event that has already been seen, so a long running stack
+    with hundreds of events doesn't cost a full listing every time, and no event is missed when more
+    than one page of events arrives between polls.  The poll interval backs off while nothing is
+    happening and resets as soon as something does.
+    """
+
+    __stack_name: str
+    __region: str
+    __seen: Set[str]
+    __stack_status: str
+
+    def __init__(self, stack_name: str, region: str):
+        self.__stack_name = stack_name
+        self.__region = region
+        self.__seen = set()
+        self.__stack_status = None
+
+    @property
+    def stack_status(self) -> str:
+        return self.__stack_status
+
+    @property
+    def finished(self) -> bool:
+        return self.__stack_status in TERMINAL_STACK_STATUSES
+
+    @property
+    def succeeded(self) -> bool:
+        return self.__stack_status == "CREATE_COMPLETE"
+
+    def _poll(self, cf) -> List[dict]:
+        new_events = []
+        paginator = cf.get_paginator("describe_stack_events")
+        for page in paginator.paginate(StackName=self.__stack_name):
+            caught_up = False
+            for event in page["StackEvents"]:
+                if event["EventId"] in self.__seen:
+                    caught_up = True
+                    break
+
+                new_events.append(event)
+
+            if caught_up:
+                break
+
+        # Oldest first, as they happened
+        new_events.reverse()
+        for event in new_events:
+            self.__seen.add(event["EventId"])
+            if event["ResourceType"] == STACK_RESOURCE and event["LogicalResourceId"] == self.__stack_name:
+                self.__stack_status = event["ResourceStatus"]
+
+        return new_events
+
+    def events(self, timeout: float = 3600) -> Iterator[dict]:
+        """Yields each new stack event until the stack reaches a terminal status
+
+        Arguments:
+            timeout -- How long to follow the stack for
+
+        Returns:
+            A generator of the raw event dictionaries, oldest first
+        """
+
+        cf = boto3.client("cloudformation", region_name=self.__region)
+        backoff = Backoff(2.0, 15.0, 1.5)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            new_events = self._poll(cf)
+            yield from new_events
+            if self.finished:
+                return
+
+            if len(new_events) > 0:
+                backoff.reset()
+
+            time.sleep(backoff.next())
+
+        raise TimeoutError("Stack {} did not finish within {} seconds".format(self.__stack_name, timeout))
+
+    def created_instances(self, timeout: float = 3600) -> Iterator[AWSInstance]:
+        """Yields each EC2 instance in the stack as soon as CloudFormation reports it as created
+
+        Raises StackFailedError once the stack has been followed to the end if it didn't succeed
+
+        Arguments:
+            timeout -- How long to follow the stack for
+
+        Returns:
+            A generator of AWSInstance objects
+        """
+
+        for event in self.events(timeout):
+            status = event["ResourceStatus"]
+            if event["ResourceType"] == EC2_INSTANCE_RESOURCE:
+                if status == "CREATE_COMPLETE":
+                    instance = get_aws_instance(event["PhysicalResourceId"], self.__region)
+                    if instance is not None:
+                        yield instance
+                elif status == "CREATE_FAILED":
+                    print("{} failed to create: {}".format(event["LogicalResourceId"],
+                                                           event.get("ResourceStatusReason")))
+
+        if not self.succeeded:
+            raise StackFailedError("Stack {} finished with status {}".format(self.__stack_name, self.__stack_status))
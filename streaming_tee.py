@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+from pathlib import Path
+from queue import Queue, Full
+from threading import Thread
+from typing import List
+from termcolor import colored
+from query_cluster import AWSInstance
+from ssh_utils import ssh_session, remote_sha256, HostResult
+from downloader import DownloadError, SegmentedDownloader, fetch_published_sha256, get_http_session, READ_BLOCK_SIZE
+from utils import ensure_min_python_version
+
+import hashlib
+import shlex
+import time
+
+ensure_min_python_version()
+
+# How many blocks a node may fall behind the download before the download waits for it
+DEFAULT_QUEUE_DEPTH = 64
+
+
+class _NodeSink:
+    """Writes a stream of blocks to a .part file on one node over SFTP, in its own thread"""
+
+    instance: AWSInstance
+    result: HostResult
+    __queue: Queue
+    __thread: Thread
+    __remote_filename: str
+    __ssh_keyfile: str
+    __keypass: str
+
+    def __init__(self, instance: AWSInstance, remote_filename: str, ssh_keyfile: str, keypass: str,
+                 queue_depth: int):
+        self.instance = instance
+        self.result = HostResult(instance)
+        self.__queue = Queue(maxsize=queue_depth)
+        self.__remote_filename = remote_filename
+        self.__ssh_keyfile = ssh_keyfile
+        self.__keypass = keypass
+        self.__thread = Thread(target=self._run, name="tee_{}".format(instance.name), daemon=True)
+
+    @property
+    def part_filename(self) -> str:
+        return "{}.part".format(self.__remote_filename)
+
+    @property
+    def failed(self) -> bool:
+        return self.result.error is not None
+
+    def start(self):
+        self.result.attempts = 1
+        self.__thread.start()
+
+    def put(self, block: bytes):
+        # Blocking here is the backpressure, but never wait on a node that has already failed
+        while not self.failed:
+            try:
+                self.__queue.put(block, timeout=1)
+                return
+            except Full:
+                continue
+
+    def join(self):
+        self.put(None)
+        self.__thread.join()
+
+    def _run(self):
+        start = time.monotonic()
+        try:
+            with ssh_session(self.instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+                sftp = ssh_client.open_sftp()
+                try:
+                    with sftp.open(self.part_filename, "wb") as fout:
+                        fout.set_pipelined(True)
+                        while True:
+                            block = self.__queue.get()
+                            if block is None:
+                                break
+
+                            fout.write(block)
+                finally:
+                    sftp.close()
+        except Exception as e:
+            self.result.error = str(e)
+        finally:
+            self.result.duration = time.monotonic() - start
+
+    def finish(self, sha256: str):
+        if self.failed:
+            return
+
+        with ssh_session(self.instance.address, self.__ssh_keyfile, self.__keypass) as ssh_client:
+            if remote_sha256(ssh_client, self.part_filename) != sha256:
+                self.result.error = "Checksum mismatch after streaming"
+                return
+
+            (_, stdout, _) = ssh_client.exec_command("mv -f {} {}".format(shlex.quote(self.part_filename),
+                                                                          shlex.quote(self.__remote_filename)))
+            self.result.exit_code = stdout.channel.recv_exit_status()
+
+
+def stream_package(url: str, path: Path, instances: List[AWSInstance], remote_filename: str, ssh_keyfile: str,
+                   keypass: str = None, queue_depth: int = DEFAULT_QUEUE_DEPTH) -> List[HostResult]:
+    """Downloads url to a local path while forwarding the same bytes to every node as they arrive
+
+    Each node has a bounded queue of pending blocks, so the download proceeds at the pace of the
+    slowest healthy node rather than buffering the whole package in memory.  A node that fails is
+    dropped from the stream without stopping the others.  Once the last byte lands every node's copy
+    is verified against the SHA-256 of the local file and moved into place, so the install can start
+    immediately afterwards.  The download itself is checked against the advertised size and the
+    published SHA-256 (if any) first; if either doesn't match the local file is removed, nothing is
+    moved into place on the nodes and DownloadError is raised.
+
+    Arguments:
+        url             -- The package to download
+        path            -- The local file to write (e.g. from ArtifactStore.temp_path)
+        instances       -- The nodes to forward the package to
+        remote_filename -- The path to write to on each node
+        ssh_keyfile     -- The key to connect to the nodes with
+        keypass         -- The password for the key, if any
+        queue_depth     -- How many blocks each node may fall behind by
+
+    Returns:
+        One HostResult per node
+    """
+
+    path = Path(path)
+    # This download overwrites the file, so progress from an earlier segmented download no longer applies
+    progress_path = SegmentedDownloader.progress_path(path)
+    if progress_path.exists():
+        progress_path.unlink()
+
+    sinks = list(_NodeSink(i, remote_filename, ssh_keyfile, keypass, queue_depth) for i in instances)
+    for sink in sinks:
+        sink.start()
+
+    session = get_http_session()
+    digest = hashlib.sha256()
+    received = 0
+    expected_size = None
+    try:
+        with session.get(url, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            # The length of an encoded response doesn't match the decoded bytes we receive
+            if resp.headers.get("Content-Encoding", "identity") == "identity":
+                expected_size = resp.headers.get("Content-Length")
+
+            with path.open(mode="wb") as fout:
+                for block in resp.iter_content(READ_BLOCK_SIZE):
+                    fout.write(block)
+                    digest.update(block)
+                    received += len(block)
+                    for sink in sinks:
+                        sink.put(block)
+    finally:
+        for sink in sinks:
+            sink.join()
+
+    sha256 = digest.hexdigest()
+    error = None
+    if expected_size is not None and received != int(expected_size):
+        error = "Downloaded {} bytes from {}, expected {}".format(received, url, expected_size)
+    else:
+        expected_sha256 = fetch_published_sha256(session, url)
+        if expected_sha256 is not None and sha256 != expected_sha256:
+            error = "Checksum mismatch for {}".format(url)
+
+    if error is not None:
+        # The nodes are left with only their .part files, which the direct upload overwrites
+        path.unlink()
+        raise DownloadError(error)
+
+    for sink in sinks:
+        sink.finish(sha256)
+        if sink.failed:
+            print(colored("Streaming to {} failed ({}), it will be uploaded directly instead".format(
+                          sink.instance.name, sink.result.error), "yellow"))
+
+    return list(s.result for s in sinks)
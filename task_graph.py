@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from enum import Enum
+from typing import Callable, Dict, List
+from tabulate import tabulate
+from termcolor import colored
+from utils import ensure_min_python_version
+
+import time
+
+ensure_min_python_version()
+
+
+class TaskState(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __str__(self):
+        return self.value
+
+
+class GraphTask:
+    name: str
+    action: Callable[[], object]
+    dependencies: List[str]
+    state: TaskState
+    started: float
+    finished: float
+    error: str
+
+    def __init__(self, name: str, action: Callable[[], object], dependencies: List[str]):
+        self.name = name
+        self.action = action
+        self.dependencies = dependencies
+        self.state = TaskState.PENDING
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+
+        return self.finished - self.started
+
+
+class TaskGraph:
+    """Runs a set of tasks with explicit dependencies, starting each one as soon as everything it depends on succeeds
+
+    Independent tasks run concurrently (up to max_workers at once).  A task that raises is marked as
+    failed and everything that depends on it, directly or not, is skipped while unrelated work carries
+    on.  After run() the critical path, i.e. the chain of dependencies that determined the total time,
+    can be reported to show what is worth speeding up next.
+    """
+
+    __tasks: Dict[str, GraphTask]
+    __max_workers: int
+    __started: float
+
+    def __init__(self, max_workers: int = 16):
+        self.__tasks = {}
+        self.__max_workers = max_workers
+        self.__started = None
+
+    @property
+    def tasks(self) -> List[GraphTask]:
+        return list(self.__tasks.values())
+
+    def add(self, name: str, action: Callable[[], object], dependencies: List[str] = None) -> str:
+        """Adds a task to the graph
+
+        Arguments:
+            name         -- A unique name for the task
+            action       -- The function to run, which signals failure by raising
+            dependencies -- The names of the tasks that must succeed first (they may be added later)
+
+        Returns:
+            The name, so that it can be used directly in the dependencies of other tasks
+        """
+
+        if name in self.__tasks:
+            raise ValueError("Duplicate task {}".format(name))
+
+        self.__tasks[name] = GraphTask(name, action, list(dependencies or []))
+        return name
+
+    def _validate(self):
+        for task in self.__tasks.values():
+            for dep in task.dependencies:
+                if dep not in self.__tasks:
+                    raise ValueError("{} depends on unknown task {}".format(task.name, dep))
+
+        # Kahn's algorithm, anything left over is part of a cycle
+        remaining = {t.name: len(t.dependencies) for t in self.__tasks.values()}
+        ready = list(n for (n, c) in remaining.items() if c == 0)
+        visited = 0
+        while len(ready) > 0:
+            name = ready.pop()
+            visited += 1
+            for task in self.__tasks.values():
+                if name in task.dependencies:
+                    remaining[task.name] -= 1
+                    if remaining[task.name] == 0:
+                        ready.append(task.name)
+
+        if visited != len(self.__tasks):
+            raise ValueError("The task graph contains a cycle")
+
+    def _run_task(self, task: GraphTask):
+        task.started = time.monotonic()
+        try:
+            task.action()
+            task.state = TaskState.SUCCEEDED
+        except Exception as e:
+            task.error = str(e)
+            task.state = TaskState.FAILED
+        finally:
+            task.finished = time.monotonic()
+
+    def _skip_blocked(self):
+        changed = True
+        while changed:
+            changed = False
+            for task in self.__tasks.values():
+                if task.state != TaskState.PENDING:
+                    continue
+
+                if any(self.__tasks[d].state in (TaskState.FAILED, TaskState.SKIPPED) for d in task.dependencies):
+                    task.state = TaskState.SKIPPED
+                    changed = True
+
+    def run(self) -> bool:
+        """Runs every task in dependency order
+
+        Returns:
+            True if every task succeeded
+        """
+
+        self._validate()
+        self.__started = time.monotonic()
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="task_graph") as tp:
+            while True:
+                self._skip_blocked()
+                for task in self.__tasks.values():
+                    if task.state == TaskState.PENDING and \
+                            all(self.__tasks[d].state == TaskState.SUCCEEDED for d in task.dependencies):
+                        print("[{:7.1f}s] Starting {}".format(time.monotonic() - self.__started, task.name))
+                        task.state = TaskState.RUNNING
+                        running[tp.submit(self._run_task, task)] = task
+
+                if len(running) == 0:
+                    break
+
+                (done, _) = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    if task.state == TaskState.SUCCEEDED:
+                        print("[{:7.1f}s] Finished {} ({:.1f}s)".format(time.monotonic() - self.__started, task.name,
+                                                                        task.duration))
+                    else:
+                        print(colored("[{:7.1f}s] {} failed: {}".format(time.monotonic() - self.__started, task.name,
+                                                                        task.error), "red"))
+
+        return all(t.state == TaskState.SUCCEEDED for t in self.__tasks.values())
+
+    def critical_path(self) -> List[GraphTask]:
+        """Returns the chain of tasks that determined when the last task finished, earliest first"""
+
+        finished = list(t for t in self.__tasks.values() if t.finished is not None)
+        if len(finished) == 0:
+            return []
+
+        path = [max(finished, key=lambda t: t.finished)]
+        while True:
+            deps = list(self.__tasks[d] for d in path[-1].dependencies if self.__tasks[d].finished is not None)
+            if len(deps) == 0:
+                break
+
+            # The dependency that finished last is the one that was actually waited on
+            path.append(max(deps, key=lambda t: t.finished))
+
+        path.reverse()
+        return path
+
+    def print_report(self):
+        rows = []
+        for task in sorted(self.__tasks.values(), key=lambda t: (t.started is None, t.started or 0)):
+            start = "" if task.started is None else "{:.1f}".format(task.started - self.__started)
+            state = colored(str(task.state), "green" if task.state == TaskState.SUCCEEDED else "red")
+            rows.append([task.name, state, start, "{:.1f}".format(task.duration), task.error or ""])
+
+        print(tabulate(rows, ["Task", "State", "Start (s)", "Duration (s)", "Error"]))
+        print()
+
+        path = self.critical_path()
+        if len(path) > 0:
+            total = path[-1].finished - self.__started
+            print("Critical path ({:.1f}s):".format(total))
+            for task in path:
+                print("  {} ({:.1f}s, {:.0f}%)".format(task.name, task.duration,
+                                                       100.0 * task.duration / total if total > 0 else 0))
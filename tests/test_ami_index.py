@@ -0,0 +1,67 @@
+from ami_index import AmiIndex
+from cloud_formation import select_image
+from constants import BASE_IMAGE_ID
+
+import pytest
+
+
+class _Client:
+    """Stands in for the EC2 client, describing each image id with the given state (or not at all)"""
+
+    def __init__(self, states: dict = None):
+        self.states = states or {}
+        self.described = []
+
+    def describe_images(self, Filters):
+        image_id = Filters[0]["Values"][0]
+        self.described.append(image_id)
+        if image_id not in self.states:
+            return {"Images": []}
+
+        return {"Images": [{"ImageId": image_id, "State": self.states[image_id]}]}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = AmiIndex(tmp_path / "amis.json")
+    index.register("us-east-1", "couchbase-server", "7.0.0", "ami-baked", "ami-base")
+    return index
+
+
+def test_lookup_without_verify(index):
+    client = _Client()
+    image = index.lookup("us-east-1", "couchbase-server", "7.0.0", ec2=client)
+
+    assert image.image_id == "ami-baked"
+    assert image.base_image_id == "ami-base"
+    assert client.described == []
+    assert index.lookup("us-east-1", "couchbase-server", "7.1.0") is None
+    assert index.lookup("us-west-2", "couchbase-server", "7.0.0") is None
+
+
+def test_lookup_verifies_the_image(index):
+    client = _Client({"ami-baked": "available"})
+
+    assert index.lookup("us-east-1", "couchbase-server", "7.0.0", True, client).image_id == "ami-baked"
+    assert client.described == ["ami-baked"]
+
+
+def test_unavailable_image_is_skipped_but_kept(index):
+    assert index.lookup("us-east-1", "couchbase-server", "7.0.0", True, _Client({"ami-baked": "pending"})) is None
+    assert len(index.images()) == 1
+
+
+def test_missing_image_is_removed(index):
+    assert index.lookup("us-east-1", "couchbase-server", "7.0.0", True, _Client()) is None
+    assert index.images() == []
+
+
+def test_select_image_prefers_the_baked_image(index):
+    client = _Client({"ami-baked": "available"})
+
+    assert select_image("us-east-1", "couchbase-server", "7.0.0", index, client) == "ami-baked"
+    assert select_image("us-east-1", "couchbase-server", "7.1.0", index, client) == BASE_IMAGE_ID
+
+
+def test_select_image_falls_back_when_the_image_is_gone(index):
+    assert select_image("us-east-1", "couchbase-server", "7.0.0", index, _Client()) == BASE_IMAGE_ID
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from artifact_cache import ArtifactStore
+
+import artifact_cache
+import pytest
+import time
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # Every use gets a distinct, increasing timestamp so that the LRU order is well defined
+    ticks = count(1000)
+    monkeypatch.setattr(artifact_cache.time, "time", lambda: float(next(ticks)))
+
+
+def _source(tmp_path, name: str, size: int, fill: bytes = b"x"):
+    path = tmp_path / "src-{}".format(name)
+    path.write_bytes(fill * size)
+    return path
+
+
+def test_add_moves_the_file_into_the_store(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=1024)
+    source = _source(tmp_path, "a", 100)
+    artifact = store.add("couchbase-server", "7.0.0", None, source, "cbs.rpm")
+
+    assert not source.exists()
+    assert artifact.path.read_bytes() == b"x" * 100
+    assert store.lookup("couchbase-server", "7.0.0", None).sha256 == artifact.sha256
+    assert store.lookup("couchbase-server", "7.0.1", None) is None
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=250)
+    a = store.add("p", "1", None, _source(tmp_path, "a", 100, b"a"), "a.rpm")
+    b = store.add("p", "2", None, _source(tmp_path, "b", 100, b"b"), "b.rpm")
+    # Using a makes b the least recently used
+    store.lookup("p", "1", None)
+    store.add("p", "3", None, _source(tmp_path, "c", 100, b"c"), "c.rpm")
+
+    assert store.lookup("p", "1", None) is not None
+    assert store.lookup("p", "2", None) is None
+    assert a.path.exists()
+    assert not b.path.exists()
+
+
+def test_newest_artifact_is_kept_even_if_it_alone_exceeds_the_cap(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=50)
+    store.add("p", "1", None, _source(tmp_path, "a", 40, b"a"), "a.rpm")
+    big = store.add("p", "2", None, _source(tmp_path, "b", 100, b"b"), "b.rpm")
+
+    assert big.path.exists()
+    assert list(a.version for a in store.artifacts()) == ["2"]
+
+
+def test_shared_content_survives_evicting_one_of_its_entries(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=150)
+    first = store.add("p", "1", None, _source(tmp_path, "a", 100, b"s"), "same.rpm")
+    store.add("p", "1", "42", _source(tmp_path, "b", 100, b"s"), "same.rpm")
+    store.add("q", "1", None, _source(tmp_path, "c", 10, b"q"), "q.rpm")
+
+    # Dedup means both entries only count once on disk, but the index counts each of them
+    assert store.lookup("p", "1", None) is None
+    assert store.lookup("p", "1", "42") is not None
+    assert first.path.exists()
+
+
+def test_fetch_downloads_once(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=1024)
+    calls = []
+
+    def _download(path):
+        calls.append(path)
+        path.write_bytes(b"pkg")
+
+    first = store.fetch("p", "1", None, "p.rpm", _download)
+    second = store.fetch("p", "1", None, "p.rpm", _download)
+
+    assert len(calls) == 1
+    assert calls[0] == store.temp_path("p.rpm")
+    assert first.sha256 == second.sha256
+
+
+def test_concurrent_fetches_share_one_download(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=1024)
+    calls = []
+
+    def _download(path):
+        calls.append(path)
+        # Hold the download lock long enough for the other callers to queue up behind it
+        time.sleep(0.2)
+        path.write_bytes(b"pkg")
+
+    with ThreadPoolExecutor(max_workers=4) as tp:
+        artifacts = list(tp.map(lambda _: store.fetch("p", "1", None, "p.rpm", _download), range(4)))
+
+    assert len(calls) == 1
+    assert len(set(a.sha256 for a in artifacts)) == 1
+    assert all(a.path.read_bytes() == b"pkg" for a in artifacts)
@@ -0,0 +1,37 @@
+from threading import Event
+from cluster_watcher import ClusterWatcher
+from couchbase_rest import NodeStatus
+
+import time
+
+HEALTHY = {"hostname": "cb1:8091", "status": "healthy", "clusterMembership": "active"}
+WARMUP = {"hostname": "cb1:8091", "status": "warmup", "clusterMembership": "active"}
+
+
+class _Client:
+    """Reports a warming up node, then streams the healthy node for as long as it's read"""
+
+    def __init__(self):
+        self.closed = Event()
+
+    def nodes(self):
+        return [NodeStatus(WARMUP)]
+
+    def stream_json(self, path):
+        try:
+            while True:
+                yield {"nodes": [HEALTHY]}
+                time.sleep(0.01)
+        finally:
+            self.closed.set()
+
+
+def test_stream_stops_once_healthy():
+    client = _Client()
+    transitions = []
+    nodes = ClusterWatcher(client, on_transition=transitions.append).wait_for_healthy(expected_nodes=1, timeout=10)
+
+    assert list(n.status for n in nodes) == ["healthy"]
+    assert list(t.new_status for t in transitions) == ["warmup", "healthy"]
+    # The streaming thread doesn't outlive the wait
+    assert client.closed.wait(5)
@@ -0,0 +1,106 @@
+from couchbase_rest import CouchbaseAdminClient, CouchbaseRestError, RebalanceProgress
+
+import json
+import pytest
+
+
+class _Response:
+    def __init__(self, status_code: int, body=None):
+        self.status_code = status_code
+        self.content = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class _Session:
+    """Records every request, and answers each path with a canned (status, body)"""
+
+    def __init__(self, responses: dict = None):
+        self.responses = responses or {}
+        self.requests = []
+
+    def request(self, method, url, data=None, auth=None, **kwargs):
+        path = url.split(":8091", 1)[1]
+        self.requests.append((method, path, data, auth))
+        (status, body) = self.responses.get((method, path), (200, None))
+        return _Response(status, body)
+
+
+def _client(responses: dict = None):
+    session = _Session(responses)
+    return (CouchbaseAdminClient("cb1", "admin", "secret", session=session), session)
+
+
+def test_cluster_init_payloads():
+    (client, session) = _client()
+    client.cluster_init("device-farm", 4096, 1024)
+
+    assert session.requests == [
+        ("POST", "/pools/default", {"memoryQuota": 4096, "indexMemoryQuota": 1024, "clusterName": "device-farm"}, None),
+        ("POST", "/node/controller/setupServices", {"services": "kv,index,n1ql"}, None),
+        ("POST", "/settings/indexes", {"storageMode": "plasma"}, None),
+        ("POST", "/settings/web", {"username": "admin", "password": "secret", "port": "SAME"}, None)
+    ]
+
+
+def test_cluster_init_without_index_skips_index_settings():
+    (client, session) = _client()
+    client.cluster_init("device-farm", 4096, 1024, services=["kv"])
+
+    assert list(r[1] for r in session.requests) == ["/pools/default", "/node/controller/setupServices",
+                                                    "/settings/web"]
+
+
+def test_is_initialized_uses_authenticated_pools_default():
+    (client, session) = _client({("GET", "/pools/default"): (200, {"nodes": []})})
+    assert client.is_initialized()
+    assert session.requests == [("GET", "/pools/default", None, ("admin", "secret"))]
+
+    (client, _) = _client({("GET", "/pools/default"): (404, "unknown pool")})
+    assert not client.is_initialized()
+
+
+def test_is_initialized_raises_for_other_credentials():
+    (client, _) = _client({("GET", "/pools/default"): (401, None)})
+    with pytest.raises(CouchbaseRestError) as e:
+        client.is_initialized()
+
+    assert e.value.status_code == 401
+
+
+def test_add_node_and_rebalance_payloads():
+    nodes = {"nodes": [{"otpNode": "ns_1@10.0.0.1"}, {"otpNode": "ns_1@10.0.0.2"}]}
+    (client, session) = _client({("GET", "/pools/default"): (200, nodes)})
+    client.add_node("10.0.0.2", "admin", "secret", services=["kv"])
+    client.rebalance(ejected=["ns_1@10.0.0.3"])
+
+    assert session.requests[0] == ("POST", "/controller/addNode", {"hostname": "https://10.0.0.2:18091",
+                                                                   "user": "admin", "password": "secret",
+                                                                   "services": "kv"}, ("admin", "secret"))
+    assert session.requests[-1][:3] == ("POST", "/controller/rebalance",
+                                        {"knownNodes": "ns_1@10.0.0.1,ns_1@10.0.0.2",
+                                         "ejectedNodes": "ns_1@10.0.0.3"})
+
+
+def test_create_bucket_payload():
+    (client, session) = _client()
+    client.create_bucket("db", 2048, replicas=0, flush_enabled=False)
+
+    assert session.requests == [("POST", "/pools/default/buckets", {"name": "db", "ramQuotaMB": 2048,
+                                                                    "replicaNumber": 0, "flushEnabled": 0,
+                                                                    "bucketType": "couchbase"},
+                                 ("admin", "secret"))]
+
+
+def test_missing_bucket_is_none():
+    (client, _) = _client({("GET", "/pools/default/buckets/db"): (404, None)})
+    assert client.bucket("db") is None
+
+
+def test_rebalance_progress():
+    progress = RebalanceProgress({"status": "running", "ns_1@a": {"progress": 0.5}, "ns_1@b": {"progress": 1.0}})
+    assert progress.running
+    assert progress.percent == 75.0
+    assert RebalanceProgress({"status": "none"}).percent == 100.0
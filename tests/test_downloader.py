@@ -0,0 +1,164 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from downloader import DownloadError, SegmentedDownloader
+
+import downloader
+import hashlib
+import json
+import pytest
+import random
+import requests
+
+PAYLOAD = bytes(random.Random(7).getrandbits(8) for _ in range(256 * 1024))
+
+
+class _Server:
+    """Serves PAYLOAD at /file, with or without range support, and records every Range asked for"""
+
+    def __init__(self, ranges: bool = True, sha256: str = None):
+        self.ranges = ranges
+        self.sha256 = sha256
+        self.requested = []
+        server = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(PAYLOAD)))
+                if server.ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path == "/file.sha256":
+                    if server.sha256 is None:
+                        self.send_error(404)
+                        return
+
+                    body = "{}  file\n".format(server.sha256).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                requested = self.headers.get("Range")
+                server.requested.append(requested)
+                if requested is None or not server.ranges:
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(PAYLOAD)))
+                    self.end_headers()
+                    self.wfile.write(PAYLOAD)
+                    return
+
+                (start, end) = (int(x) for x in requested.split("=")[1].split("-"))
+                body = PAYLOAD[start:end + 1]
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(PAYLOAD)))
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.url = "http://127.0.0.1:{}/file".format(self.httpd.server_address[1])
+        Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    # Split the small payload the way a large installer would be split
+    monkeypatch.setattr(downloader, "MIN_SEGMENT_SIZE", 64 * 1024)
+    monkeypatch.setattr(downloader, "READ_BLOCK_SIZE", 16 * 1024)
+
+
+def _downloader() -> SegmentedDownloader:
+    return SegmentedDownloader(session=requests.Session(), timeout=10)
+
+
+def test_segmented_download(tmp_path, small_segments):
+    server = _Server()
+    try:
+        path = _downloader().download(server.url, tmp_path / "file")
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+    assert sorted(server.requested) == ["bytes=0-65535", "bytes=131072-196607", "bytes=196608-262143",
+                                        "bytes=65536-131071"]
+    assert not SegmentedDownloader.progress_path(path).exists()
+
+
+def test_download_without_range_support(tmp_path, small_segments):
+    server = _Server(ranges=False)
+    try:
+        path = _downloader().download(server.url, tmp_path / "file")
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+    assert server.requested == [None]
+
+
+def test_resume_only_fetches_what_is_missing(tmp_path, small_segments):
+    server = _Server()
+    path = tmp_path / "file"
+    # An earlier run finished the first segment and half of the last one
+    partial = bytearray(len(PAYLOAD))
+    partial[0:65536] = PAYLOAD[0:65536]
+    partial[196608:229376] = PAYLOAD[196608:229376]
+    path.write_bytes(bytes(partial))
+    segments = [[0, 65535, 65536], [65536, 131071, 65536], [131072, 196607, 131072], [196608, 262143, 229376]]
+    SegmentedDownloader.progress_path(path).write_text(json.dumps({"url": server.url, "size": len(PAYLOAD),
+                                                                   "segments": segments}))
+    try:
+        _downloader().download(server.url, path)
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+    assert sorted(server.requested) == ["bytes=131072-196607", "bytes=229376-262143", "bytes=65536-131071"]
+
+
+def test_progress_for_another_url_starts_over(tmp_path, small_segments):
+    server = _Server()
+    path = tmp_path / "file"
+    path.write_bytes(bytes(len(PAYLOAD)))
+    SegmentedDownloader.progress_path(path).write_text(json.dumps({
+        "url": "http://elsewhere/file", "size": len(PAYLOAD), "segments": [[0, len(PAYLOAD) - 1, len(PAYLOAD)]]}))
+    try:
+        _downloader().download(server.url, path)
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+    assert len(server.requested) == 4
+
+
+def test_published_checksum_is_verified(tmp_path, small_segments):
+    server = _Server(sha256=hashlib.sha256(PAYLOAD).hexdigest())
+    try:
+        path = _downloader().download(server.url, tmp_path / "file")
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+
+
+def test_checksum_mismatch_discards_the_file(tmp_path, small_segments):
+    server = _Server(sha256="0" * 64)
+    path = tmp_path / "file"
+    try:
+        with pytest.raises(DownloadError):
+            _downloader().download(server.url, path)
+    finally:
+        server.close()
+
+    assert not path.exists()
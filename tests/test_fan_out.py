@@ -0,0 +1,99 @@
+from threading import Lock
+from query_cluster import AWSInstance
+from ssh_utils import FanOutExecutor, fan_out, fan_out_exit_code
+
+import time
+
+
+def _instance(name: str) -> AWSInstance:
+    return AWSInstance({"Name": name, "Address": "{}.example.com".format(name)})
+
+
+def test_results_and_exit_codes():
+    results = fan_out([_instance("a"), _instance("b")], lambda i: 0 if i.name == "a" else 3)
+    assert {r.name: r.exit_code for r in results} == {"a": 0, "b": 3}
+    assert fan_out_exit_code(results) == 3
+
+
+def test_exception_is_retried():
+    calls = []
+
+    def _task(_):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RuntimeError("transient")
+
+        return 0
+
+    (result,) = fan_out([_instance("a")], _task, retries=1, backoff=0.01)
+    assert result.succeeded
+    assert result.attempts == 2
+
+
+def test_timed_out_attempt_does_not_overlap_or_replace_its_retry():
+    lock = Lock()
+    running = [0]
+    overlaps = []
+    attempts = []
+
+    def _task(_):
+        with lock:
+            attempts.append(len(attempts) + 1)
+            attempt = attempts[-1]
+            running[0] += 1
+            overlaps.append(running[0] > 1)
+
+        try:
+            # The first attempt times out and finishes late with a failure code
+            time.sleep(1.5 if attempt == 1 else 0.5)
+            return 7 if attempt == 1 else 0
+        finally:
+            with lock:
+                running[0] -= 1
+
+    executor = FanOutExecutor(timeout=1.0, retries=1, backoff=0.01)
+    executor.submit(_instance("a"), _task)
+    (result,) = executor.wait()
+
+    assert result.exit_code == 0
+    assert result.attempts == 2
+    assert not any(overlaps)
+
+
+def test_stuck_attempt_fails_the_task():
+    executor = FanOutExecutor(timeout=0.2, retries=1, backoff=0.01)
+    executor.submit(_instance("a"), lambda _: time.sleep(2) or 0)
+    start = time.monotonic()
+    (result,) = executor.wait()
+
+    assert result.error is not None
+    assert time.monotonic() - start < 1.5
+
+
+def test_timed_out_attempts_still_count_towards_max_workers():
+    lock = Lock()
+    running = [0]
+    peak = [0]
+
+    def _task(_):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+
+        try:
+            time.sleep(0.5)
+            return 0
+        finally:
+            with lock:
+                running[0] -= 1
+
+    # Every attempt times out, but its thread keeps running until the sleep ends
+    executor = FanOutExecutor(max_workers=2, timeout=0.1)
+    for name in ("a", "b", "c", "d"):
+        executor.submit(_instance(name), _task)
+
+    results = executor.wait()
+    time.sleep(0.6)
+
+    assert len(results) == 4
+    assert peak[0] <= 2
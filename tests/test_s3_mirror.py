@@ -0,0 +1,73 @@
+from artifact_cache import ArtifactStore
+from s3_mirror import PACKAGE_FOLDER, SHA256_METADATA_KEY, S3Mirror
+
+import boto3
+import botocore.exceptions
+import pytest
+
+
+class _Client:
+    """Stands in for the S3 client, with a single stored object (or none)"""
+
+    def __init__(self, head: dict = None, error_code: str = "404"):
+        self.head = head
+        self.error_code = error_code
+        self.uploads = []
+
+    def head_object(self, Bucket, Key):
+        if self.head is None:
+            raise botocore.exceptions.ClientError({"Error": {"Code": self.error_code}}, "HeadObject")
+
+        return self.head
+
+    def upload_file(self, filename, bucket, key, ExtraArgs=None, Config=None):
+        self.uploads.append((filename, bucket, key, ExtraArgs))
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    store = ArtifactStore(tmp_path / "store", max_bytes=1024 * 1024)
+    source = tmp_path / "download"
+    source.write_bytes(b"package contents")
+    return store.add("couchbase-server", "7.0.0", None, source, "couchbase-server.rpm")
+
+
+def test_key_is_content_addressed(artifact):
+    assert S3Mirror.key(artifact) == "{}/{}/couchbase-server.rpm".format(PACKAGE_FOLDER, artifact.sha256)
+
+
+def test_publish_uploads_a_missing_package(artifact):
+    client = _Client()
+    assert S3Mirror(bucket="bucket", client=client).publish(artifact)
+    assert client.uploads == [(str(artifact.path), "bucket", S3Mirror.key(artifact),
+                               {"Metadata": {SHA256_METADATA_KEY: artifact.sha256}})]
+
+
+def test_publish_skips_a_matching_copy(artifact):
+    client = _Client({"ContentLength": artifact.size, "Metadata": {SHA256_METADATA_KEY: artifact.sha256}})
+    assert not S3Mirror(bucket="bucket", client=client).publish(artifact)
+    assert client.uploads == []
+
+
+@pytest.mark.parametrize("head", [
+    {"ContentLength": 1, "Metadata": {SHA256_METADATA_KEY: "0" * 64}},
+    {"ContentLength": 16, "Metadata": {}}
+])
+def test_publish_replaces_a_different_copy(artifact, head):
+    client = _Client(head)
+    assert S3Mirror(bucket="bucket", client=client).publish(artifact)
+    assert len(client.uploads) == 1
+
+
+def test_other_errors_are_raised(artifact):
+    with pytest.raises(botocore.exceptions.ClientError):
+        S3Mirror(bucket="bucket", client=_Client(error_code="AccessDenied")).publish(artifact)
+
+
+def test_presigned_url_points_at_the_package(artifact):
+    client = boto3.client("s3", region_name="us-east-1", endpoint_url="http://127.0.0.1:9000",
+                          aws_access_key_id="test", aws_secret_access_key="test")
+    url = S3Mirror(bucket="bucket", client=client).presigned_url(artifact, expires=60)
+
+    assert url.startswith("http://127.0.0.1:9000/bucket/{}?".format(S3Mirror.key(artifact)))
+    assert "Signature" in url
@@ -0,0 +1,77 @@
+from seed_dataset import ChannelDistribution, SeedCheckpoint, SeedSpec, shard_range
+
+import json
+import pytest
+
+
+def _spec(distribution: ChannelDistribution = ChannelDistribution.UNIFORM, seed: int = 0) -> SeedSpec:
+    return SeedSpec(1000, 256, 20, 3, distribution, "seed::{:06d}", seed)
+
+
+@pytest.mark.parametrize("count,shards", [(0, 3), (10, 1), (10, 3), (1000, 7), (5, 8)])
+def test_shards_partition_the_dataset(count, shards):
+    indexes = []
+    for shard in range(shards):
+        indexes.extend(shard_range(count, shard, shards))
+
+    assert indexes == list(range(count))
+
+
+def test_shards_are_balanced():
+    sizes = list(len(shard_range(1000, s, 7)) for s in range(7))
+    assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize("distribution", list(ChannelDistribution))
+def test_documents_are_deterministic(distribution):
+    first = _spec(distribution).generator()
+    second = _spec(distribution).generator()
+
+    # Generating out of order (as a resumed shard would) gives the same documents
+    assert list(first(i) for i in range(50)) == list(second(i) for i in reversed(range(50)))[::-1]
+    assert first(7) == first(7)
+
+
+def test_documents_depend_on_the_seed():
+    assert _spec(seed=0).generator()(7) != _spec(seed=1).generator()(7)
+
+
+def test_document_shape():
+    doc = _spec().generator()(42)
+
+    assert doc["index"] == 42
+    assert len(doc["channels"]) == 3
+    assert all(c.startswith("channel-") for c in doc["channels"])
+    assert abs(len(json.dumps(doc)) - 256) <= 16
+    assert _spec().key(42) == "seed::000042"
+
+
+def test_zipf_favours_the_first_channels():
+    spec = SeedSpec(2000, 64, 20, 1, ChannelDistribution.ZIPF, "{}", 0)
+    generate = spec.generator()
+    counts = {}
+    for i in range(2000):
+        channel = generate(i)["channels"][0]
+        counts[channel] = counts.get(channel, 0) + 1
+
+    assert counts["channel-0"] > counts.get("channel-19", 0) * 5
+
+
+def test_fingerprint_changes_with_the_settings():
+    assert _spec().fingerprint == _spec().fingerprint
+    assert _spec().fingerprint != _spec(seed=1).fingerprint
+    assert _spec().fingerprint != _spec(ChannelDistribution.ZIPF).fingerprint
+
+
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint = SeedCheckpoint("bucket", _spec(), 1, 4, folder=tmp_path)
+    assert checkpoint.read(250) == 250
+
+    checkpoint.write(300)
+    assert SeedCheckpoint("bucket", _spec(), 1, 4, folder=tmp_path).read(250) == 300
+    # A different dataset or sharding doesn't pick up the progress
+    assert SeedCheckpoint("bucket", _spec(seed=1), 1, 4, folder=tmp_path).read(250) == 250
+    assert SeedCheckpoint("bucket", _spec(), 1, 5, folder=tmp_path).read(200) == 200
+
+    checkpoint.clear()
+    assert checkpoint.read(250) == 250
@@ -0,0 +1,32 @@
+from downloader import DownloadError, SegmentedDownloader
+from streaming_tee import stream_package
+from test_downloader import PAYLOAD, _Server
+
+import hashlib
+import pytest
+
+
+def test_stream_checks_the_published_checksum(tmp_path):
+    server = _Server(sha256=hashlib.sha256(PAYLOAD).hexdigest())
+    path = tmp_path / "file"
+    SegmentedDownloader.progress_path(path).write_text("{}")
+    try:
+        assert stream_package(server.url, path, [], "/tmp/file", "key") == []
+    finally:
+        server.close()
+
+    assert path.read_bytes() == PAYLOAD
+    # A later segmented download mustn't resume from the stale progress
+    assert not SegmentedDownloader.progress_path(path).exists()
+
+
+def test_stream_checksum_mismatch_discards_the_file(tmp_path):
+    server = _Server(sha256="0" * 64)
+    path = tmp_path / "file"
+    try:
+        with pytest.raises(DownloadError):
+            stream_package(server.url, path, [], "/tmp/file", "key")
+    finally:
+        server.close()
+
+    assert not path.exists()
@@ -1,6 +1,20 @@
 #!/usr/bin/env python3
 
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+
 import sys
+import hashlib
+import random
+import time
+
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    import msvcrt
+    HAVE_FCNTL = False
 
 
 MIN_PY_VERSION = (3, 5, 0)
@@ -11,3 +25,98 @@ def ensure_min_python_version():
         found_ver = ".".join(str(i) for i in sys.version_info[:3])
         required_ver = ".".join(str(i) for i in MIN_PY_VERSION)
         raise AssertionError("Python {} required (detected {})".format(required_ver, found_ver))
+
+
+def file_sha256(filename: str, start: int = 0, length: int = None) -> str:
+    """Computes the SHA-256 of a file, or of the given byte range of it"""
+
+    digest = hashlib.sha256()
+    remaining = length
+    with open(filename, "rb") as fin:
+        fin.seek(start)
+        while remaining is None or remaining > 0:
+            block = fin.read(1024 * 1024 if remaining is None else min(1024 * 1024, remaining))
+            if not block:
+                break
+
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    return digest.hexdigest()
+
+
+@contextmanager
+def file_lock(lock_path: Path):
+    # Exclusive across processes as well as across threads (each caller opens its own handle)
+    with lock_path.open(mode="a+") as lock_file:
+        if HAVE_FCNTL:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+
+        try:
+            yield
+        finally:
+            if HAVE_FCNTL:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class Backoff:
+    """Exponential backoff with jitter that can be reset when progress is observed"""
+
+    __initial: float
+    __maximum: float
+    __factor: float
+    __current: float
+
+    def __init__(self, initial: float = 0.5, maximum: float = 10.0, factor: float = 2.0):
+        self.__initial = initial
+        self.__maximum = maximum
+        self.__factor = factor
+        self.__current = initial
+
+    def reset(self):
+        self.__current = self.__initial
+
+    def next(self) -> float:
+        """Returns the next delay to wait, and grows the delay for the following call"""
+
+        delay = self.__current * random.uniform(0.5, 1.0)
+        self.__current = min(self.__maximum, self.__current * self.__factor)
+        return delay
+
+
+class RateLimiter:
+    """A thread safe token bucket that allows rate operations per second on average, in bursts of up to burst"""
+
+    __rate: float
+    __burst: float
+    __tokens: float
+    __updated: float
+    __lock: Lock
+
+    def __init__(self, rate: float, burst: int = None):
+        self.__rate = rate
+        self.__burst = float(burst if burst is not None else max(1, int(rate)))
+        self.__tokens = self.__burst
+        self.__updated = time.monotonic()
+        self.__lock = Lock()
+
+    def acquire(self):
+        """Blocks until an operation is allowed"""
+
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+                self.__updated = now
+                if self.__tokens >= 1.0:
+                    self.__tokens -= 1.0
+                    return
+
+                delay = (1.0 - self.__tokens) / self.__rate
+
+            time.sleep(delay)